@@ -122,6 +122,14 @@ inline Vec3dSimd cross(Vec3d& a, Vec3dSimd& b){
     return Vec3dSimd(a[1] * b.z - a[2] * b.y, a[2] * b.x - a[0] * b.z, a[0] * b.y - a[1] * b.x);
 }
 
+inline simd_t inner(Vec3dSimd& a, Vec3dSimd& b){
+    return a.x*b.x+a.y*b.y+a.z*b.z;
+}
+
+inline Vec3dSimd cross(Vec3dSimd& a, Vec3dSimd& b){
+    return Vec3dSimd(a.y * b.z - a.z * b.y, a.z * b.x - a.x * b.z, a.x * b.y - a.y * b.x);
+}
+
 inline simd_t normsq(Vec3dSimd& a){
     return a.x*a.x+a.y*a.y+a.z*a.z;
 }
@@ -131,6 +139,14 @@ void biot_savart_B_only(Array& points, vector<Array>& gammas, vector<Array>& dga
 
 void biot_savart_by_dcoilcoeff_all(Array& points, vector<Array>& gammas, vector<Array>& dgamma_by_dphis, vector<Array>& dgamma_by_dcoeffs, vector<Array>& d2gamma_by_dphidcoeffs, vector<double>& currents, vector<Array>& dB_by_dcoilcoeffs, vector<Array>& d2B_by_dXdcoilcoeff);
 
+void biot_savart_all_tiled(Array& points, vector<Array>& gammas, vector<Array>& dgamma_by_dphis, vector<double>& currents, Array& B, Array& dB_by_dX, Array& d2B_by_dXdX, vector<Array>& dB_by_coilcurrents, vector<Array>& d2B_by_dXdcoilcurrents, int num_threads, int chunk_size);
+void biot_savart_by_dcoilcoeff_all_tiled(Array& points, vector<Array>& gammas, vector<Array>& dgamma_by_dphis, vector<Array>& dgamma_by_dcoeffs, vector<Array>& d2gamma_by_dphidcoeffs, vector<double>& currents, vector<Array>& dB_by_dcoilcoeffs, vector<Array>& d2B_by_dXdcoilcoeff, int num_threads, int chunk_size);
+
+void biot_savart_vjp(Array& points, vector<Array>& gammas, vector<Array>& dgamma_by_dphis, vector<double>& currents, Array& v, Array& vgrad, vector<Array>& res_gamma, vector<Array>& res_dgamma_by_dphi);
+
+void biot_savart_all_batched(Array& points, Array& gammas, Array& dgamma_by_dphis, vector<double>& currents, Array& B, Array& dB_by_dX, Array& d2B_by_dXdX, Array& dB_by_dcoilcurrents, Array& d2B_by_dXdcoilcurrents);
+void biot_savart_vjp_batched(Array& points, Array& gammas, Array& dgamma_by_dphis, vector<double>& currents, Array& v, Array& vgrad, Array& res_gamma, Array& res_dgamma_by_dphi);
+
 void biot_savart_B(Array& points, Array& gammas, Array& dgamma_by_dphis, Array& res);
 void biot_savart_dB_by_dX(Array& points, Array& gammas, Array& dgamma_by_dphis, Array& res);
 void biot_savart_d2B_by_dXdX(Array& points, Array& gamma, Array& dgamma_by_dphi, Array& res);
@@ -140,3 +156,7 @@ void biot_savart_d2B_by_dXdcoilcoeff(Array& points, Array& gammas, Array& dgamma
 
 template<class T>
 void biot_savart_all_simd(vector_type& pointsx, vector_type& pointsy, vector_type& pointsz, T& gamma, T& dgamma_by_dphi, T& B, T& dB_by_dX, T& d2B_by_dXdX);
+template<class T>
+void biot_savart_by_dcoilcoeff_all_simd(vector_type& pointsx, vector_type& pointsy, vector_type& pointsz, T& gamma, T& dgamma_by_dphi, T& dgamma_by_dcoeff, T& d2gamma_by_dphidcoeff, T& dB_by_dcoilcoeff, T& d2B_by_dXdcoilcoeff);
+template<class T>
+void biot_savart_vjp_simd(vector_type& pointsx, vector_type& pointsy, vector_type& pointsz, T& gamma, T& dgamma_by_dphi, vector_type& vx, vector_type& vy, vector_type& vz, vector<vector_type>& vgrad, T& res_gamma, T& res_dgamma_by_dphi, bool compute_dB);
@@ -0,0 +1,109 @@
+#include "biot_savart.h"
+
+/*
+ * Batched versions of biot_savart_all and biot_savart_vjp for many samples of
+ * the same coil set, e.g. the perturbed coils of a stochastic objective. The
+ * geometry is passed as arrays of shape (num_samples, num_coils,
+ * num_quad_points, 3), all samples share the target points and the currents.
+ * The samples are distributed over the threads, so every thread owns the
+ * outputs of its sample and no reduction between threads is needed.
+ */
+
+void biot_savart_all_batched(Array& points, Array& gammas, Array& dgamma_by_dphis, vector<double>& currents, Array& B, Array& dB_by_dX, Array& d2B_by_dXdX, Array& dB_by_dcoilcurrents, Array& d2B_by_dXdcoilcurrents) {
+    int num_points      = points.shape(0);
+    int num_samples     = gammas.shape(0);
+    int num_coils       = gammas.shape(1);
+    int num_quad_points = gammas.shape(2);
+    auto pointsx = vector_type(num_points, 0);
+    auto pointsy = vector_type(num_points, 0);
+    auto pointsz = vector_type(num_points, 0);
+    for (int i = 0; i < num_points; ++i) {
+        pointsx[i] = points(i, 0);
+        pointsy[i] = points(i, 1);
+        pointsz[i] = points(i, 2);
+    }
+
+    #pragma omp parallel for schedule(dynamic)
+    for(int s=0; s<num_samples; s++) {
+        xt::xarray<double> B_coil           = xt::zeros<double>({num_points, 3});
+        xt::xarray<double> dB_by_dX_coil    = xt::zeros<double>({num_points, 3, 3});
+        xt::xarray<double> d2B_by_dXdX_coil = xt::zeros<double>({num_points, 3, 3, 3});
+        for(int i=0; i<num_coils; i++) {
+            xt::xarray<double> gamma          = xt::view(gammas, s, i, xt::all(), xt::all());
+            xt::xarray<double> dgamma_by_dphi = xt::view(dgamma_by_dphis, s, i, xt::all(), xt::all());
+            B_coil.fill(0.);
+            dB_by_dX_coil.fill(0.);
+            d2B_by_dXdX_coil.fill(0.);
+            biot_savart_all_simd<xt::xarray<double>>(pointsx, pointsy, pointsz, gamma, dgamma_by_dphi, B_coil, dB_by_dX_coil, d2B_by_dXdX_coil);
+
+            double fak1 = (currents[i] * 1e-7/num_quad_points);
+            double fak2 = (1e-7/num_quad_points);
+            for (int j1 = 0; j1 < num_points; ++j1) {
+                for (int j2 = 0; j2 < 3; ++j2) {
+                    B(s, j1, j2) += fak1 * B_coil(j1, j2);
+                    dB_by_dcoilcurrents(s, i, j1, j2) += fak2 * B_coil(j1, j2);
+                    for (int j3 = 0; j3 < 3; ++j3) {
+                        dB_by_dX(s, j1, j2, j3) += fak1 * dB_by_dX_coil(j1, j2, j3);
+                        d2B_by_dXdcoilcurrents(s, i, j1, j2, j3) += fak2 * dB_by_dX_coil(j1, j2, j3);
+                        for (int j4 = 0; j4 < 3; ++j4) {
+                            d2B_by_dXdX(s, j1, j2, j3, j4) += fak1 * d2B_by_dXdX_coil(j1, j2, j3, j4);
+                        }
+                    }
+                }
+            }
+        }
+    }
+}
+
+void biot_savart_vjp_batched(Array& points, Array& gammas, Array& dgamma_by_dphis, vector<double>& currents, Array& v, Array& vgrad, Array& res_gamma, Array& res_dgamma_by_dphi) {
+    int num_points      = points.shape(0);
+    int num_samples     = gammas.shape(0);
+    int num_coils       = gammas.shape(1);
+    int num_quad_points = gammas.shape(2);
+    bool compute_dB = vgrad.shape(0) > 0;
+    auto pointsx = vector_type(num_points, 0);
+    auto pointsy = vector_type(num_points, 0);
+    auto pointsz = vector_type(num_points, 0);
+    for (int i = 0; i < num_points; ++i) {
+        pointsx[i] = points(i, 0);
+        pointsy[i] = points(i, 1);
+        pointsz[i] = points(i, 2);
+    }
+
+    #pragma omp parallel for schedule(dynamic)
+    for(int s=0; s<num_samples; s++) {
+        auto vx = vector_type(num_points, 0);
+        auto vy = vector_type(num_points, 0);
+        auto vz = vector_type(num_points, 0);
+        auto vgrads = vector<vector_type>(9, vector_type(compute_dB ? num_points : 0, 0));
+        for (int j = 0; j < num_points; ++j) {
+            vx[j] = v(s, j, 0);
+            vy[j] = v(s, j, 1);
+            vz[j] = v(s, j, 2);
+            if(compute_dB) {
+                for (int k1 = 0; k1 < 3; ++k1) {
+                    for (int k2 = 0; k2 < 3; ++k2) {
+                        vgrads[3*k1 + k2][j] = vgrad(s, j, k1, k2);
+                    }
+                }
+            }
+        }
+        xt::xarray<double> res_gamma_coil          = xt::zeros<double>({num_quad_points, 3});
+        xt::xarray<double> res_dgamma_by_dphi_coil = xt::zeros<double>({num_quad_points, 3});
+        for(int i=0; i<num_coils; i++) {
+            xt::xarray<double> gamma          = xt::view(gammas, s, i, xt::all(), xt::all());
+            xt::xarray<double> dgamma_by_dphi = xt::view(dgamma_by_dphis, s, i, xt::all(), xt::all());
+            res_gamma_coil.fill(0.);
+            res_dgamma_by_dphi_coil.fill(0.);
+            biot_savart_vjp_simd<xt::xarray<double>>(pointsx, pointsy, pointsz, gamma, dgamma_by_dphi, vx, vy, vz, vgrads, res_gamma_coil, res_dgamma_by_dphi_coil, compute_dB);
+
+            double fak = (currents[i] * 1e-7/num_quad_points);
+            for (int j1 = 0; j1 < num_quad_points; ++j1) {
+                for (int j2 = 0; j2 < 3; ++j2) {
+                    res_gamma(s, i, j1, j2)          += fak * res_gamma_coil(j1, j2);
+                    res_dgamma_by_dphi(s, i, j1, j2) += fak * res_dgamma_by_dphi_coil(j1, j2);
+                }
+            }
+        }
+    }
+}
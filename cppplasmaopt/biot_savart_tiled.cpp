@@ -0,0 +1,158 @@
+#include "biot_savart.h"
+#include <algorithm>
+#ifdef _OPENMP
+#include <omp.h>
+#endif
+
+/*
+ * Variants of biot_savart_all and biot_savart_by_dcoilcoeff_all that
+ * distribute (coil, block of target points) pairs over the threads instead of
+ * only the coils. With few coils per rank the coil loop alone leaves most
+ * threads idle; tiling the target points as well gives
+ * num_coils * ceil(num_points/chunk_size) independent tasks. Every task
+ * writes to its own slice of the outputs, so no locking is needed, and the
+ * sum over coils is done in parallel over the target points afterwards.
+ *
+ * num_threads <= 0 uses the OpenMP default, chunk_size <= 0 picks a block
+ * size that gives roughly four tasks per thread. The block size is rounded up
+ * to a multiple of the SIMD width.
+ */
+
+int tiled_num_threads(int num_threads) {
+#ifdef _OPENMP
+    return num_threads > 0 ? num_threads : omp_get_max_threads();
+#else
+    return 1;
+#endif
+}
+
+int tiled_chunk_size(int chunk_size, int num_points, int num_coils, int num_threads) {
+    constexpr int simd_size = xsimd::simd_type<double>::size;
+    if(chunk_size <= 0) {
+        int num_blocks = std::max(1, (4*num_threads + num_coils - 1)/num_coils);
+        chunk_size = (num_points + num_blocks - 1)/num_blocks;
+    }
+    chunk_size = ((chunk_size + simd_size - 1)/simd_size)*simd_size;
+    return std::max(chunk_size, simd_size);
+}
+
+void biot_savart_all_tiled(Array& points, vector<Array>& gammas, vector<Array>& dgamma_by_dphis, vector<double>& currents, Array& B, Array& dB_by_dX, Array& d2B_by_dXdX, vector<Array>& dB_by_coilcurrents, vector<Array>& d2B_by_dXdcoilcurrents, int num_threads, int chunk_size) {
+    int num_points = points.shape(0);
+    int num_coils  = gammas.size();
+    num_threads    = tiled_num_threads(num_threads);
+    chunk_size     = tiled_chunk_size(chunk_size, num_points, num_coils, num_threads);
+    int num_blocks = (num_points + chunk_size - 1)/chunk_size;
+
+    auto pointsx = vector_type(num_points, 0);
+    auto pointsy = vector_type(num_points, 0);
+    auto pointsz = vector_type(num_points, 0);
+    for (int i = 0; i < num_points; ++i) {
+        pointsx[i] = points(i, 0);
+        pointsy[i] = points(i, 1);
+        pointsz[i] = points(i, 2);
+    }
+
+    auto gammas_          = vector<xt::xarray<double>>();
+    auto dgamma_by_dphis_ = vector<xt::xarray<double>>();
+    auto Bs           = vector<xt::xarray<double>>();
+    auto dB_by_dXs    = vector<xt::xarray<double>>();
+    auto d2B_by_dXdXs = vector<xt::xarray<double>>();
+    for(int i=0; i<num_coils; i++) {
+        gammas_.push_back(xt::xarray<double>(gammas[i]));
+        dgamma_by_dphis_.push_back(xt::xarray<double>(dgamma_by_dphis[i]));
+        Bs.push_back(xt::zeros<double>({num_points, 3}));
+        dB_by_dXs.push_back(xt::zeros<double>({num_points, 3, 3}));
+        d2B_by_dXdXs.push_back(xt::zeros<double>({num_points, 3, 3, 3}));
+    }
+
+    #pragma omp parallel for schedule(dynamic) num_threads(num_threads)
+    for(int t=0; t<num_coils*num_blocks; t++) {
+        int i     = t / num_blocks;
+        int start = (t % num_blocks) * chunk_size;
+        int end   = std::min(start + chunk_size, num_points);
+        int n     = end - start;
+        auto px = vector_type(pointsx.begin() + start, pointsx.begin() + end);
+        auto py = vector_type(pointsy.begin() + start, pointsy.begin() + end);
+        auto pz = vector_type(pointsz.begin() + start, pointsz.begin() + end);
+        xt::xarray<double> B_block           = xt::zeros<double>({n, 3});
+        xt::xarray<double> dB_by_dX_block    = xt::zeros<double>({n, 3, 3});
+        xt::xarray<double> d2B_by_dXdX_block = xt::zeros<double>({n, 3, 3, 3});
+        biot_savart_all_simd<xt::xarray<double>>(px, py, pz, gammas_[i], dgamma_by_dphis_[i], B_block, dB_by_dX_block, d2B_by_dXdX_block);
+        std::copy(B_block.begin(), B_block.end(), &Bs[i](start, 0));
+        std::copy(dB_by_dX_block.begin(), dB_by_dX_block.end(), &dB_by_dXs[i](start, 0, 0));
+        std::copy(d2B_by_dXdX_block.begin(), d2B_by_dXdX_block.end(), &d2B_by_dXdXs[i](start, 0, 0, 0));
+    }
+
+    #pragma omp parallel for num_threads(num_threads)
+    for (int j1 = 0; j1 < num_points; ++j1) {
+        for(int i=0; i<num_coils; i++) {
+            double fak1 = (currents[i] * 1e-7/gammas[i].shape(0));
+            double fak2 = (1e-7/gammas[i].shape(0));
+            for (int j2 = 0; j2 < 3; ++j2) {
+                B(j1, j2) += fak1 * Bs[i](j1, j2);
+                dB_by_coilcurrents[i](j1, j2) += fak2 * Bs[i](j1, j2);
+                for (int j3 = 0; j3 < 3; ++j3) {
+                    dB_by_dX(j1, j2, j3) += fak1 * dB_by_dXs[i](j1, j2, j3);
+                    d2B_by_dXdcoilcurrents[i](j1, j2, j3) += fak2 * dB_by_dXs[i](j1, j2, j3);
+                    for (int j4 = 0; j4 < 3; ++j4) {
+                        d2B_by_dXdX(j1, j2, j3, j4) += fak1 * d2B_by_dXdXs[i](j1, j2, j3, j4);
+                    }
+                }
+            }
+        }
+    }
+}
+
+void biot_savart_by_dcoilcoeff_all_tiled(Array& points, vector<Array>& gammas, vector<Array>& dgamma_by_dphis, vector<Array>& dgamma_by_dcoeffs, vector<Array>& d2gamma_by_dphidcoeffs, vector<double>& currents, vector<Array>& dB_by_dcoilcoeffs, vector<Array>& d2B_by_dXdcoilcoeff, int num_threads, int chunk_size) {
+    int num_points = points.shape(0);
+    int num_coils  = gammas.size();
+    num_threads    = tiled_num_threads(num_threads);
+    chunk_size     = tiled_chunk_size(chunk_size, num_points, num_coils, num_threads);
+    int num_blocks = (num_points + chunk_size - 1)/chunk_size;
+
+    auto pointsx = vector_type(num_points, 0);
+    auto pointsy = vector_type(num_points, 0);
+    auto pointsz = vector_type(num_points, 0);
+    for (int i = 0; i < num_points; ++i) {
+        pointsx[i] = points(i, 0);
+        pointsy[i] = points(i, 1);
+        pointsz[i] = points(i, 2);
+    }
+
+    auto gammas_                 = vector<xt::xarray<double>>();
+    auto dgamma_by_dphis_        = vector<xt::xarray<double>>();
+    auto dgamma_by_dcoeffs_      = vector<xt::xarray<double>>();
+    auto d2gamma_by_dphidcoeffs_ = vector<xt::xarray<double>>();
+    for(int i=0; i<num_coils; i++) {
+        gammas_.push_back(xt::xarray<double>(gammas[i]));
+        dgamma_by_dphis_.push_back(xt::xarray<double>(dgamma_by_dphis[i]));
+        dgamma_by_dcoeffs_.push_back(xt::xarray<double>(dgamma_by_dcoeffs[i]));
+        d2gamma_by_dphidcoeffs_.push_back(xt::xarray<double>(d2gamma_by_dphidcoeffs[i]));
+    }
+
+    #pragma omp parallel for schedule(dynamic) num_threads(num_threads)
+    for(int t=0; t<num_coils*num_blocks; t++) {
+        int i     = t / num_blocks;
+        int start = (t % num_blocks) * chunk_size;
+        int end   = std::min(start + chunk_size, num_points);
+        int n     = end - start;
+        int num_coil_coeffs = dgamma_by_dcoeffs_[i].shape(1);
+        auto px = vector_type(pointsx.begin() + start, pointsx.begin() + end);
+        auto py = vector_type(pointsy.begin() + start, pointsy.begin() + end);
+        auto pz = vector_type(pointsz.begin() + start, pointsz.begin() + end);
+        xt::xarray<double> dB_block    = xt::zeros<double>({n, num_coil_coeffs, 3});
+        xt::xarray<double> d2B_block   = xt::zeros<double>({n, num_coil_coeffs, 3, 3});
+        biot_savart_by_dcoilcoeff_all_simd<xt::xarray<double>>(px, py, pz, gammas_[i], dgamma_by_dphis_[i], dgamma_by_dcoeffs_[i], d2gamma_by_dphidcoeffs_[i], dB_block, d2B_block);
+        double fak = (currents[i] * 1e-7/gammas[i].shape(0));
+        for (int j1 = 0; j1 < n; ++j1) {
+            for (int k = 0; k < num_coil_coeffs; ++k) {
+                for (int j2 = 0; j2 < 3; ++j2) {
+                    dB_by_dcoilcoeffs[i](start + j1, k, j2) += fak * dB_block(j1, k, j2);
+                    for (int j3 = 0; j3 < 3; ++j3) {
+                        d2B_by_dXdcoilcoeff[i](start + j1, k, j2, j3) += fak * d2B_block(j1, k, j2, j3);
+                    }
+                }
+            }
+        }
+    }
+}
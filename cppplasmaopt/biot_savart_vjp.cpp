@@ -0,0 +1,137 @@
+#include "biot_savart.h"
+
+/*
+ * Computes the vector-Jacobian product of the Biot-Savart field with respect
+ * to the coil quadrature points and tangents, i.e. for
+ *     J = \sum_i v_i . B(x_i) + \sum_i vgrad_i : dB_by_dX(x_i)
+ * we accumulate dJ/dgamma_j and dJ/d(dgamma_by_dphi)_j for every quadrature
+ * point j of the coil. The contraction with dgamma_by_dcoeff is left to the
+ * caller, so that the cost does not depend on the number of coil coefficients.
+ */
+template<class T>
+void biot_savart_vjp_simd(vector_type& pointsx, vector_type& pointsy, vector_type& pointsz, T& gamma, T& dgamma_by_dphi, vector_type& vx, vector_type& vy, vector_type& vz, vector<vector_type>& vgrad, T& res_gamma, T& res_dgamma_by_dphi, bool compute_dB) {
+    int num_points         = pointsx.size();
+    int num_quad_points    = gamma.shape(0);
+    constexpr int simd_size = xsimd::simd_type<double>::size;
+    for (int j = 0; j < num_quad_points; ++j) {
+        auto gamma_j          = Vec3d(3, &gamma(j, 0));
+        auto dgamma_by_dphi_j = Vec3d(3, &dgamma_by_dphi(j, 0));
+        auto res_gamma_j          = Vec3dSimd();
+        auto res_dgamma_by_dphi_j = Vec3dSimd();
+        for(int i = 0; i < num_points-num_points%simd_size; i += simd_size) {
+            auto point_i = Vec3dSimd(&(pointsx[i]), &(pointsy[i]), &(pointsz[i]));
+            auto v_i     = Vec3dSimd(&(vx[i]), &(vy[i]), &(vz[i]));
+
+            auto diff = point_i - gamma_j;
+            auto norm_diff_2     = normsq(diff);
+            auto norm_diff       = sqrt(norm_diff_2);
+            auto norm_diff_3_inv = 1./(norm_diff_2 * norm_diff);
+            auto norm_diff_5_inv = norm_diff_3_inv/norm_diff_2;
+
+            auto diff_cross_v = cross(diff, v_i);
+            res_dgamma_by_dphi_j += diff_cross_v * norm_diff_3_inv;
+            auto v_cross_dgamma_by_dphi_j = cross(v_i, dgamma_by_dphi_j);
+            auto diff_inner_v_cross_dgamma = inner(diff, v_cross_dgamma_by_dphi_j);
+            res_gamma_j += diff * (3. * diff_inner_v_cross_dgamma * norm_diff_5_inv) - v_cross_dgamma_by_dphi_j * norm_diff_3_inv;
+
+            if(compute_dB) {
+                auto V0 = Vec3dSimd(&(vgrad[0][i]), &(vgrad[1][i]), &(vgrad[2][i]));
+                auto V1 = Vec3dSimd(&(vgrad[3][i]), &(vgrad[4][i]), &(vgrad[5][i]));
+                auto V2 = Vec3dSimd(&(vgrad[6][i]), &(vgrad[7][i]), &(vgrad[8][i]));
+                auto norm_diff_7_inv = norm_diff_5_inv/norm_diff_2;
+
+                auto u = V0 * diff.x + V1 * diff.y + V2 * diff.z;
+                auto c = Vec3dSimd(V1.z - V2.y, V2.x - V0.z, V0.y - V1.x);
+                auto trace_W = inner(c, dgamma_by_dphi_j);
+                auto diff_cross_u = cross(diff, u);
+                auto diffT_W_diff = inner(diff_cross_u, dgamma_by_dphi_j);
+                auto dgamma_by_dphi_j_cross_diff = cross(dgamma_by_dphi_j, diff);
+                auto W_diff = Vec3dSimd(inner(V0, dgamma_by_dphi_j_cross_diff), inner(V1, dgamma_by_dphi_j_cross_diff), inner(V2, dgamma_by_dphi_j_cross_diff));
+                auto u_cross_dgamma_by_dphi_j = cross(u, dgamma_by_dphi_j);
+
+                res_dgamma_by_dphi_j += c * norm_diff_3_inv - diff_cross_u * (3. * norm_diff_5_inv);
+                res_gamma_j += diff * (3. * trace_W * norm_diff_5_inv - 15. * diffT_W_diff * norm_diff_7_inv)
+                    + (W_diff + u_cross_dgamma_by_dphi_j) * (3. * norm_diff_5_inv);
+            }
+        }
+        for(int k=0; k<3; k++) {
+            res_gamma(j, k)          += xs::hadd(res_gamma_j[k]);
+            res_dgamma_by_dphi(j, k) += xs::hadd(res_dgamma_by_dphi_j[k]);
+        }
+
+        for (int i = num_points - num_points % simd_size; i < num_points; ++i) {
+            Vec3d point = Vec3d{pointsx[i], pointsy[i], pointsz[i]};
+            Vec3d v     = Vec3d{vx[i], vy[i], vz[i]};
+            Vec3d diff  = point - gamma_j;
+            double norm_diff = norm(diff);
+            double norm_diff_3_inv = 1/(norm_diff*norm_diff*norm_diff);
+            double norm_diff_5_inv = norm_diff_3_inv/(norm_diff*norm_diff);
+
+            Vec3d temp_dgamma = norm_diff_3_inv * cross(diff, v);
+            Vec3d v_cross_dgamma_by_dphi_j = cross(v, dgamma_by_dphi_j);
+            Vec3d temp_gamma = (3 * inner(diff, v_cross_dgamma_by_dphi_j) * norm_diff_5_inv) * diff - norm_diff_3_inv * v_cross_dgamma_by_dphi_j;
+
+            if(compute_dB) {
+                Vec3d V0 = Vec3d{vgrad[0][i], vgrad[1][i], vgrad[2][i]};
+                Vec3d V1 = Vec3d{vgrad[3][i], vgrad[4][i], vgrad[5][i]};
+                Vec3d V2 = Vec3d{vgrad[6][i], vgrad[7][i], vgrad[8][i]};
+                double norm_diff_7_inv = norm_diff_5_inv/(norm_diff*norm_diff);
+
+                Vec3d u = diff[0] * V0 + diff[1] * V1 + diff[2] * V2;
+                Vec3d c = Vec3d{V1[2] - V2[1], V2[0] - V0[2], V0[1] - V1[0]};
+                double trace_W = inner(c, dgamma_by_dphi_j);
+                Vec3d diff_cross_u = cross(diff, u);
+                double diffT_W_diff = inner(diff_cross_u, dgamma_by_dphi_j);
+                Vec3d dgamma_by_dphi_j_cross_diff = cross(dgamma_by_dphi_j, diff);
+                Vec3d W_diff = Vec3d{inner(V0, dgamma_by_dphi_j_cross_diff), inner(V1, dgamma_by_dphi_j_cross_diff), inner(V2, dgamma_by_dphi_j_cross_diff)};
+
+                temp_dgamma += norm_diff_3_inv * c - 3 * norm_diff_5_inv * diff_cross_u;
+                temp_gamma  += (3 * trace_W * norm_diff_5_inv - 15 * diffT_W_diff * norm_diff_7_inv) * diff
+                    + 3 * norm_diff_5_inv * (W_diff + cross(u, dgamma_by_dphi_j));
+            }
+            for(int k=0; k<3; k++) {
+                res_gamma(j, k)          += temp_gamma[k];
+                res_dgamma_by_dphi(j, k) += temp_dgamma[k];
+            }
+        }
+    }
+}
+template void biot_savart_vjp_simd<xt::xarray<double>>(vector_type&, vector_type&, vector_type&, xt::xarray<double>&, xt::xarray<double>&, vector_type&, vector_type&, vector_type&, vector<vector_type>&, xt::xarray<double>&, xt::xarray<double>&, bool);
+
+
+void biot_savart_vjp(Array& points, vector<Array>& gammas, vector<Array>& dgamma_by_dphis, vector<double>& currents, Array& v, Array& vgrad, vector<Array>& res_gamma, vector<Array>& res_dgamma_by_dphi) {
+    int num_points = points.shape(0);
+    bool compute_dB = vgrad.shape(0) > 0;
+    auto pointsx = vector_type(num_points, 0);
+    auto pointsy = vector_type(num_points, 0);
+    auto pointsz = vector_type(num_points, 0);
+    auto vx = vector_type(num_points, 0);
+    auto vy = vector_type(num_points, 0);
+    auto vz = vector_type(num_points, 0);
+    auto vgrads = vector<vector_type>(9, vector_type(compute_dB ? num_points : 0, 0));
+    for (int i = 0; i < num_points; ++i) {
+        pointsx[i] = points(i, 0);
+        pointsy[i] = points(i, 1);
+        pointsz[i] = points(i, 2);
+        vx[i] = v(i, 0);
+        vy[i] = v(i, 1);
+        vz[i] = v(i, 2);
+        if(compute_dB) {
+            for (int k1 = 0; k1 < 3; ++k1) {
+                for (int k2 = 0; k2 < 3; ++k2) {
+                    vgrads[3*k1 + k2][i] = vgrad(i, k1, k2);
+                }
+            }
+        }
+    }
+
+    int num_coils  = gammas.size();
+
+    #pragma omp parallel for
+    for(int i=0; i<num_coils; i++) {
+        biot_savart_vjp_simd<Array>(pointsx, pointsy, pointsz, gammas[i], dgamma_by_dphis[i], vx, vy, vz, vgrads, res_gamma[i], res_dgamma_by_dphi[i], compute_dB);
+        double fak = (currents[i] * 1e-7/gammas[i].shape(0));
+        res_gamma[i] *= fak;
+        res_dgamma_by_dphi[i] *= fak;
+    }
+}
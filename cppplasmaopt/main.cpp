@@ -23,6 +23,11 @@ PYBIND11_MODULE(cppplasmaopt, m) {
     m.def("biot_savart_all",               & biot_savart_all);
     m.def("biot_savart_B_only",            & biot_savart_B_only);
     m.def("biot_savart_by_dcoilcoeff_all", & biot_savart_by_dcoilcoeff_all);
+    m.def("biot_savart_vjp",               & biot_savart_vjp);
+    m.def("biot_savart_all_tiled",         & biot_savart_all_tiled);
+    m.def("biot_savart_by_dcoilcoeff_all_tiled", & biot_savart_by_dcoilcoeff_all_tiled);
+    m.def("biot_savart_all_batched",       & biot_savart_all_batched);
+    m.def("biot_savart_vjp_batched",       & biot_savart_vjp_batched);
     
     m.def("biot_savart_B",           &biot_savart_B);
     m.def("biot_savart_dB_by_dX",    &biot_savart_dB_by_dX);
@@ -7,7 +7,7 @@ import os
 obj, args = example2_get_objective()
 
 if args.ninsamples > 0:
-    info("Biggest deviation in first coil %.6fmm", np.max(np.linalg.norm(obj.stochastic_qs_objective.J_BSvsQS_perturbed[0].biotsavart.coils[0].sample[0], axis=1))*1e3)
+    info("Biggest deviation in first coil %.6fmm", np.max(np.linalg.norm(obj.stochastic_qs_objective.samples[obj.stochastic_qs_objective.first][0].sample[0], axis=1))*1e3)
 
 outdir = obj.outdir
 solver = args.optimizer
@@ -44,8 +44,10 @@ else:
     x = obj.x0
 
 if obj.mode == "cvar":
+    if obj.importance_sampling:
+        obj.update_importance_shift(x)
     obj.update(x)
-    x[-1] = obj.cvar.find_optimal_t(obj.QSvsBS_perturbed[-1] ,x[-1])
+    x[-1] = obj.cvar.find_optimal_t(obj.QSvsBS_perturbed[-1] ,x[-1], obj.likelihood_ratios)
 
 obj.update(x)
 obj.callback(x)
@@ -88,7 +90,11 @@ elif solver.lower() in ["bfgs", "lbfgs"]:
             miter = min(250, maxiter-iters)
             res = minimize(J_scipy, x, jac=True, method=method, tol=1e-20, options={"maxiter": miter, "maxcor": memory}, callback=obj.callback)
             obj.cvar.eps *= 0.1
-            x[-1] = obj.cvar.find_optimal_t(obj.QSvsBS_perturbed[-1] ,x[-1])
+            if obj.importance_sampling:
+                # move the samples to the tail of the new iterate
+                obj.update_importance_shift(res.x)
+                obj.update(res.x)
+            x[-1] = obj.cvar.find_optimal_t(obj.QSvsBS_perturbed[-1] ,x[-1], obj.likelihood_ratios)
         else:
             miter = maxiter-iters
             res = minimize(J_scipy, x, jac=True, method=method, tol=1e-20, options={"maxiter": miter, "maxcor": memory}, callback=obj.callback)
@@ -0,0 +1,43 @@
+import numpy as np
+from pyplasmaopt import get_ncsx_data, CoilCollection, BiotSavart
+
+coils, ma, currents = get_ncsx_data(Nt=25, ppp=10)
+stellerator = CoilCollection(coils, currents, 3, True)
+direct = BiotSavart(stellerator.coils, stellerator.currents)
+
+def plasma_points(n):
+    # the region of the field lines of `compute_field_lines` and Poincare plots
+    r = 1.5 + 0.2 * np.random.rand(n)
+    phi = 2 * np.pi * np.random.rand(n)
+    z = 0.2 * (np.random.rand(n)-0.5)
+    return np.stack([r*np.cos(phi), r*np.sin(phi), z], axis=1)
+
+def sphere_points(radius):
+    def points(n):
+        x = np.random.standard_normal(size=(n, 3))
+        return radius * x/np.linalg.norm(x, axis=1)[:, None]
+    return points
+
+import time
+for tol in [1e-3, 1e-6]:
+    treecode = BiotSavart(stellerator.coils, stellerator.currents, backend="treecode", tol=tol)
+    start = time.time()
+    treecode.treecode
+    end = time.time()
+    print('tol=%.0e: time to build the tree %.1fms' % (tol, (end-start)*1000))
+    for region, get_points in [("plasma", plasma_points), ("|x|=5", sphere_points(5.)), ("|x|=10", sphere_points(10.)), ("|x|=20", sphere_points(20.))]:
+        for n in [1000, 10000, 100000]:
+            np.random.seed(1)
+            points = get_points(n)
+
+            start = time.time()
+            B = direct.evaluate(points)
+            end = time.time()
+            time_direct = (end-start)*1000
+
+            start = time.time()
+            Btree = treecode.evaluate(points)
+            end = time.time()
+            time_treecode = (end-start)*1000
+            err = np.max(np.linalg.norm(B-Btree, axis=1)/np.linalg.norm(B, axis=1))
+            print('tol=%.0e, %6s, n=%6i: direct %8.1fms, treecode %8.1fms, rel. err %.2e' % (tol, region, n, time_direct, time_treecode, err))
@@ -1,11 +1,15 @@
+from .operator_cache import *
 from .curve import *
 from .biotsavart import *
+from .treecode import *
 from .objective import *
 from .coils import *
 from .helpers import *
 from .quasi_symmetric_field import *
 from .poincareplot import *
 from .cvar import *
+from .control_variate import *
+from .sample_size import *
 from .stochastic_objective import *
 from .stochastic_gradient import *
 from .logging import *
@@ -2,15 +2,40 @@ import numpy as np
 from math import pi
 import cppplasmaopt as cpp
 from property_manager3 import cached_property, PropertyManager
+from .treecode import BiotSavartTreecode, levi_civita
 writable_cached_property = cached_property(writable=True)
 
 
 class BiotSavart(PropertyManager):
 
-    def __init__(self, coils, coil_currents):
+    def __init__(self, coils, coil_currents, backend="direct", tol=1e-6, num_threads=None, chunk_size=None, symmetries=None):
+        """
+        `backend` selects how `evaluate` computes the field: "direct" sums
+        over all quadrature points, "treecode" uses a `BiotSavartTreecode`
+        with relative tolerance `tol`, which only pays off for targets far
+        outside the coil set, see there.
+
+        `num_threads` and `chunk_size` are the defaults for `compute` and
+        `compute_by_dcoilcoeff`, see there.
+
+        If `symmetries` is given (e.g. `CoilCollection.symmetries`), `coils`
+        and `coil_currents` are only the base coils and the field of all their
+        rotated/reflected copies is included by evaluating the base coils at
+        the mapped target points, see `symmetric_points`. The per coil
+        derivatives (`dB_by_dcoilcurrents`, `dB_by_dcoilcoeffs`, the vjps, ...)
+        are then returned for the base coils only, already summed over the
+        copies, which is what `CoilCollection.reduce_*` expect.
+        """
         assert len(coils) == len(coil_currents)
+        if backend not in ["direct", "treecode"]:
+            raise ValueError("Unknown backend %s" % backend)
         self.coils = coils
         self.coil_currents = coil_currents
+        self.backend = backend
+        self.tol = tol
+        self.num_threads = num_threads
+        self.chunk_size = chunk_size
+        self.symmetries = symmetries
 
     def set_points(self, points):
         self.points = points
@@ -51,7 +76,101 @@ class BiotSavart(PropertyManager):
         self.compute_by_dcoilcoeff(self.points)
         return self.d2B_by_dXdcoilcoeffs
 
-    def compute(self, points, use_cpp=True):
+    @writable_cached_property
+    def dB_by_dcoilgeometry(self):
+        self.compute_by_dcoilgeometry(self.points)
+        return self.dB_by_dcoilgeometry
+
+    @writable_cached_property
+    def d2B_by_dXdXdcoilgeometry(self):
+        self.compute_d2B_by_dXdXdcoilgeometry(self.points)
+        return self.d2B_by_dXdXdcoilgeometry
+
+    def symmetric_points(self, points):
+        r"""
+        A copy of the coil with gamma @ R and current sign*I produces the field
+            B(x) = sign * B_0(x @ R^T) @ R,
+        where B_0 is the field of the base coil. Returns x @ R^T for all
+        symmetries, stacked along the first axis.
+        """
+        return np.concatenate([points @ rotmat.T for (rotmat, sign) in self.symmetries], axis=0)
+
+    def symmetric_reduce(self, values, num_field_derivs=0):
+        """
+        Sum a quantity evaluated at `symmetric_points` over all symmetries,
+        rotating back the last axis (the field component) and the
+        `num_field_derivs` axes before it (derivatives with respect to x).
+        """
+        rotmats = np.asarray([rotmat for (rotmat, sign) in self.symmetries])
+        signs   = np.asarray([sign for (rotmat, sign) in self.symmetries], dtype=float)
+        values = values.reshape((len(self.symmetries), -1) + values.shape[1:])
+        if num_field_derivs == 0:
+            return np.einsum('s,s...m,smj->...j', signs, values, rotmats)
+        elif num_field_derivs == 1:
+            return np.einsum('s,sna,s...nm,smj->...aj', signs, rotmats, values, rotmats)
+        elif num_field_derivs == 2:
+            return np.einsum('s,sna,smb,s...nml,slj->...abj', signs, rotmats, rotmats, values, rotmats)
+        else:
+            raise ValueError("Only up to two derivatives are supported.")
+
+    @property
+    def treecode(self):
+        """
+        The `BiotSavartTreecode` of the coils. It is stored together with the
+        state of the coils and the currents it was built for, and rebuilt
+        once either has changed.
+        """
+        key = (tuple(coil.state() for coil in self.coils), tuple(self.coil_currents))
+        if getattr(self, "_treecode_key", None) != key:
+            gammas          = [coil.gamma for coil in self.coils]
+            dgamma_by_dphis = [coil.dgamma_by_dphi[:, 0, :] for coil in self.coils]
+            self._treecode = BiotSavartTreecode(gammas, dgamma_by_dphis, list(self.coil_currents), tol=self.tol)
+            self._treecode_key = key
+        return self._treecode
+
+    def evaluate(self, points, compute_dB_by_dX=False, backend=None):
+        """
+        Returns B (and dB_by_dX if `compute_dB_by_dX` is true) at `points`
+        using `backend`, by default the one selected in the constructor.
+        Unlike `compute`, this neither computes the second derivatives nor
+        overwrites the cached quantities.
+        """
+        if self.symmetries is not None:
+            points = self.symmetric_points(points)
+        if (backend or self.backend) == "treecode":
+            B, dB_by_dX = self.treecode.evaluate(points, compute_dB=compute_dB_by_dX)
+        else:
+            gammas          = [coil.gamma for coil in self.coils]
+            dgamma_by_dphis = [coil.dgamma_by_dphi[:, 0, :] for coil in self.coils]
+            B = np.zeros((len(points), 3))
+            if compute_dB_by_dX:
+                dB_by_dX    = np.zeros((len(points), 3, 3))
+                d2B_by_dXdX = np.zeros((len(points), 3, 3, 3))
+                dB_by_dcoilcurrents    = [np.zeros((len(points), 3)) for coil in self.coils]
+                d2B_by_dXdcoilcurrents = [np.zeros((len(points), 3, 3)) for coil in self.coils]
+                cpp.biot_savart_all(points, gammas, dgamma_by_dphis, self.coil_currents, B, dB_by_dX, d2B_by_dXdX, dB_by_dcoilcurrents, d2B_by_dXdcoilcurrents)
+            else:
+                cpp.biot_savart_B_only(points, gammas, dgamma_by_dphis, self.coil_currents, B)
+        if self.symmetries is not None:
+            B = self.symmetric_reduce(B)
+            if compute_dB_by_dX:
+                dB_by_dX = self.symmetric_reduce(dB_by_dX, 1)
+        if compute_dB_by_dX:
+            return B, dB_by_dX
+        return B
+
+    def compute(self, points, use_cpp=True, num_threads=None, chunk_size=None):
+        """
+        By default the C++ kernel parallelises over the coils only. If
+        `num_threads` or `chunk_size` is given (here or in the constructor),
+        the work is instead split into (coil, block of `chunk_size` points)
+        tasks that are distributed over `num_threads` OpenMP threads. A value
+        of 0 means the OpenMP default thread count and an automatic block size.
+        """
+        num_threads = self.num_threads if num_threads is None else num_threads
+        chunk_size  = self.chunk_size if chunk_size is None else chunk_size
+        if self.symmetries is not None:
+            points = self.symmetric_points(points)
         self.B           = np.zeros((len(points), 3))
         self.dB_by_dX    = np.zeros((len(points), 3, 3))
         self.d2B_by_dXdX = np.zeros((len(points), 3, 3, 3))
@@ -62,7 +181,10 @@ class BiotSavart(PropertyManager):
             gammas                 = [coil.gamma for coil in self.coils]
             dgamma_by_dphis        = [coil.dgamma_by_dphi[:, 0, :] for coil in self.coils]
 
-            cpp.biot_savart_all(points, gammas, dgamma_by_dphis, self.coil_currents, self.B, self.dB_by_dX, self.d2B_by_dXdX, self.dB_by_dcoilcurrents, self.d2B_by_dXdcoilcurrents)
+            if num_threads is None and chunk_size is None:
+                cpp.biot_savart_all(points, gammas, dgamma_by_dphis, self.coil_currents, self.B, self.dB_by_dX, self.d2B_by_dXdX, self.dB_by_dcoilcurrents, self.d2B_by_dXdcoilcurrents)
+            else:
+                cpp.biot_savart_all_tiled(points, gammas, dgamma_by_dphis, self.coil_currents, self.B, self.dB_by_dX, self.d2B_by_dXdX, self.dB_by_dcoilcurrents, self.d2B_by_dXdcoilcurrents, num_threads or 0, chunk_size or 0)
         else:
             for l in range(len(self.coils)):
                 coil = self.coils[l]
@@ -119,9 +241,106 @@ class BiotSavart(PropertyManager):
                                 term4 = 0
                             self.d2B_by_dXdX[i, j1, j2, :] += (current/num_coil_quadrature_points) * np.sum(term1 + term2 + term3 + term4, axis=0)
             self.d2B_by_dXdX *= 1e-7
+        if self.symmetries is not None:
+            self.B           = self.symmetric_reduce(self.B)
+            self.dB_by_dX    = self.symmetric_reduce(self.dB_by_dX, 1)
+            self.d2B_by_dXdX = self.symmetric_reduce(self.d2B_by_dXdX, 2)
+            self.dB_by_dcoilcurrents    = [self.symmetric_reduce(dB) for dB in self.dB_by_dcoilcurrents]
+            self.d2B_by_dXdcoilcurrents = [self.symmetric_reduce(dB, 1) for dB in self.d2B_by_dXdcoilcurrents]
         return self
 
-    def compute_by_dcoilcoeff(self, points, use_cpp=True):
+    def B_vjp(self, v, use_cpp=True):
+        r"""
+        Compute the gradient of
+            J = \sum_i v_i \cdot B(x_i)
+        with respect to the coefficients of each coil, without forming
+        `dB_by_dcoilcoeffs`. Returns a list with one array per coil.
+        """
+        return self.B_and_dB_vjp(v, None, use_cpp=use_cpp)
+
+    def dB_by_dX_vjp(self, vgrad, use_cpp=True):
+        r"""
+        Compute the gradient of
+            J = \sum_i vgrad_i : \nabla B(x_i)
+        with respect to the coefficients of each coil, without forming
+        `d2B_by_dXdcoilcoeffs`. Returns a list with one array per coil.
+        """
+        return self.B_and_dB_vjp(np.zeros((len(self.points), 3)), vgrad, use_cpp=use_cpp)
+
+    def B_and_dB_vjp(self, v, vgrad, use_cpp=True):
+        r"""
+        Compute the gradient of
+            J = \sum_i v_i \cdot B(x_i) + vgrad_i : \nabla B(x_i)
+        with respect to the coefficients of each coil. The derivatives with
+        respect to the quadrature points and tangents of the coils are
+        accumulated first and then contracted once via
+        `Curve.dgamma_by_dcoeff_vjp` and `Curve.d2gamma_by_dphidcoeff_vjp`.
+        """
+        dJ_by_dgammas, dJ_by_ddgamma_by_dphis = self.compute_vjp(self.points, v, vgrad, use_cpp=use_cpp)
+        res = []
+        for coil, dJ_by_dgamma, dJ_by_ddgamma_by_dphi in zip(self.coils, dJ_by_dgammas, dJ_by_ddgamma_by_dphis):
+            res.append(coil.dgamma_by_dcoeff_vjp(dJ_by_dgamma) + coil.d2gamma_by_dphidcoeff_vjp(dJ_by_ddgamma_by_dphi))
+        return res
+
+    def compute_vjp(self, points, v, vgrad=None, use_cpp=True):
+        r"""
+        For
+            J = \sum_i v_i \cdot B(x_i) + vgrad_i : \nabla B(x_i)
+        compute dJ/dgamma and dJ/d(dgamma_by_dphi) at the quadrature points of
+        every coil. `vgrad` may be `None`, in which case only the first term
+        is considered.
+        """
+        if self.symmetries is not None:
+            # v . (sign B_0(x R^T) R) = (sign v R^T) . B_0(x R^T), similarly for vgrad
+            points = self.symmetric_points(points)
+            v = np.concatenate([sign * v @ rotmat.T for (rotmat, sign) in self.symmetries], axis=0)
+            if vgrad is not None:
+                vgrad = np.concatenate([sign * np.einsum('na,iaj,mj->inm', rotmat, vgrad, rotmat) for (rotmat, sign) in self.symmetries], axis=0)
+        dJ_by_dgammas          = [np.zeros((coil.gamma.shape[0], 3)) for coil in self.coils]
+        dJ_by_ddgamma_by_dphis = [np.zeros((coil.gamma.shape[0], 3)) for coil in self.coils]
+        if use_cpp:
+            gammas          = [coil.gamma for coil in self.coils]
+            dgamma_by_dphis = [coil.dgamma_by_dphi[:, 0, :] for coil in self.coils]
+            if vgrad is None:
+                vgrad = np.zeros((0, 3, 3))
+            cpp.biot_savart_vjp(points, gammas, dgamma_by_dphis, self.coil_currents, v, vgrad, dJ_by_dgammas, dJ_by_ddgamma_by_dphis)
+        else:
+            for l in range(len(self.coils)):
+                coil = self.coils[l]
+                current = self.coil_currents[l]
+                gamma = coil.gamma
+                dgamma_by_dphi = coil.dgamma_by_dphi[:, 0, :]
+                num_coil_quadrature_points = gamma.shape[0]
+                diff = points[:, None, :] - gamma[None, :, :]
+                norm_diff = np.linalg.norm(diff, axis=2)
+                norm_diff_3_inv = 1./norm_diff**3
+                norm_diff_5_inv = norm_diff_3_inv/norm_diff**2
+                v_cross_dgamma_by_dphi = np.cross(v[:, None, :], dgamma_by_dphi[None, :, :])
+                dJ_by_ddgamma_by_dphis[l] += np.einsum('ijk,ij->jk', np.cross(diff, v[:, None, :]), norm_diff_3_inv)
+                dJ_by_dgammas[l] += np.einsum('ijk,ij->jk', diff, 3 * np.sum(diff * v_cross_dgamma_by_dphi, axis=2) * norm_diff_5_inv) \
+                    - np.einsum('ijk,ij->jk', v_cross_dgamma_by_dphi, norm_diff_3_inv)
+                if vgrad is not None:
+                    norm_diff_7_inv = norm_diff_5_inv/norm_diff**2
+                    u = np.einsum('ijk,ikl->ijl', diff, vgrad)
+                    c = np.stack((vgrad[:, 1, 2] - vgrad[:, 2, 1], vgrad[:, 2, 0] - vgrad[:, 0, 2], vgrad[:, 0, 1] - vgrad[:, 1, 0]), axis=1)
+                    trace_W = c @ dgamma_by_dphi.T
+                    diff_cross_u = np.cross(diff, u)
+                    diffT_W_diff = np.sum(diff_cross_u * dgamma_by_dphi[None, :, :], axis=2)
+                    W_diff = np.einsum('ikl,ijl->ijk', vgrad, np.cross(dgamma_by_dphi[None, :, :], diff))
+                    u_cross_dgamma_by_dphi = np.cross(u, dgamma_by_dphi[None, :, :])
+                    dJ_by_ddgamma_by_dphis[l] += np.einsum('ik,ij->jk', c, norm_diff_3_inv) \
+                        - 3 * np.einsum('ijk,ij->jk', diff_cross_u, norm_diff_5_inv)
+                    dJ_by_dgammas[l] += np.einsum('ijk,ij->jk', diff, 3 * trace_W * norm_diff_5_inv - 15 * diffT_W_diff * norm_diff_7_inv) \
+                        + 3 * np.einsum('ijk,ij->jk', W_diff + u_cross_dgamma_by_dphi, norm_diff_5_inv)
+                dJ_by_dgammas[l] *= current * 1e-7/num_coil_quadrature_points
+                dJ_by_ddgamma_by_dphis[l] *= current * 1e-7/num_coil_quadrature_points
+        return dJ_by_dgammas, dJ_by_ddgamma_by_dphis
+
+    def compute_by_dcoilcoeff(self, points, use_cpp=True, num_threads=None, chunk_size=None):
+        num_threads = self.num_threads if num_threads is None else num_threads
+        chunk_size  = self.chunk_size if chunk_size is None else chunk_size
+        if self.symmetries is not None:
+            points = self.symmetric_points(points)
         self.dB_by_dcoilcoeffs    = [np.zeros((len(points), coil.dgamma_by_dcoeff.shape[1], 3)) for coil in self.coils]
         self.d2B_by_dXdcoilcoeffs = [np.zeros((len(points), coil.dgamma_by_dcoeff.shape[1], 3, 3)) for coil in self.coils]
         if use_cpp:
@@ -131,7 +350,10 @@ class BiotSavart(PropertyManager):
             d2gamma_by_dphidcoeffs = [coil.d2gamma_by_dphidcoeff[:, 0, :, :] for coil in self.coils]
 
 
-            cpp.biot_savart_by_dcoilcoeff_all(points, gammas, dgamma_by_dphis, dgamma_by_dcoeffs, d2gamma_by_dphidcoeffs, self.coil_currents, self.dB_by_dcoilcoeffs, self.d2B_by_dXdcoilcoeffs)
+            if num_threads is None and chunk_size is None:
+                cpp.biot_savart_by_dcoilcoeff_all(points, gammas, dgamma_by_dphis, dgamma_by_dcoeffs, d2gamma_by_dphidcoeffs, self.coil_currents, self.dB_by_dcoilcoeffs, self.d2B_by_dXdcoilcoeffs)
+            else:
+                cpp.biot_savart_by_dcoilcoeff_all_tiled(points, gammas, dgamma_by_dphis, dgamma_by_dcoeffs, d2gamma_by_dphidcoeffs, self.coil_currents, self.dB_by_dcoilcoeffs, self.d2B_by_dXdcoilcoeffs, num_threads or 0, chunk_size or 0)
         else:
             for l in range(len(self.coils)):
                 coil = self.coils[l]
@@ -181,4 +403,293 @@ class BiotSavart(PropertyManager):
                             self.d2B_by_dXdcoilcoeffs[l][i, j, k, :] = current * np.sum(term1 + term2 + term3 + term4 + term5 + term6, axis=0)
                 mu = 4 * pi * 1e-7
                 self.d2B_by_dXdcoilcoeffs[l] *= mu/(4*pi*num_coil_quadrature_points)
+        if self.symmetries is not None:
+            self.dB_by_dcoilcoeffs    = [self.symmetric_reduce(dB) for dB in self.dB_by_dcoilcoeffs]
+            self.d2B_by_dXdcoilcoeffs = [self.symmetric_reduce(dB, 1) for dB in self.d2B_by_dXdcoilcoeffs]
+        return self
+
+    def compute_by_dcoilgeometry(self, points):
+        r"""
+        Sensitivity of the field of every coil, per unit current, to its
+        quadrature points \gamma_j and tangents \gamma'_j. For each coil an
+        array of shape (npoints, 12, nquadpoints, 6) is stored, whose rows
+        are B and the flattened dB_by_dX at `points` and whose columns are
+        \gamma_j and \gamma'_j. As the contribution of quadrature point j only
+        depends on x-\gamma_j, its derivatives with respect to \gamma_j are
+        the negative of its derivatives with respect to x.
+        """
+        if self.symmetries is not None:
+            raise NotImplementedError("The coil geometry sensitivities are not implemented for symmetric coil sets.")
+        eps = levi_civita
+        eye = np.eye(3)
+        npoints = len(points)
+        self.dB_by_dcoilgeometry = []
+        for coil in self.coils:
+            gamma = coil.gamma
+            dgamma_by_dphi = coil.dgamma_by_dphi[:, 0, :]
+            num_coil_quadrature_points = gamma.shape[0]
+            diff = points[:, None, :] - gamma[None, :, :]
+            norm_diff = np.linalg.norm(diff, axis=2)
+            norm_diff_3_inv = 1./norm_diff**3
+            norm_diff_5_inv = norm_diff_3_inv/norm_diff**2
+            norm_diff_7_inv = norm_diff_5_inv/norm_diff**2
+            dgamma_by_dphi_cross_e    = np.einsum('mpa,jp->jam', eps, dgamma_by_dphi)
+            dgamma_by_dphi_cross_diff = np.cross(dgamma_by_dphi[None, :, :], diff)
+            e_cross_diff              = np.einsum('mnq,ijq->ijnm', eps, diff)
+            # x derivatives of the contribution of every quadrature point
+            dB_by_dX = dgamma_by_dphi_cross_e[None, :, :, :] * norm_diff_3_inv[:, :, None, None] \
+                - 3 * np.einsum('ija,ijm,ij->ijam', diff, dgamma_by_dphi_cross_diff, norm_diff_5_inv)
+            d2B_by_dXdX = -3 * (np.einsum('ijb,jam->ijabm', diff, dgamma_by_dphi_cross_e)
+                                + np.einsum('ija,jbm->ijabm', diff, dgamma_by_dphi_cross_e)
+                                + np.einsum('ab,ijm->ijabm', eye, dgamma_by_dphi_cross_diff)) * norm_diff_5_inv[:, :, None, None, None] \
+                + 15 * np.einsum('ija,ijb,ijm,ij->ijabm', diff, diff, dgamma_by_dphi_cross_diff, norm_diff_7_inv)
+            # B and dB_by_dX are linear in the tangents
+            dB_by_ddgamma_by_dphi = e_cross_diff * norm_diff_3_inv[:, :, None, None]
+            d2B_by_dXddgamma_by_dphi = np.einsum('mna,ij->ijamn', eps, norm_diff_3_inv) \
+                - 3 * np.einsum('ija,ijnm,ij->ijamn', diff, e_cross_diff, norm_diff_5_inv)
+
+            sensitivity = np.zeros((npoints, 12, num_coil_quadrature_points, 6))
+            sensitivity[:, :3, :, :3] = -dB_by_dX.transpose((0, 3, 1, 2))
+            sensitivity[:, 3:, :, :3] = -d2B_by_dXdX.transpose((0, 2, 4, 1, 3)).reshape((npoints, 9, num_coil_quadrature_points, 3))
+            sensitivity[:, :3, :, 3:] = dB_by_ddgamma_by_dphi.transpose((0, 3, 1, 2))
+            sensitivity[:, 3:, :, 3:] = d2B_by_dXddgamma_by_dphi.reshape((npoints, num_coil_quadrature_points, 9, 3)).transpose((0, 2, 1, 3))
+            self.dB_by_dcoilgeometry.append(sensitivity * (1e-7/num_coil_quadrature_points))
+        return self
+
+    def compute_d2B_by_dXdXdcoilgeometry(self, points):
+        r"""
+        Same as `compute_by_dcoilgeometry` for d2B_by_dXdX: for each coil an
+        array of shape (npoints, 27, nquadpoints, 6) is stored, whose rows are
+        the flattened d2B_by_dXdX at `points`. With g(r) = r/|r|^3 the
+        contribution of quadrature point j is \gamma'_j \times \nabla^2 g(x-\gamma_j),
+        so this needs the third derivatives of g.
+        """
+        if self.symmetries is not None:
+            raise NotImplementedError("The coil geometry sensitivities are not implemented for symmetric coil sets.")
+        eps = levi_civita
+        eye = np.eye(3)
+        npoints = len(points)
+        self.d2B_by_dXdXdcoilgeometry = []
+        for coil in self.coils:
+            gamma = coil.gamma
+            dgamma_by_dphi = coil.dgamma_by_dphi[:, 0, :]
+            num_coil_quadrature_points = gamma.shape[0]
+            diff = points[:, None, :] - gamma[None, :, :]
+            norm_diff = np.linalg.norm(diff, axis=2)
+            norm_diff_5_inv = 1./norm_diff**5
+            norm_diff_7_inv = norm_diff_5_inv/norm_diff**2
+            norm_diff_9_inv = norm_diff_7_inv/norm_diff**2
+            # second and third derivatives of g
+            ee = np.einsum('la,ijb->ijlab', eye, diff) + np.einsum('lb,ija->ijlab', eye, diff) + np.einsum('ab,ijl->ijlab', eye, diff)
+            d2g = -3 * ee * norm_diff_5_inv[:, :, None, None, None] \
+                + 15 * np.einsum('ijl,ija,ijb,ij->ijlab', diff, diff, diff, norm_diff_7_inv)
+            eee = np.einsum('la,bc->labc', eye, eye) + np.einsum('lb,ac->labc', eye, eye) + np.einsum('lc,ab->labc', eye, eye)
+            eedd = np.einsum('ijlab,ijc->ijlabc', ee, diff)
+            eedd = eedd + np.einsum('lc,ija,ijb->ijlabc', eye, diff, diff) + np.einsum('ac,ijl,ijb->ijlabc', eye, diff, diff) \
+                + np.einsum('bc,ijl,ija->ijlabc', eye, diff, diff)
+            d3g = -3 * eee[None, None] * norm_diff_5_inv[:, :, None, None, None, None] \
+                + 15 * eedd * norm_diff_7_inv[:, :, None, None, None, None] \
+                - 105 * np.einsum('ijl,ija,ijb,ijc,ij->ijlabc', diff, diff, diff, diff, norm_diff_9_inv)
+
+            sensitivity = np.zeros((npoints, 3, 3, 3, num_coil_quadrature_points, 6))
+            # as in compute_by_dcoilgeometry, derivatives with respect to
+            # \gamma_j are the negative of those with respect to x
+            sensitivity[..., :3] = -np.einsum('mkl,jk,ijlabc->iabmjc', eps, dgamma_by_dphi, d3g)
+            sensitivity[..., 3:] = np.einsum('mkl,ijlab->iabmjk', eps, d2g)
+            self.d2B_by_dXdXdcoilgeometry.append(sensitivity.reshape((npoints, 27, num_coil_quadrature_points, 6)) * (1e-7/num_coil_quadrature_points))
+        return self
+
+
+class BatchedBiotSavart(PropertyManager):
+
+    def __init__(self, coil_sets, coil_currents):
+        """
+        The Biot-Savart fields of `len(coil_sets)` samples of a set of coils
+        that all carry `coil_currents`, e.g. the perturbed copies of the coils
+        in `StochasticQuasiSymmetryObjective`. All samples need the same
+        number of coils and quadrature points; the coil geometry is stacked
+        into arrays of shape (nsamples, ncoils, nquadpoints, 3) and all samples
+        are evaluated in a single call to the C++ kernel. The outputs carry a
+        leading sample dimension, e.g. `B` has shape (nsamples, npoints, 3) and
+        `dB_by_dcoilcurrents` has shape (nsamples, ncoils, npoints, 3).
+        """
+        assert all(len(coils) == len(coil_currents) for coils in coil_sets)
+        self.coil_sets = coil_sets
+        self.coil_currents = coil_currents
+
+    def set_points(self, points):
+        self.points = points
+        self.clear_cached_properties()
+
+    @writable_cached_property
+    def B(self):
+        self.compute(self.points)
+        return self.B
+
+    @writable_cached_property
+    def dB_by_dX(self):
+        self.compute(self.points)
+        return self.dB_by_dX
+
+    @writable_cached_property
+    def d2B_by_dXdX(self):
+        self.compute(self.points)
+        return self.d2B_by_dXdX
+
+    @writable_cached_property
+    def dB_by_dcoilcurrents(self):
+        self.compute(self.points)
+        return self.dB_by_dcoilcurrents
+
+    @writable_cached_property
+    def d2B_by_dXdcoilcurrents(self):
+        self.compute(self.points)
+        return self.d2B_by_dXdcoilcurrents
+
+    def gammas(self):
+        return np.asarray([[coil.gamma for coil in coils] for coils in self.coil_sets])
+
+    def dgamma_by_dphis(self):
+        return np.asarray([[coil.dgamma_by_dphi[:, 0, :] for coil in coils] for coils in self.coil_sets])
+
+    def compute(self, points, use_cpp=True):
+        nsamples, ncoils = len(self.coil_sets), len(self.coil_currents)
+        self.B           = np.zeros((nsamples, len(points), 3))
+        self.dB_by_dX    = np.zeros((nsamples, len(points), 3, 3))
+        self.d2B_by_dXdX = np.zeros((nsamples, len(points), 3, 3, 3))
+        self.dB_by_dcoilcurrents    = np.zeros((nsamples, ncoils, len(points), 3))
+        self.d2B_by_dXdcoilcurrents = np.zeros((nsamples, ncoils, len(points), 3, 3))
+        if nsamples == 0:
+            return self
+        if use_cpp:
+            cpp.biot_savart_all_batched(points, self.gammas(), self.dgamma_by_dphis(), self.coil_currents, self.B, self.dB_by_dX, self.d2B_by_dXdX, self.dB_by_dcoilcurrents, self.d2B_by_dXdcoilcurrents)
+        else:
+            for i, coils in enumerate(self.coil_sets):
+                bs = BiotSavart(coils, self.coil_currents).compute(points, use_cpp=False)
+                self.B[i], self.dB_by_dX[i], self.d2B_by_dXdX[i] = bs.B, bs.dB_by_dX, bs.d2B_by_dXdX
+                self.dB_by_dcoilcurrents[i], self.d2B_by_dXdcoilcurrents[i] = bs.dB_by_dcoilcurrents, bs.d2B_by_dXdcoilcurrents
         return self
+
+    def B_and_dB_vjp(self, v, vgrad, use_cpp=True):
+        r"""
+        For every sample s compute the gradient of
+            J_s = \sum_i v_{si} \cdot B_s(x_i) + vgrad_{si} : \nabla B_s(x_i)
+        with respect to the coefficients of each coil. Returns a list (over
+        samples) of lists (over coils) of arrays.
+        """
+        dJ_by_dgammas, dJ_by_ddgamma_by_dphis = self.compute_vjp(self.points, v, vgrad, use_cpp=use_cpp)
+        return [
+            [coil.dgamma_by_dcoeff_vjp(dJ_by_dgammas[i, j]) + coil.d2gamma_by_dphidcoeff_vjp(dJ_by_ddgamma_by_dphis[i, j])
+             for j, coil in enumerate(coils)]
+            for i, coils in enumerate(self.coil_sets)]
+
+    def compute_vjp(self, points, v, vgrad=None, use_cpp=True):
+        r"""
+        Batched version of `BiotSavart.compute_vjp`: `v` has shape
+        (nsamples, npoints, 3) and `vgrad` shape (nsamples, npoints, 3, 3) or
+        is `None`. Returns dJ/dgamma and dJ/d(dgamma_by_dphi) as arrays of
+        shape (nsamples, ncoils, nquadpoints, 3).
+        """
+        gammas = self.gammas()
+        dJ_by_dgammas          = np.zeros(gammas.shape)
+        dJ_by_ddgamma_by_dphis = np.zeros(gammas.shape)
+        if len(self.coil_sets) == 0:
+            return dJ_by_dgammas, dJ_by_ddgamma_by_dphis
+        if use_cpp:
+            if vgrad is None:
+                vgrad = np.zeros((0, 0, 3, 3))
+            cpp.biot_savart_vjp_batched(points, gammas, self.dgamma_by_dphis(), self.coil_currents, v, vgrad, dJ_by_dgammas, dJ_by_ddgamma_by_dphis)
+        else:
+            for i, coils in enumerate(self.coil_sets):
+                bs = BiotSavart(coils, self.coil_currents)
+                res_gamma, res_dgamma_by_dphi = bs.compute_vjp(points, v[i], None if vgrad is None else vgrad[i], use_cpp=False)
+                dJ_by_dgammas[i], dJ_by_ddgamma_by_dphis[i] = res_gamma, res_dgamma_by_dphi
+        return dJ_by_dgammas, dJ_by_ddgamma_by_dphis
+
+
+class LinearisedBatchedBiotSavart():
+
+    def __init__(self, nominal, coil_sets):
+        r"""
+        First order approximation
+            B(\gamma+\delta) \approx B(\gamma) + dB/d\gamma \delta
+        of `BatchedBiotSavart` for small perturbations of the coils of the
+        `BiotSavart` object `nominal`, whose field and `dB_by_dcoilgeometry`
+        are computed once and then shared by all samples. The perturbations
+        \delta of the quadrature points and tangents are the differences
+        between the coils in `coil_sets` and the nominal coils, so evaluating
+        a sample only costs a matrix product instead of a Biot-Savart sum.
+
+        `d2B_by_dXdX` and `compute_vjp` are the exact derivatives of this
+        approximation for fixed \delta, so they also use the sensitivities
+        `d2B_by_dXdXdcoilgeometry` of the second derivatives.
+        """
+        assert all(len(coils) == len(nominal.coils) for coils in coil_sets)
+        self.nominal = nominal
+        self.coil_sets = coil_sets
+        self.coil_currents = nominal.coil_currents
+
+    def set_points(self, points):
+        self.points = points
+
+    def perturbations(self):
+        r""" \delta as an array of shape (nsamples, ncoils, nquadpoints, 6). """
+        return np.asarray([[
+            np.concatenate((coil.gamma - nominal.gamma, coil.dgamma_by_dphi[:, 0, :] - nominal.dgamma_by_dphi[:, 0, :]), axis=1)
+            for (coil, nominal) in zip(coils, self.nominal.coils)] for coils in self.coil_sets])
+
+    def compute(self, points):
+        nominal = self.nominal
+        if getattr(nominal, "points", None) is not points:
+            nominal.set_points(points)
+        nsamples, npoints = len(self.coil_sets), len(points)
+        deltas = self.perturbations()
+        fields = np.zeros((nsamples, len(nominal.coils), npoints, 12))
+        for i, sensitivity in enumerate(nominal.dB_by_dcoilgeometry):
+            nominal_field = np.concatenate((nominal.dB_by_dcoilcurrents[i], nominal.d2B_by_dXdcoilcurrents[i].reshape((npoints, 9))), axis=1)
+            fields[:, i] = nominal_field[None, :, :] \
+                + (deltas[:, i].reshape((nsamples, -1)) @ sensitivity.reshape((npoints*12, -1)).T).reshape((nsamples, npoints, 12))
+        self.dB_by_dcoilcurrents    = fields[..., :3]
+        self.d2B_by_dXdcoilcurrents = fields[..., 3:].reshape((nsamples, -1, npoints, 3, 3))
+        self.B           = np.einsum('c,scij->sij', self.coil_currents, self.dB_by_dcoilcurrents)
+        self.dB_by_dX    = np.einsum('c,scijk->sijk', self.coil_currents, self.d2B_by_dXdcoilcurrents)
+        self.d2B_by_dXdX = np.repeat(nominal.d2B_by_dXdX[None, ...], nsamples, axis=0)
+        for i, (current, sensitivity) in enumerate(zip(self.coil_currents, nominal.d2B_by_dXdXdcoilgeometry)):
+            self.d2B_by_dXdX += current * (deltas[:, i].reshape((nsamples, -1)) @ sensitivity.reshape((npoints*27, -1)).T).reshape((nsamples, npoints, 3, 3, 3))
+        return self
+
+    def compute_vjp(self, points, v, vgrad=None):
+        r"""
+        Same as `BatchedBiotSavart.compute_vjp`, for the linearised fields
+            F_s = F(\gamma) + S(\gamma) \delta_s
+        of B and dB_by_dX with the sensitivities S of `dB_by_dcoilgeometry`.
+        Besides S^T v this has the term of the derivative of S with respect
+        to the coils. The contribution of quadrature point j depends on
+        \gamma_j only through x-\gamma_j and is linear in \gamma'_j, so the
+        columns of S that belong to \gamma_j are minus the x derivatives of
+        the contribution, and the derivatives of S are again x derivatives,
+        i.e. the rows of S and of `d2B_by_dXdXdcoilgeometry` shifted by one
+        order.
+        """
+        nominal = self.nominal
+        nsamples, npoints = v.shape[0], v.shape[1]
+        if vgrad is None:
+            vgrad = np.zeros((nsamples, npoints, 3, 3))
+        vs = np.concatenate((v, vgrad.reshape((nsamples, npoints, 9))), axis=2).reshape((nsamples, -1))
+        res = np.asarray([
+            current * (vs @ sensitivity.reshape((npoints*12, -1))).reshape((nsamples, -1, 6))
+            for (current, sensitivity) in zip(self.coil_currents, nominal.dB_by_dcoilgeometry)]).transpose((1, 0, 2, 3))
+        deltas = self.perturbations()
+        for i, (current, sensitivity, d2B_sensitivity) in enumerate(zip(self.coil_currents, nominal.dB_by_dcoilgeometry, nominal.d2B_by_dXdXdcoilgeometry)):
+            nquadpoints = sensitivity.shape[2]
+            d2B_sensitivity = d2B_sensitivity.reshape((npoints, 3, 3, 3, nquadpoints, 6))
+            # vs_dS[s, b, j, c] = \sum v_s \partial_b S[:, :, j, c], the second
+            # derivatives are symmetric, so \partial_b of the rows of
+            # dB_by_dX are the contiguous rows d2B_sensitivity[:, b]
+            vs_dS = np.stack([
+                vs @ np.concatenate((sensitivity[:, 3+3*b:6+3*b], d2B_sensitivity[:, b].reshape((npoints, 9, nquadpoints, 6))), axis=1).reshape((npoints*12, -1))
+                for b in range(3)], axis=1).reshape((nsamples, 3, nquadpoints, 6))
+            delta = deltas[:, i]
+            res[:, i, :, :3] -= current * np.einsum('sjc,sbjc->sjb', delta, vs_dS)
+            res[:, i, :, 3:] -= current * np.einsum('sja,sajm->sjm', delta[:, :, :3], vs_dS[..., 3:])
+        return res[..., :3], res[..., 3:]
@@ -7,28 +7,40 @@ class CoilCollection():
     """
     Given some input coils and currents, this performs the reflection and
     rotation to generate a full set of stellerator coils.
+
+    `symmetries` contains one pair (rotmat, sign) per rotation/reflection, such
+    that the corresponding copy of a base coil is `gamma @ rotmat` and carries
+    the current `sign * current`. The base currents are updated in place, so
+    that a `BiotSavart` built from `_base_coils`, `_base_currents` and
+    `symmetries` stays in sync with `set_currents`.
     """
 
     def __init__(self, coils, currents, nfp, stellerator_symmetrie):
         self._base_coils = coils
-        self._base_currents = currents
+        self._base_currents = list(currents)
+        self.nfp = nfp
+        self.stellerator_symmetrie = stellerator_symmetrie
         self.coils = []
         self.currents = []
         flip_list = [False, True] if stellerator_symmetrie else [False] 
         self.map = []
         self.current_sign = []
+        self.symmetries = []
         for k in range(0, nfp):
             for flip in flip_list:
                 for i in range(len(coils)):
                     if k == 0 and not flip:
                         self.coils.append(self._base_coils[i])
                         self.currents.append(self._base_currents[i])
+                        rotmat = np.eye(3)
                     else:
                         rotcoil = RotatedCurve(coils[i], 2*pi*k/nfp, flip)
                         self.coils.append(rotcoil)
                         self.currents.append(-self._base_currents[i] if flip else currents[i])
+                        rotmat = rotcoil.rotmat
                     self.map.append(i)
                     self.current_sign.append(-1 if flip else +1)
+                self.symmetries.append((rotmat, -1 if flip else +1))
         dof_ranges = [(0, len(self._base_coils[0].get_dofs()))]
         for i in range(1, len(self._base_coils)):
             dof_ranges.append((dof_ranges[-1][1], dof_ranges[-1][1] + len(self._base_coils[i].get_dofs())))
@@ -43,7 +55,7 @@ class CoilCollection():
         return np.concatenate([coil.get_dofs() for coil in self._base_coils])
     
     def set_currents(self, currents):
-        self._base_currents = currents
+        self._base_currents[:] = currents
         for i in range(len(self.currents)):
             self.currents[i] = self.current_sign[i] * currents[self.map[i]]
 
@@ -0,0 +1,58 @@
+import numpy as np
+
+
+class ControlVariate():
+
+    def __init__(self, decay=0.9):
+        r"""
+        Control variate estimator of E[X] from samples X_i (scalars or
+        vectors) and control samples C_i with known mean E[C] = 0,
+            \hat E[X] = mean(X_i) - \beta mean(C_i),   \beta = Cov(X, C)/Var(C),
+        with one coefficient per component of X.
+
+        The coefficient is estimated online: the centered sums
+        \sum (X_i - mean(X)) C_i and \sum (C_i - mean(C))^2 of the accepted
+        calls are kept, weighted down by `decay` per accepted call. Each call
+        uses the coefficient from the previously accepted calls only, so that
+        the estimate stays unbiased and the coefficient does not change during
+        the line search of an iteration. The first call is plain Monte Carlo.
+        """
+        self.decay = decay
+        self.sum_xc = 0.
+        self.sum_cc = 0.
+        self.pending = None
+
+    def coefficient(self):
+        if np.all(self.sum_cc == 0):
+            return 0.
+        return self.sum_xc/self.sum_cc
+
+    def estimate(self, mean_x, mean_c, sum_xc=None, sum_cc=None, nsamples=None):
+        """
+        Returns the controlled estimate given the sample means of X and C.
+        The sums of X_i C_i and C_i^2 of the current `nsamples` samples are
+        centered with the sample means and kept until `accept` is called.
+        The sums are omitted when only the leading components of X were
+        sampled; then `accept` has no effect.
+        """
+        beta = self.coefficient()
+        if np.ndim(beta) > 0:
+            beta = beta[:np.size(mean_x)]
+        res = mean_x - beta * mean_c
+        if sum_xc is not None:
+            self.pending = (sum_xc - nsamples * mean_c * mean_x, sum_cc - nsamples * mean_c**2)
+        else:
+            self.pending = None
+        return res
+
+    def accept(self):
+        """
+        Adds the sums of the last call of `estimate` to the running sums,
+        e.g. once its point has been accepted as the next iterate.
+        """
+        if self.pending is None:
+            return
+        sum_xc, sum_cc = self.pending
+        self.sum_xc = self.decay * self.sum_xc + sum_xc
+        self.sum_cc = self.decay * self.sum_cc + sum_cc
+        self.pending = None
@@ -1,7 +1,30 @@
-from sympy import *
 import numpy as np
 from math import pi, sin, cos
-from property_manager3 import cached_property, PropertyManager
+from .operator_cache import operator_cache
+
+
+class curve_property():
+    """
+    A lazily computed property of a `Curve`. The value is stored together
+    with `curve.state()` at the time it was computed, and recomputed when it
+    is accessed after the state has changed, i.e. after the curve or a curve
+    it is derived from was updated.
+    """
+
+    def __init__(self, func):
+        self.func = func
+        self.name = func.__name__
+        self.__doc__ = func.__doc__
+
+    def __get__(self, obj, objtype=None):
+        if obj is None:
+            return self
+        state = obj.state()
+        entry = obj.property_cache.get(self.name)
+        if entry is None or entry[0] != state:
+            entry = (state, self.func(obj))
+            obj.property_cache[self.name] = entry
+        return entry[1]
 
 
 class Curve():
@@ -14,24 +37,21 @@ class Curve():
             self.points = np.linspace(0, 1, points, endpoint=False)
         else:
             self.points = points
-        self.dependencies = []
-        self.curve_properties = set([
-            "gamma", "dgamma_by_dphi", "d2gamma_by_dphidphi", "d3gamma_by_dphidphidphi",
-            "dgamma_by_dcoeff", "d2gamma_by_dphidcoeff", "d3gamma_by_dphidphidcoeff", "d4gamma_by_dphidphidphidcoeff",
-            "kappa", "dkappa_by_dphi", "dkappa_by_dcoeff", "d2kappa_by_dphidcoeff",
-            "incremental_arclength", "dincremental_arclength_by_dcoeff", "dincremental_arclength_by_dphi",
-            "torsion", "dtorsion_by_dcoeff",
-            "frenet_frame", "dfrenet_frame_by_dcoeff"
-        ])
-    def update(self):
+        self.version = 0
+        self.property_cache = {}
 
-        d = self.__dict__
-        keys_to_remove = set(self.curve_properties).intersection(set(d.keys()))
-        for key in keys_to_remove:
-            del d[key]
+    def update(self):
+        """
+        Marks the properties of the curve, and of all curves derived from it,
+        as outdated. They are recomputed when they are accessed next.
+        """
+        self.version += 1
 
-        for obj in self.dependencies:
-            obj.update()
+    def state(self):
+        """
+        Changes whenever the curve or a curve it is derived from is updated.
+        """
+        return self.version
 
     def num_coeff(self):
         raise NotImplementedError
@@ -42,27 +62,55 @@ class Curve():
     def set_dofs(self, dofs):
         raise NotImplementedError
 
-    @cached_property
+    @curve_property
     def gamma(self):
         """ Evaluate the curve at `points`. """
         raise NotImplementedError
 
-    @cached_property
+    @curve_property
     def dgamma_by_dphi(self):
         """ Return the derivative of the curve. """
         raise NotImplementedError
 
-    @cached_property
+    @curve_property
     def d2gamma_by_dphidphi(self):
         """ Return the second derivative of the curve. """
         raise NotImplementedError
 
-    @cached_property
+    @curve_property
     def d3gamma_by_dphidphidphi(self):
         """ Return the third derivative of the curve. """
         pass
 
-    @cached_property
+    def dgamma_by_dcoeff_vjp(self, v):
+        r"""
+        Return \sum_{i,j} v_{ij} dgamma_by_dcoeff_{ikj}, the gradient of
+        \sum_i v_i \cdot \Gamma(\phi_i) with respect to the coefficients.
+        Curves with structured coefficient derivatives override this to avoid
+        the dense tensor. `v` may have leading batch dimensions (e.g. one per
+        sample), which are kept in the result.
+        """
+        return np.einsum('...ij,ikj->...k', v, self.dgamma_by_dcoeff)
+
+    def d2gamma_by_dphidcoeff_vjp(self, v):
+        r"""
+        Return \sum_{i,j} v_{ij} d2gamma_by_dphidcoeff_{i0kj}.
+        """
+        return np.einsum('...ij,ikj->...k', v, self.d2gamma_by_dphidcoeff[:, 0, :, :])
+
+    def d3gamma_by_dphidphidcoeff_vjp(self, v):
+        r"""
+        Return \sum_{i,j} v_{ij} d3gamma_by_dphidphidcoeff_{i00kj}.
+        """
+        return np.einsum('...ij,ikj->...k', v, self.d3gamma_by_dphidphidcoeff[:, 0, 0, :, :])
+
+    def d4gamma_by_dphidphidphidcoeff_vjp(self, v):
+        r"""
+        Return \sum_{i,j} v_{ij} d4gamma_by_dphidphidphidcoeff_{i000kj}.
+        """
+        return np.einsum('...ij,ikj->...k', v, self.d4gamma_by_dphidphidphidcoeff[:, 0, 0, 0, :, :])
+
+    @curve_property
     def kappa(self):
         """ Curvature at `points`. """
         kappa = np.zeros((len(self.points), 1))
@@ -72,7 +120,7 @@ class Curve():
         kappa[:, :] = (np.linalg.norm(np.cross(dgamma, d2gamma), axis=1)/np.linalg.norm(dgamma, axis=1)**3).reshape(len(points),1)
         return kappa
 
-    @cached_property
+    @curve_property
     def dkappa_by_dphi(self):
         dkappa_by_dphi = np.zeros((len(self.points), 1, 1))
         points = self.points
@@ -86,7 +134,7 @@ class Curve():
             - 3 * inner(dgamma, d2gamma) * norm(cross(dgamma, d2gamma))/norm(dgamma)**5
         return dkappa_by_dphi
 
-    @cached_property
+    @curve_property
     def d2kappa_by_dphidcoeff(self):
         d2kappa_by_dphidcoeff = np.zeros((len(self.points), 1, self.num_coeff(), 1))
         points = self.points
@@ -131,19 +179,19 @@ class Curve():
                 )
         return d2kappa_by_dphidcoeff
 
-    @cached_property
+    @curve_property
     def d2gamma_by_dphidcoeff(self):
         raise NotImplementedError
 
-    @cached_property
+    @curve_property
     def d3gamma_by_dphidphidcoeff(self):
         raise NotImplementedError
 
-    @cached_property
+    @curve_property
     def d4gamma_by_dphidphidphidcoeff(self):
         raise NotImplementedError
 
-    @cached_property
+    @curve_property
     def dkappa_by_dcoeff(self):
         dkappa_by_dcoeff = np.zeros((len(self.points), self.num_coeff(), 1))
         dgamma_by_dphi = self.dgamma_by_dphi[:, 0, :]
@@ -162,13 +210,13 @@ class Curve():
             - (norm(numerator) * 3 / denominator**5)[:, None] * np.sum(dgamma_by_dphi[:, None, :] * dgamma_by_dphidcoeff[:, :, :], axis=2)
         return dkappa_by_dcoeff
 
-    @cached_property
+    @curve_property
     def incremental_arclength(self):
         incremental_arclength = np.zeros((len(self.points), 1))
         incremental_arclength[:, :] = np.linalg.norm(self.dgamma_by_dphi[:, 0, :], axis=1).reshape((len(self.points), 1))
         return incremental_arclength
 
-    @cached_property
+    @curve_property
     def dincremental_arclength_by_dcoeff(self):
         dgamma_by_dphi = self.dgamma_by_dphi[:, 0, :]
         dgamma_by_dphidcoeff = self.d2gamma_by_dphidcoeff[:, 0, :, :]
@@ -177,7 +225,7 @@ class Curve():
         res[:, :, 0] = (1/self.incremental_arclength) * np.sum(dgamma_by_dphi[:, None, :] * dgamma_by_dphidcoeff[:, :, :], axis=2)
         return res
 
-    @cached_property
+    @curve_property
     def dincremental_arclength_by_dphi(self):
         dincremental_arclength_by_dphi = np.zeros((len(self.points), 1, 1))
         dgamma_by_dphi = self.dgamma_by_dphi[:, 0, :]
@@ -188,7 +236,7 @@ class Curve():
         dincremental_arclength_by_dphi[:, 0, 0] = inner(dgamma_by_dphi, dgamma_by_dphidphi)/self.incremental_arclength[:,0]
         return dincremental_arclength_by_dphi 
 
-    @cached_property
+    @curve_property
     def torsion(self):
         torsion = np.zeros((len(self.points), 1))
         d1gamma = self.dgamma_by_dphi[:, 0, :]
@@ -197,7 +245,7 @@ class Curve():
         torsion[:, 0] = np.sum(np.cross(d1gamma, d2gamma, axis=1) * d3gamma, axis=1) / np.sum(np.cross(d1gamma, d2gamma, axis=1)**2, axis=1)
         return torsion
 
-    @cached_property
+    @curve_property
     def dtorsion_by_dcoeff(self):
         dtorsion_by_dcoeff = np.zeros((len(self.points), self.num_coeff(), 1))
         d1gamma = self.dgamma_by_dphi[:, 0, :]
@@ -213,7 +261,7 @@ class Curve():
         dtorsion_by_dcoeff[:, :, 0] -= np.sum(np.cross(d1gamma, d2gamma, axis=1) * d3gamma, axis=1)[:, None] * np.sum(2 * np.cross(d1gamma, d2gamma, axis=1)[:, None, :] * (np.cross(d1gammadcoeff, d2gamma[:, None, :], axis=2) + np.cross(d1gamma[:, None, :], d2gammadcoeff, axis=2)), axis=2)/np.sum(np.cross(d1gamma, d2gamma, axis=1)**2, axis=1)[:, None]**2
         return dtorsion_by_dcoeff
         
-    @cached_property
+    @curve_property
     def frenet_frame(self):
         """
         Returns the (t, n, b) Frenet frame.
@@ -236,7 +284,7 @@ class Curve():
         b[:,:] = np.cross(t, n, axis=1)
         return t, n, b
 
-    @cached_property
+    @curve_property
     def dfrenet_frame_by_dcoeff(self):
         dgamma_by_dphi            = self.dgamma_by_dphi[:, 0, :]
         d2gamma_by_dphidphi       = self.d2gamma_by_dphidphi[:, 0, 0, :]
@@ -275,6 +323,72 @@ class Curve():
         db_by_dcoeff[:, :, :] = np.cross(dt_by_dcoeff, n[:, None, :], axis=2) + np.cross(t[:, None, :], dn_by_dcoeff, axis=2)
         return dt_by_dcoeff, dn_by_dcoeff, db_by_dcoeff
 
+    def frenet_frame_vjp(self, v_t, v_n, v_b, v_kappa, v_dkappa_by_dphi, v_torsion, v_l):
+        r"""
+        Return the gradient of
+            \sum_i v_t_i \cdot t_i + v_n_i \cdot n_i + v_b_i \cdot b_i + v_kappa_i \kappa_i
+                + v_dkappa_by_dphi_i \kappa'_i + v_torsion_i \tau_i + v_l_i l_i
+        with respect to the coefficients. The derivatives are first propagated
+        back to the first three derivatives of the curve at each point, so the
+        coefficients only enter through three vjps.
+        """
+        d1 = self.dgamma_by_dphi[:, 0, :]
+        d2 = self.d2gamma_by_dphidphi[:, 0, 0, :]
+        d3 = self.d3gamma_by_dphidphidphi[:, 0, 0, 0, :]
+        inner = lambda a, b: np.sum(a*b, axis=1)
+        cross = lambda a, b: np.cross(a, b, axis=1)
+        l = np.linalg.norm(d1, axis=1)
+        w = cross(d1, d2)
+        W = np.linalg.norm(w, axis=1)
+        q = inner(d1, d2)
+        u = cross(d1, d3)
+        P = inner(w, u)
+        t, n, b = self.frenet_frame
+        tdash = d2/l[:, None] - (q/l**3)[:, None] * d1
+        normtdash = np.linalg.norm(tdash, axis=1)
+
+        v_t = v_t + cross(n, v_b)
+        v_n = v_n + cross(v_b, t)
+        v_l = np.array(v_l, dtype=np.float64)
+        v_d1, v_d2, v_d3 = np.zeros(d1.shape), np.zeros(d2.shape), np.zeros(d3.shape)
+
+        """ n = tdash/|tdash|, tdash = d2/l - (d1 . d2) d1/l^3 """
+        v_tdash = (v_n - inner(v_n, n)[:, None] * n)/normtdash[:, None]
+        v_d2 += v_tdash/l[:, None]
+        v_q = -inner(v_tdash, d1)/l**3
+        v_d1 -= (q/l**3)[:, None] * v_tdash
+        v_l += -inner(v_tdash, d2)/l**2 + 3 * q * inner(v_tdash, d1)/l**4
+
+        """ t = d1/l """
+        v_d1 += (v_t - inner(v_t, t)[:, None] * t)/l[:, None]
+
+        """ torsion = (w . d3)/|w|^2, w = d1 x d2 """
+        v_w = (v_torsion/W**2)[:, None] * d3 - (2 * v_torsion * inner(w, d3)/W**4)[:, None] * w
+        v_d3 += (v_torsion/W**2)[:, None] * w
+
+        """ dkappa_by_dphi = (w . u)/(|w| l^3) - 3 (d1 . d2) |w|/l^5, u = d1 x d3 """
+        v_P = v_dkappa_by_dphi/(W * l**3)
+        v_W = -v_dkappa_by_dphi * P/(W**2 * l**3) - 3 * v_dkappa_by_dphi * q/l**5
+        v_l += -3 * v_dkappa_by_dphi * P/(W * l**4) + 15 * v_dkappa_by_dphi * q * W/l**6
+        v_q += -3 * v_dkappa_by_dphi * W/l**5
+        v_w += v_P[:, None] * u
+        v_u = v_P[:, None] * w
+        v_d1 += cross(d3, v_u)
+        v_d3 += cross(v_u, d1)
+
+        """ kappa = |w|/l^3 """
+        v_W += v_kappa/l**3
+        v_l += -3 * v_kappa * W/l**4
+
+        v_w += (v_W/W)[:, None] * w
+        v_d1 += cross(d2, v_w)
+        v_d2 += cross(v_w, d1)
+        v_d1 += v_q[:, None] * d2
+        v_d2 += v_q[:, None] * d1
+        v_d1 += (v_l/l)[:, None] * d1
+        return self.d2gamma_by_dphidcoeff_vjp(v_d1) + self.d3gamma_by_dphidphidcoeff_vjp(v_d2) \
+            + self.d4gamma_by_dphidphidphidcoeff_vjp(v_d3)
+
     def plot(self, ax=None, show=True, plot_derivative=False, closed_loop=True, color=None, linestyle=None):
         import matplotlib.pyplot as plt
         from mpl_toolkits.mplot3d import Axes3D
@@ -297,6 +411,56 @@ class Curve():
         return ax
 
 
+def fourier_basis(points, order):
+    r"""
+    Returns an array of shape (4, len(points), 2*order+1) containing the basis
+        1, sin(2*pi*j*\phi), cos(2*pi*j*\phi), j = 1, ..., order
+    (in the order used by `CartesianFourierCurve.coefficients`) and its first
+    three derivatives with respect to \phi. The result is kept in the
+    `operator_cache` and shared by all curves with the same quadrature points
+    and order, so it is read-only.
+    """
+    def compute():
+        w = 2*pi*np.arange(1, order+1)[None, :]
+        sin_, cos_ = np.sin(w*points[:, None]), np.cos(w*points[:, None])
+        basis = np.zeros((4, len(points), 2*order+1))
+        basis[0, :, 0] = 1.
+        basis[:, :, 1::2] = [sin_, w*cos_, -w**2*sin_, -w**3*cos_]
+        basis[:, :, 2::2] = [cos_, -w*sin_, -w**2*cos_, w**3*sin_]
+        return basis
+    return operator_cache.get(("fourier_basis", operator_cache.grid_key(points), order), compute)
+
+
+def fourier_basis_by_dcoeff(points, order, deriv):
+    """
+    The derivative of the `deriv`-th derivative of a `CartesianFourierCurve`
+    with respect to its coefficients, an array of shape (len(points),
+    3*(2*order+1), 3). It does not depend on the coefficients, so it is
+    cached and shared like `fourier_basis`.
+    """
+    def compute():
+        basis = fourier_basis(points, order)[deriv]
+        res = np.zeros((len(points), 3*(2*order+1), 3))
+        for i in range(3):
+            res[:, i*(2*order+1):(i+1)*(2*order+1), i] = basis
+        return res
+    return operator_cache.get(("fourier_basis_by_dcoeff", operator_cache.grid_key(points), order, deriv), compute)
+
+
+def cylindrical_fourier_basis(points, order, nfp):
+    r"""
+    Returns cos(nfp*2*pi*i*\phi) and sin(nfp*2*pi*i*\phi) for i = 0, ...,
+    order as arrays of shape (len(points), order+1), and cos(2*pi*\phi) and
+    sin(2*pi*\phi), the tables used by
+    `StelleratorSymmetricCylindricalFourierCurve`. Cached and shared like
+    `fourier_basis`.
+    """
+    def compute():
+        x = nfp * 2 * pi * np.outer(points, np.arange(order+1))
+        return (np.cos(x), np.sin(x), np.cos(2 * pi * points), np.sin(2 * pi * points))
+    return operator_cache.get(("cylindrical_fourier_basis", operator_cache.grid_key(points), order, nfp), compute)
+
+
 class CartesianFourierCurve(Curve):
     r"""
 A curve of the form 
@@ -326,6 +490,8 @@ with
         return np.concatenate(self.coefficients)
 
     def set_dofs(self, dofs):
+        if np.array_equal(dofs, self.get_dofs()):
+            return
         counter = 0
         for i in range(3):
             self.coefficients[i][0] = dofs[counter]
@@ -337,91 +503,53 @@ with
                 counter += 1
         super().update()
 
-    @cached_property
+    @curve_property
     def gamma(self):
-        gamma = np.zeros((len(self.points), 3))
-        coeffs = self.coefficients
-        points = self.points
-        for i in range(3):
-            gamma[:, i] += coeffs[i][0]
-            for j in range(1, self.order+1):
-                gamma[:, i] += coeffs[i][2*j-1] * np.sin(2*pi*j*points)
-                gamma[:, i] += coeffs[i][2*j]   * np.cos(2*pi*j*points)
-        return gamma
+        return fourier_basis(self.points, self.order)[0] @ np.asarray(self.coefficients).T
 
-    @cached_property
+    @curve_property
     def dgamma_by_dcoeff(self):
-        dgamma_by_dcoeff = np.zeros((len(self.points), self.num_coeff(), 3))
-        points = self.points
-        for i in range(3):
-            dgamma_by_dcoeff[:, i*(2*self.order+1), i] = 1
-            for j in range(1, self.order+1):
-                dgamma_by_dcoeff[:, i*(2*self.order+1) + 2*j-1, i] = np.sin(2*pi*j*points)
-                dgamma_by_dcoeff[:, i*(2*self.order+1) + 2*j  , i] = np.cos(2*pi*j*points)
-        return dgamma_by_dcoeff
+        return fourier_basis_by_dcoeff(self.points, self.order, 0)
 
-    @cached_property
+    @curve_property
     def dgamma_by_dphi(self):
-        dgamma_by_dphi = np.zeros((len(self.points), 1, 3))
-        coeffs = self.coefficients
-        points = self.points
-        for i in range(3):
-            for j in range(1, self.order+1):
-                dgamma_by_dphi[:, 0, i] += +coeffs[i][2*j-1] * 2*pi*j*np.cos(2*pi*j*points)
-                dgamma_by_dphi[:, 0, i] += -coeffs[i][2*j] * 2*pi*j*np.sin(2*pi*j*points)
-        return dgamma_by_dphi
+        return (fourier_basis(self.points, self.order)[1] @ np.asarray(self.coefficients).T)[:, None, :]
 
-    @cached_property
+    @curve_property
     def d2gamma_by_dphidcoeff(self):
-        d2gamma_by_dphidcoeff = np.zeros((len(self.points), 1, self.num_coeff(), 3))
-        points = self.points
-        for i in range(3):
-            for j in range(1, self.order+1):
-                d2gamma_by_dphidcoeff[:, 0, i*(2*self.order+1) + 2*j-1, i] = +2*pi*j*np.cos(2*pi*j*points)
-                d2gamma_by_dphidcoeff[:, 0, i*(2*self.order+1) + 2*j  , i] = -2*pi*j*np.sin(2*pi*j*points)
-        return d2gamma_by_dphidcoeff
+        return fourier_basis_by_dcoeff(self.points, self.order, 1)[:, None, :, :]
 
-    @cached_property
+    @curve_property
     def d2gamma_by_dphidphi(self):
-        d2gamma_by_dphidphi = np.zeros((len(self.points), 1, 1, 3))
-        coeffs = self.coefficients
-        points = self.points
-        for i in range(3):
-            for j in range(1, self.order+1):
-                d2gamma_by_dphidphi[:, 0, 0, i] += -coeffs[i][2*j-1] * (2*pi*j)**2*np.sin(2*pi*j*points)
-                d2gamma_by_dphidphi[:, 0, 0, i] += -coeffs[i][2*j]   * (2*pi*j)**2*np.cos(2*pi*j*points)
-        return d2gamma_by_dphidphi
+        return (fourier_basis(self.points, self.order)[2] @ np.asarray(self.coefficients).T)[:, None, None, :]
 
-    @cached_property
+    @curve_property
     def d3gamma_by_dphidphidcoeff(self):
-        d3gamma_by_dphidphidcoeff = np.zeros((len(self.points), 1, 1, self.num_coeff(), 3))
-        points = self.points
-        for i in range(3):
-            for j in range(1, self.order+1):
-                d3gamma_by_dphidphidcoeff[:, 0, 0, i*(2*self.order+1) + 2*j-1, i] = -(2*pi*j)**2*np.sin(2*pi*j*points)
-                d3gamma_by_dphidphidcoeff[:, 0, 0, i*(2*self.order+1) + 2*j  , i] = -(2*pi*j)**2*np.cos(2*pi*j*points)
-        return d3gamma_by_dphidphidcoeff
+        return fourier_basis_by_dcoeff(self.points, self.order, 2)[:, None, None, :, :]
 
-    @cached_property
+    @curve_property
     def d3gamma_by_dphidphidphi(self):
-        d3gamma_by_dphidphidphi = np.zeros((len(self.points), 1, 1, 1, 3))
-        coeffs = self.coefficients
-        points = self.points
-        for i in range(3):
-            for j in range(1, self.order+1):
-                d3gamma_by_dphidphidphi[:, 0, 0, 0, i] += -coeffs[i][2*j-1] * (2*pi*j)**3*np.cos(2*pi*j*points)
-                d3gamma_by_dphidphidphi[:, 0, 0, 0, i] += +coeffs[i][2*j]   * (2*pi*j)**3*np.sin(2*pi*j*points)
-        return d3gamma_by_dphidphidphi
+        return (fourier_basis(self.points, self.order)[3] @ np.asarray(self.coefficients).T)[:, None, None, None, :]
 
-    @cached_property
+    @curve_property
     def d4gamma_by_dphidphidphidcoeff(self):
-        d4gamma_by_dphidphidphidcoeff = np.zeros((len(self.points), 1, 1, 1, self.num_coeff(), 3))
-        points = self.points
-        for i in range(3):
-            for j in range(1, self.order+1):
-                d4gamma_by_dphidphidphidcoeff[:, 0, 0, 0, i*(2*self.order+1) + 2*j-1, i] = -(2*pi*j)**3*np.cos(2*pi*j*points)
-                d4gamma_by_dphidphidphidcoeff[:, 0, 0, 0, i*(2*self.order+1) + 2*j  , i] = +(2*pi*j)**3*np.sin(2*pi*j*points)
-        return d4gamma_by_dphidphidphidcoeff
+        return fourier_basis_by_dcoeff(self.points, self.order, 3)[:, None, None, None, :, :]
+
+    def dgamma_by_dcoeff_vjp(self, v):
+        v = np.asarray(v)
+        return np.einsum('im,...ij->...jm', fourier_basis(self.points, self.order)[0], v).reshape(v.shape[:-2] + (-1,))
+
+    def d2gamma_by_dphidcoeff_vjp(self, v):
+        v = np.asarray(v)
+        return np.einsum('im,...ij->...jm', fourier_basis(self.points, self.order)[1], v).reshape(v.shape[:-2] + (-1,))
+
+    def d3gamma_by_dphidphidcoeff_vjp(self, v):
+        v = np.asarray(v)
+        return np.einsum('im,...ij->...jm', fourier_basis(self.points, self.order)[2], v).reshape(v.shape[:-2] + (-1,))
+
+    def d4gamma_by_dphidphidphidcoeff_vjp(self, v):
+        v = np.asarray(v)
+        return np.einsum('im,...ij->...jm', fourier_basis(self.points, self.order)[3], v).reshape(v.shape[:-2] + (-1,))
 
 
 class StelleratorSymmetricCylindricalFourierCurve(Curve):
@@ -439,6 +567,8 @@ class StelleratorSymmetricCylindricalFourierCurve(Curve):
         return np.concatenate(self.coefficients)
 
     def set_dofs(self, dofs):
+        if np.array_equal(dofs, self.get_dofs()):
+            return
         counter = 0
         for i in range(self.order+1):
             self.coefficients[0][i] = dofs[i]
@@ -446,150 +576,158 @@ class StelleratorSymmetricCylindricalFourierCurve(Curve):
             self.coefficients[1][i] = dofs[self.order + 1 + i]
         self.update()
 
-    @cached_property
+    @curve_property
     def gamma(self):
         gamma = np.zeros((len(self.points), 3))
         points = self.points
         nfp = self.nfp
+        cos_nfp, sin_nfp, cos_, sin_ = cylindrical_fourier_basis(self.points, self.order, nfp)
         for i in range(self.order+1):
-            gamma[:, 0] += self.coefficients[0][i] * np.cos(nfp * 2 * pi * i * points) * np.cos(2 * pi * points)
-            gamma[:, 1] += self.coefficients[0][i] * np.cos(nfp * 2 * pi * i * points) * np.sin(2 * pi * points)
+            gamma[:, 0] += self.coefficients[0][i] * cos_nfp[:, i] * cos_
+            gamma[:, 1] += self.coefficients[0][i] * cos_nfp[:, i] * sin_
         for i in range(1, self.order+1):
-            gamma[:, 2] += self.coefficients[1][i-1] * np.sin(nfp * 2 * pi * i * points)
+            gamma[:, 2] += self.coefficients[1][i-1] * sin_nfp[:, i]
         return gamma
 
-    @cached_property
+    @curve_property
     def dgamma_by_dcoeff(self):
         dgamma_by_dcoeff = np.zeros((len(self.points), self.num_coeff(), 3))
         points = self.points
         nfp = self.nfp
+        cos_nfp, sin_nfp, cos_, sin_ = cylindrical_fourier_basis(self.points, self.order, nfp)
         for i in range(self.order+1):
-            dgamma_by_dcoeff[:, i, 0] = np.cos(nfp * 2 * pi * i * points) * np.cos(2 * pi * points)
-            dgamma_by_dcoeff[:, i, 1] = np.cos(nfp * 2 * pi * i * points) * np.sin(2 * pi * points)
+            dgamma_by_dcoeff[:, i, 0] = cos_nfp[:, i] * cos_
+            dgamma_by_dcoeff[:, i, 1] = cos_nfp[:, i] * sin_
         for i in range(1, self.order+1):
-            dgamma_by_dcoeff[:, self.order + i, 2] = np.sin(nfp * 2 * pi * i * points)
+            dgamma_by_dcoeff[:, self.order + i, 2] = sin_nfp[:, i]
         return dgamma_by_dcoeff
 
-    @cached_property
+    @curve_property
     def dgamma_by_dphi(self):
         dgamma_by_dphi = np.zeros((len(self.points), 1, 3))
         points = self.points
         nfp = self.nfp
+        cos_nfp, sin_nfp, cos_, sin_ = cylindrical_fourier_basis(self.points, self.order, nfp)
         for i in range(self.order+1):
             dgamma_by_dphi[:, 0, 0] += self.coefficients[0][i] * (
-                -(nfp * 2 * pi * i) * np.sin(nfp * 2 * pi * i * points) * np.cos(2 * pi * points)
-                -(2 * pi) *           np.cos(nfp * 2 * pi * i * points) * np.sin(2 * pi * points)
+                -(nfp * 2 * pi * i) * sin_nfp[:, i] * cos_
+                -(2 * pi) *           cos_nfp[:, i] * sin_
             )
             dgamma_by_dphi[:, 0, 1] += self.coefficients[0][i] * (
-                -(nfp * 2 * pi * i) * np.sin(nfp * 2 * pi * i * points) * np.sin(2 * pi * points)
-                +(2 * pi) *           np.cos(nfp * 2 * pi * i * points) * np.cos(2 * pi * points)
+                -(nfp * 2 * pi * i) * sin_nfp[:, i] * sin_
+                +(2 * pi) *           cos_nfp[:, i] * cos_
             )
         for i in range(1, self.order+1):
-            dgamma_by_dphi[:, 0, 2] += self.coefficients[1][i-1] * (nfp * 2 * pi * i) * np.cos(nfp * 2 * pi * i * points)
+            dgamma_by_dphi[:, 0, 2] += self.coefficients[1][i-1] * (nfp * 2 * pi * i) * cos_nfp[:, i]
         return dgamma_by_dphi
 
-    @cached_property
+    @curve_property
     def d2gamma_by_dphidcoeff(self):
         d2gamma_by_dphidcoeff = np.zeros((len(self.points), 1, self.num_coeff(), 3))
         nfp = self.nfp
+        cos_nfp, sin_nfp, cos_, sin_ = cylindrical_fourier_basis(self.points, self.order, nfp)
         points = self.points
         for i in range(self.order+1):
             d2gamma_by_dphidcoeff[:, 0, i, 0] = (
-                -(nfp * 2 * pi * i) * np.sin(nfp * 2 * pi * i * points) * np.cos(2 * pi * points)
-                -(2 * pi) *           np.cos(nfp * 2 * pi * i * points) * np.sin(2 * pi * points)
+                -(nfp * 2 * pi * i) * sin_nfp[:, i] * cos_
+                -(2 * pi) *           cos_nfp[:, i] * sin_
             )
             d2gamma_by_dphidcoeff[:, 0, i, 1] = (
-                -(nfp * 2 * pi * i) * np.sin(nfp * 2 * pi * i * points) * np.sin(2 * pi * points)
-                +(2 * pi) *           np.cos(nfp * 2 * pi * i * points) * np.cos(2 * pi * points)
+                -(nfp * 2 * pi * i) * sin_nfp[:, i] * sin_
+                +(2 * pi) *           cos_nfp[:, i] * cos_
             )
         for i in range(1, self.order+1):
-            d2gamma_by_dphidcoeff[:, 0, self.order + i, 2] = (nfp * 2 * pi * i) * np.cos(nfp * 2 * pi * i * points)
+            d2gamma_by_dphidcoeff[:, 0, self.order + i, 2] = (nfp * 2 * pi * i) * cos_nfp[:, i]
         return d2gamma_by_dphidcoeff
 
-    @cached_property
+    @curve_property
     def d2gamma_by_dphidphi(self):
         d2gamma_by_dphidphi = np.zeros((len(self.points), 1, 1, 3))
         points = self.points
         coeffs = self.coefficients
         nfp = self.nfp
+        cos_nfp, sin_nfp, cos_, sin_ = cylindrical_fourier_basis(self.points, self.order, nfp)
         for i in range(self.order+1):
             d2gamma_by_dphidphi[:, 0, 0, 0] += self.coefficients[0][i] * (
-                +2*(nfp * 2 * pi * i)*(2 * pi) *       np.sin(nfp * 2 * pi * i * points) * np.sin(2 * pi * points)
-                -((nfp * 2 * pi * i)**2 + (2*pi)**2) * np.cos(nfp * 2 * pi * i * points) * np.cos(2 * pi * points)
+                +2*(nfp * 2 * pi * i)*(2 * pi) *       sin_nfp[:, i] * sin_
+                -((nfp * 2 * pi * i)**2 + (2*pi)**2) * cos_nfp[:, i] * cos_
             )
             d2gamma_by_dphidphi[:, 0, 0, 1] += self.coefficients[0][i] * (
-                -2*(nfp * 2 * pi * i) * (2 * pi) *     np.sin(nfp * 2 * pi * i * points) * np.cos(2 * pi * points)
-                -((nfp * 2 * pi * i)**2 + (2*pi)**2) * np.cos(nfp * 2 * pi * i * points) * np.sin(2 * pi * points)
+                -2*(nfp * 2 * pi * i) * (2 * pi) *     sin_nfp[:, i] * cos_
+                -((nfp * 2 * pi * i)**2 + (2*pi)**2) * cos_nfp[:, i] * sin_
             )
         for i in range(1, self.order+1):
-            d2gamma_by_dphidphi[:, 0, 0, 2] -= self.coefficients[1][i-1] * (nfp * 2 * pi * i)**2 * np.sin(nfp * 2 * pi * i * points)
+            d2gamma_by_dphidphi[:, 0, 0, 2] -= self.coefficients[1][i-1] * (nfp * 2 * pi * i)**2 * sin_nfp[:, i]
         return d2gamma_by_dphidphi
 
-    @cached_property
+    @curve_property
     def d3gamma_by_dphidphidphi(self):
         d3gamma_by_dphidphidphi = np.zeros((len(self.points), 1, 1, 1, 3))
         points = self.points
         coeffs = self.coefficients
         nfp = self.nfp
+        cos_nfp, sin_nfp, cos_, sin_ = cylindrical_fourier_basis(self.points, self.order, nfp)
         for i in range(self.order+1):
             d3gamma_by_dphidphidphi[:, 0, 0, 0, 0] += self.coefficients[0][i] * (
-                +2*(nfp * 2 * pi * i)**2*(2 * pi) *       np.cos(nfp * 2 * pi * i * points) * np.sin(2 * pi * points)
-                +2*(nfp * 2 * pi * i)*(2 * pi)**2 *       np.sin(nfp * 2 * pi * i * points) * np.cos(2 * pi * points)
-                +((nfp * 2 * pi * i)**2 + (2*pi)**2)*(nfp * 2 * pi * i)* np.sin(nfp * 2 * pi * i * points) * np.cos(2 * pi * points)
-                +((nfp * 2 * pi * i)**2 + (2*pi)**2)*(2 * pi)*           np.cos(nfp * 2 * pi * i * points) * np.sin(2 * pi * points)
+                +2*(nfp * 2 * pi * i)**2*(2 * pi) *       cos_nfp[:, i] * sin_
+                +2*(nfp * 2 * pi * i)*(2 * pi)**2 *       sin_nfp[:, i] * cos_
+                +((nfp * 2 * pi * i)**2 + (2*pi)**2)*(nfp * 2 * pi * i)* sin_nfp[:, i] * cos_
+                +((nfp * 2 * pi * i)**2 + (2*pi)**2)*(2 * pi)*           cos_nfp[:, i] * sin_
             )
             d3gamma_by_dphidphidphi[:, 0, 0, 0, 1] += self.coefficients[0][i] * (
-                -2*(nfp * 2 * pi * i)**2 * (2 * pi) *     np.cos(nfp * 2 * pi * i * points) * np.cos(2 * pi * points)
-                +2*(nfp * 2 * pi * i) * (2 * pi)**2 *     np.sin(nfp * 2 * pi * i * points) * np.sin(2 * pi * points)
-                +((nfp * 2 * pi * i)**2 + (2*pi)**2) * (nfp * 2 * pi * i) * np.sin(nfp * 2 * pi * i * points) * np.sin(2 * pi * points)
-                -((nfp * 2 * pi * i)**2 + (2*pi)**2) * (2 * pi) *           np.cos(nfp * 2 * pi * i * points) * np.cos(2 * pi * points)
+                -2*(nfp * 2 * pi * i)**2 * (2 * pi) *     cos_nfp[:, i] * cos_
+                +2*(nfp * 2 * pi * i) * (2 * pi)**2 *     sin_nfp[:, i] * sin_
+                +((nfp * 2 * pi * i)**2 + (2*pi)**2) * (nfp * 2 * pi * i) * sin_nfp[:, i] * sin_
+                -((nfp * 2 * pi * i)**2 + (2*pi)**2) * (2 * pi) *           cos_nfp[:, i] * cos_
             )
         for i in range(1, self.order+1):
-            d3gamma_by_dphidphidphi[:, 0, 0, 0, 2] -= self.coefficients[1][i-1] * (nfp * 2 * pi * i)**3 * np.cos(nfp * 2 * pi * i * points)
+            d3gamma_by_dphidphidphi[:, 0, 0, 0, 2] -= self.coefficients[1][i-1] * (nfp * 2 * pi * i)**3 * cos_nfp[:, i]
         return d3gamma_by_dphidphidphi
 
-    @cached_property
+    @curve_property
     def d3gamma_by_dphidphidcoeff(self):
         d3gamma_by_dphidphidcoeff = np.zeros((len(self.points), 1, 1, self.num_coeff(), 3))
         points = self.points
         nfp = self.nfp
+        cos_nfp, sin_nfp, cos_, sin_ = cylindrical_fourier_basis(self.points, self.order, nfp)
         for i in range(self.order+1):
             d3gamma_by_dphidphidcoeff[:, 0, 0, i, 0] = (
-                -(nfp * 2 * pi * i)**2 *       np.cos(nfp * 2 * pi * i * points) * np.cos(2 * pi * points)
-                +(nfp * 2 * pi * i)*(2 * pi) * np.sin(nfp * 2 * pi * i * points) * np.sin(2 * pi * points)
-                +(nfp * 2 * pi * i)*(2 * pi) * np.sin(nfp * 2 * pi * i * points) * np.sin(2 * pi * points)
-                -(2 * pi)**2 *                 np.cos(nfp * 2 * pi * i * points) * np.cos(2 * pi * points)
+                -(nfp * 2 * pi * i)**2 *       cos_nfp[:, i] * cos_
+                +(nfp * 2 * pi * i)*(2 * pi) * sin_nfp[:, i] * sin_
+                +(nfp * 2 * pi * i)*(2 * pi) * sin_nfp[:, i] * sin_
+                -(2 * pi)**2 *                 cos_nfp[:, i] * cos_
             )
             d3gamma_by_dphidphidcoeff[:, 0, 0, i, 1] = (
-                -(nfp * 2 * pi * i)**2 *         np.cos(nfp * 2 * pi * i * points) * np.sin(2 * pi * points)
-                -(nfp * 2 * pi * i) * (2 * pi) * np.sin(nfp * 2 * pi * i * points) * np.cos(2 * pi * points)
-                -(2 * pi) * (nfp * 2 * pi * i) * np.sin(nfp * 2 * pi * i * points) * np.cos(2 * pi * points)
-                -(2 * pi)**2 *                   np.cos(nfp * 2 * pi * i * points) * np.sin(2 * pi * points)
+                -(nfp * 2 * pi * i)**2 *         cos_nfp[:, i] * sin_
+                -(nfp * 2 * pi * i) * (2 * pi) * sin_nfp[:, i] * cos_
+                -(2 * pi) * (nfp * 2 * pi * i) * sin_nfp[:, i] * cos_
+                -(2 * pi)**2 *                   cos_nfp[:, i] * sin_
             )
         for i in range(1, self.order+1):
-            d3gamma_by_dphidphidcoeff[:, 0, 0, self.order + i, 2] = -(nfp * 2 * pi * i)**2 * np.sin(nfp * 2 * pi * i * points)
+            d3gamma_by_dphidphidcoeff[:, 0, 0, self.order + i, 2] = -(nfp * 2 * pi * i)**2 * sin_nfp[:, i]
         return d3gamma_by_dphidphidcoeff
 
-    @cached_property
+    @curve_property
     def d4gamma_by_dphidphidphidcoeff(self):
         d4gamma_by_dphidphidphidcoeff = np.zeros((len(self.points), 1, 1, 1, self.num_coeff(), 3))
         points = self.points
         nfp = self.nfp
+        cos_nfp, sin_nfp, cos_, sin_ = cylindrical_fourier_basis(self.points, self.order, nfp)
         for i in range(self.order+1):
             d4gamma_by_dphidphidphidcoeff[:, 0, 0, 0, i, 0] = (
-                +2*(nfp * 2 * pi * i)**2*(2 * pi) *       np.cos(nfp * 2 * pi * i * points) * np.sin(2 * pi * points)
-                +2*(nfp * 2 * pi * i)*(2 * pi)**2 *       np.sin(nfp * 2 * pi * i * points) * np.cos(2 * pi * points)
-                +((nfp * 2 * pi * i)**2 + (2*pi)**2)*(nfp * 2 * pi * i)* np.sin(nfp * 2 * pi * i * points) * np.cos(2 * pi * points)
-                +((nfp * 2 * pi * i)**2 + (2*pi)**2)*(2 * pi)*           np.cos(nfp * 2 * pi * i * points) * np.sin(2 * pi * points)
+                +2*(nfp * 2 * pi * i)**2*(2 * pi) *       cos_nfp[:, i] * sin_
+                +2*(nfp * 2 * pi * i)*(2 * pi)**2 *       sin_nfp[:, i] * cos_
+                +((nfp * 2 * pi * i)**2 + (2*pi)**2)*(nfp * 2 * pi * i)* sin_nfp[:, i] * cos_
+                +((nfp * 2 * pi * i)**2 + (2*pi)**2)*(2 * pi)*           cos_nfp[:, i] * sin_
             )
             d4gamma_by_dphidphidphidcoeff[:, 0, 0, 0, i, 1] = (
-                -2*(nfp * 2 * pi * i)**2 * (2 * pi) *     np.cos(nfp * 2 * pi * i * points) * np.cos(2 * pi * points)
-                +2*(nfp * 2 * pi * i) * (2 * pi)**2 *     np.sin(nfp * 2 * pi * i * points) * np.sin(2 * pi * points)
-                +((nfp * 2 * pi * i)**2 + (2*pi)**2) * (nfp * 2 * pi * i) * np.sin(nfp * 2 * pi * i * points) * np.sin(2 * pi * points)
-                -((nfp * 2 * pi * i)**2 + (2*pi)**2) * (2 * pi) *           np.cos(nfp * 2 * pi * i * points) * np.cos(2 * pi * points)
+                -2*(nfp * 2 * pi * i)**2 * (2 * pi) *     cos_nfp[:, i] * cos_
+                +2*(nfp * 2 * pi * i) * (2 * pi)**2 *     sin_nfp[:, i] * sin_
+                +((nfp * 2 * pi * i)**2 + (2*pi)**2) * (nfp * 2 * pi * i) * sin_nfp[:, i] * sin_
+                -((nfp * 2 * pi * i)**2 + (2*pi)**2) * (2 * pi) *           cos_nfp[:, i] * cos_
             )
         for i in range(1, self.order+1):
-            d4gamma_by_dphidphidphidcoeff[:, 0, 0, 0, self.order + i, 2] = -(nfp * 2 * pi * i)**3 * np.cos(nfp * 2 * pi * i * points)
+            d4gamma_by_dphidphidphidcoeff[:, 0, 0, 0, self.order + i, 2] = -(nfp * 2 * pi * i)**3 * cos_nfp[:, i]
         return d4gamma_by_dphidphidphidcoeff
 
 class RotatedCurve(Curve):
@@ -604,83 +742,262 @@ class RotatedCurve(Curve):
         if flip:
             self.rotmat = self.rotmat @ np.asarray([[1,0,0],[0,-1,0],[0,0,-1]])
         self.curve = curve
-        curve.dependencies.append(self)
-        self.update()
+
+    def state(self):
+        return (self.version, self.curve.state())
 
     def num_coeff(self):
         return self.curve.num_coeff()
 
-    @cached_property
+    @curve_property
     def gamma(self):
         return self.curve.gamma @ self.rotmat
 
-    @cached_property
+    @curve_property
     def dgamma_by_dphi(self):
         return self.curve.dgamma_by_dphi @ self.rotmat
 
-    @cached_property
+    @curve_property
     def d2gamma_by_dphidphi(self):
         return self.curve.d2gamma_by_dphidphi @ self.rotmat
 
-    @cached_property
+    @curve_property
     def dgamma_by_dcoeff(self):
         return self.curve.dgamma_by_dcoeff @ self.rotmat
 
-    @cached_property
+    @curve_property
     def d2gamma_by_dphidcoeff(self):
         return self.curve.d2gamma_by_dphidcoeff @ self.rotmat
 
-    @cached_property
+    @curve_property
     def d3gamma_by_dphidphidcoeff(self):
         return self.curve.d3gamma_by_dphidphidcoeff @ self.rotmat
 
-    @cached_property
+    @curve_property
     def d4gamma_by_dphidphidphidcoeff(self):
         return self.curve.d4gamma_by_dphidphidphidcoeff @ self.rotmat
 
+    def dgamma_by_dcoeff_vjp(self, v):
+        return self.curve.dgamma_by_dcoeff_vjp(v @ self.rotmat.T)
+
+    def d2gamma_by_dphidcoeff_vjp(self, v):
+        return self.curve.d2gamma_by_dphidcoeff_vjp(v @ self.rotmat.T)
+
+    def d3gamma_by_dphidphidcoeff_vjp(self, v):
+        return self.curve.d3gamma_by_dphidphidcoeff_vjp(v @ self.rotmat.T)
+
+    def d4gamma_by_dphidphidphidcoeff_vjp(self, v):
+        return self.curve.d4gamma_by_dphidphidphidcoeff_vjp(v @ self.rotmat.T)
+
 
 class GaussianSampler():
+    r"""
+    Samples a periodic Gaussian process f : [0, 1) \to R^3 with independent
+    components and covariance
+        k(x, y) = \sum_{i=-2}^{2} \sigma^2 \exp(-(x-y+i)^2/l^2)
+    together with its first `n_derivs` derivatives at `points`.
+
+    With `method="dense"` the square root L of the joint covariance matrix of
+    size (n_derivs+1) n is computed once and every sample costs a dense matvec.
+    On a uniform grid every block of this matrix is circulant, so it is
+    diagonalised by the FFT and only a (n_derivs+1)x(n_derivs+1) matrix has to
+    be factorised per frequency; `method="fft"` then draws samples in
+    O(n log n) and stores O(n) numbers. Both methods apply the symmetric
+    square root of the covariance to the same normal random numbers, so the
+    samples have the same distribution and agree closely for the same random
+    numbers; as the covariance is numerically singular, the per frequency
+    square root is the more accurate of the two. `method="auto"` uses the FFT
+    whenever `points` is uniform.
+
+    `method="kl"` uses a truncated Karhunen-Loeve expansion instead,
+        f(x) = \sqrt{a_0} \xi_0 + \sum_{m=1}^{K} \sqrt{2 a_m} (\xi_m \cos(2\pi m x) + \eta_m \sin(2\pi m x)),
+    where a_m are the Fourier coefficients of k. The number of modes K is the
+    smallest such that the neglected modes carry at most a fraction `tol` of
+    the variance of f and of each of its derivatives. A sample then consists
+    of only 2K+1 normal random numbers per component, see `LowRankSample`,
+    and does not require uniformly spaced points. `kl_modes` fixes K instead,
+    see `at_points`.
+    """
 
-    def __init__(self, points, sigma, length_scale, n_derivs=3):
+    def __init__(self, points, sigma, length_scale, n_derivs=3, method="auto", tol=1e-10, kl_modes=None):
         self.points = points
         xs = self.points
         n = len(xs)
         self.n_derivs = n_derivs
+        self.sigma = sigma
+        self.length_scale = length_scale
+        uniform = np.allclose(xs, np.linspace(0, 1, n, endpoint=False), rtol=0, atol=1e-13)
+        if method == "auto":
+            method = "fft" if uniform else "dense"
+        if method not in ["dense", "fft", "kl"]:
+            raise ValueError("Unknown method %s" % method)
+        if method == "fft" and not uniform:
+            raise ValueError("The fft method requires uniformly spaced points in [0, 1).")
+        self.method = method
+        # number of standard normal numbers drawn by `sample`
+        self.dimension = 3*n*(n_derivs+1)
+        # the operators are shared by all samplers with the same parameters
+        key = (operator_cache.grid_key(xs), sigma, length_scale, n_derivs)
+        if method == "fft":
+            self.sqrt_symbol = operator_cache.get(("spectral_covariance_sqrt", ) + key, self.spectral_covariance_sqrt)
+            return
+        if method == "kl":
+            self.basis = operator_cache.get(("karhunen_loeve_basis", ) + key + (tol, kl_modes), lambda: self.karhunen_loeve_basis(tol, kl_modes))
+            self.rank = self.basis[0].shape[1]
+            self.kl_modes = (self.rank - 1)//2
+            self.dimension = 3*self.rank
+            return
+        self.L = operator_cache.get(("covariance_sqrt", ) + key, self.covariance_sqrt)
+
+    def covariance_sqrt(self):
+        """
+        The symmetric square root of the joint covariance matrix of the
+        process and its derivatives at `points`.
+        """
+        xs = self.points
+        n = len(xs)
+        n_derivs = self.n_derivs
+        # x_i - x_j, folded into [-0.5, 0.5]
+        u = np.subtract.outer(xs, xs)
+        u[u > 0.5] -= 1
+        u[u < -0.5] += 1
         cov_mat = np.zeros((n*(n_derivs+1), n*(n_derivs+1)))
-        def kernel(x, y):
-            return sum(sigma**2*exp(-(x-y+i)**2/length_scale**2) for i in range(-2, 3))
         for ii in range(n_derivs+1):
             for jj in range(n_derivs+1):
-                if ii + jj == 0:
-                    lam = kernel
-                else:
-                    x = Symbol("x")
-                    y = Symbol("y")
-                    f = kernel(x, y)
-                    lam = lambdify((x, y), f.diff(*(ii * [x] + jj * [y])))
-                for i in range(n):
-                    for j in range(n):
-                        x = xs[i]
-                        y = xs[j]
-                        if abs(x-y)>0.5:
-                            if y>0.5:
-                                y -= 1
-                            else:
-                                x-= 1
-                        cov_mat[ii*n + i, jj*n + j] = lam(x, y)
+                cov_mat[ii*n:(ii+1)*n, jj*n:(jj+1)*n] = (-1)**jj * self.kernel_derivative(u, ii+jj)
 
         from scipy.linalg import sqrtm
-        self.L = np.real(sqrtm(cov_mat))
+        return np.real(sqrtm(cov_mat))
+
+    def kernel_derivative(self, u, order):
+        r"""
+        The `order`-th derivative of k(u) = \sum_i \sigma^2 \exp(-(u+i)^2/l^2),
+        using d^k/ds^k \exp(-s^2) = (-1)^k H_k(s) \exp(-s^2) with the Hermite
+        polynomials H_k.
+        """
+        from numpy.polynomial.hermite import hermval
+        l = self.length_scale
+        coeffs = np.zeros((order+1, ))
+        coeffs[order] = 1.
+        res = np.zeros_like(u)
+        for i in range(-2, 3):
+            s = (u+i)/l
+            res += hermval(s, coeffs) * np.exp(-s**2)
+        return self.sigma**2 * (-1./l)**order * res
+
+    def spectral_covariance_sqrt(self):
+        """
+        The covariance of the a-th and b-th derivative at x_i and x_j is
+        (-1)^b k^{(a+b)}(x_i-x_j), i.e. circulant in (i, j). Returns the
+        symmetric square roots of the (n_derivs+1)x(n_derivs+1) blocks of
+        eigenvalues, one per frequency.
+        """
+        n = len(self.points)
+        nblocks = self.n_derivs + 1
+        u = np.arange(n)/n
+        u[u > 0.5] -= 1
+        symbol = np.zeros((n, nblocks, nblocks), dtype=complex)
+        for a in range(nblocks):
+            for b in range(nblocks):
+                symbol[:, a, b] = np.fft.fft((-1)**b * self.kernel_derivative(u, a+b))
+        eigvals, eigvecs = np.linalg.eigh(symbol)
+        eigvals = np.sqrt(np.maximum(eigvals, 0))
+        return np.einsum('kab,kb,kcb->kac', eigvecs, eigvals, eigvecs.conj())
+
+    def karhunen_loeve_basis(self, tol, K=None):
+        """
+        Returns for every derivative d the (n, 2K+1) matrix whose columns are
+        the d-th derivatives of the scaled Karhunen-Loeve modes at `points`,
+        ordered by frequency. K is chosen by `tol` unless it is given.
+        """
+        # Fourier coefficients of the periodised kernel (Poisson summation),
+        # k(u) = \sum_m a_m \exp(2 \pi i m u)
+        l = self.length_scale
+        m = np.arange(max(len(self.points), int(10/l), (K or 0)+1))
+        a = self.sigma**2 * l * np.sqrt(pi) * np.exp(-(pi*m*l)**2)
+        weights = np.where(m == 0, 1., 2.) * a
+        if K is None:
+            K = 0
+            for d in range(self.n_derivs+1):
+                energy = weights * (2*pi*m)**(2*d)
+                tail = np.cumsum(energy[::-1])[::-1]
+                small = np.nonzero(tail <= tol * tail[0])[0]
+                K = max(K, small[0]-1 if len(small) > 0 else len(a)-1)
+        omega = 2*pi*np.arange(1, K+1)
+        x = np.asarray(self.points)[:, None] * omega[None, :]
+        scale = np.sqrt(2*a[1:K+1])
+        basis = []
+        for d in range(self.n_derivs+1):
+            const = np.full((len(self.points), 1), np.sqrt(a[0]) if d == 0 else 0.)
+            cos_d = scale * omega**d * np.cos(x + d*pi/2)
+            sin_d = scale * omega**d * np.sin(x + d*pi/2)
+            # ordered by decreasing variance, cos and sin of each frequency interleaved
+            basis.append(np.concatenate((const, np.stack((cos_d, sin_d), axis=2).reshape((len(self.points), 2*K))), axis=1))
+        return basis
 
     def sample(self, randomgen=None):
         n = len(self.points)
         n_derivs = self.n_derivs
         if randomgen is None:
             randomgen = np.random
+        if self.method == "kl":
+            return LowRankSample(self.basis, randomgen.standard_normal(size=(self.rank, 3)))
         z = randomgen.standard_normal(size=(n*(n_derivs+1), 3))
-        curve_and_derivs = self.L@z
-        return curve_and_derivs[0:n, :], curve_and_derivs[n:2*n, :], \
-            curve_and_derivs[2*n:3*n, :], curve_and_derivs[3*n:4*n, :]
+        if self.method == "fft":
+            zhat = np.fft.fft(z.reshape((n_derivs+1, n, 3)), axis=1)
+            curve_and_derivs = np.fft.ifft(np.einsum('kab,bkc->akc', self.sqrt_symbol, zhat), axis=1).real
+        else:
+            curve_and_derivs = (self.L@z).reshape((n_derivs+1, n, 3))
+        return tuple(curve_and_derivs[i] for i in range(n_derivs+1))
+
+    def at_points(self, points):
+        """
+        The same Gaussian process sampled at other `points`. For
+        `method="kl"` the returned sampler uses the same modes, so the same
+        normal numbers give the same perturbation, evaluated at `points`.
+        """
+        if self.method != "kl":
+            raise ValueError("Only the kl method can be evaluated at other points.")
+        return GaussianSampler(points, self.sigma, self.length_scale, n_derivs=self.n_derivs, method="kl", kl_modes=self.kl_modes)
+
+    def sample_vjp(self, v):
+        """
+        A sample is a linear function of the normal numbers z drawn by
+        `sample`. Given v[d], the derivative of a scalar with respect to the
+        d-th derivative of the sample, returns the derivative with respect to
+        z, flattened in the order in which the numbers are drawn. The trailing
+        derivatives may be omitted from `v`.
+        """
+        n = len(self.points)
+        nblocks = self.n_derivs + 1
+        v = np.concatenate((np.asarray(v).reshape((-1, n, 3)), np.zeros((nblocks - len(v), n, 3))), axis=0)
+        if self.method == "kl":
+            return sum(self.basis[d].T @ v[d] for d in range(nblocks)).ravel()
+        # the square roots of the covariance are symmetric
+        if self.method == "fft":
+            vhat = np.fft.fft(v, axis=1)
+            return np.fft.ifft(np.einsum('kab,bkc->akc', self.sqrt_symbol, vhat), axis=1).real.ravel()
+        return (self.L.T @ v.reshape((nblocks*n, 3))).ravel()
+
+
+class LowRankSample():
+    """
+    A sample of a `GaussianSampler` with `method="kl"`. Only the (rank, 3)
+    mode coefficients are stored, `sample[d]` evaluates the d-th derivative
+    of the perturbation at the sampler points as a product with the basis.
+    """
+
+    def __init__(self, basis, coefficients):
+        self.basis = basis
+        self.coefficients = coefficients
+
+    def __len__(self):
+        return len(self.basis)
+
+    def __getitem__(self, d):
+        if not 0 <= d < len(self.basis):
+            raise IndexError(d)
+        return self.basis[d] @ self.coefficients
 
 
 class GaussianPerturbedCurve(Curve):
@@ -689,7 +1006,6 @@ class GaussianPerturbedCurve(Curve):
         super().__init__(curve.points)
         self.curve = curve
         self.sampler = sampler
-        curve.dependencies.append(self)
         self.randomgen = randomgen
         self.sample = sampler.sample(self.randomgen)
 
@@ -697,6 +1013,9 @@ class GaussianPerturbedCurve(Curve):
         self.sample = self.sampler.sample(self.randomgen)
         self.update()
 
+    def state(self):
+        return (self.version, self.curve.state())
+
     def num_coeff(self):
         return self.curve.num_coeff()
 
@@ -706,34 +1025,46 @@ class GaussianPerturbedCurve(Curve):
     def set_dofs(self, x):
         return self.curve.set_dofs(x)
 
-    @cached_property
+    @curve_property
     def gamma(self):
         return self.curve.gamma + self.sample[0]
 
-    @cached_property
+    @curve_property
     def dgamma_by_dphi(self):
         return self.curve.dgamma_by_dphi + self.sample[1][:, None, :]
 
-    @cached_property
+    @curve_property
     def d2gamma_by_dphidphi(self):
         return self.curve.d2gamma_by_dphidphi + self.sample[2][:, None, None, :]
 
-    @cached_property
+    @curve_property
     def d3gamma_by_dphidphidphi(self):
         return self.curve.d3gamma_by_dphidphidphi + self.sample[3][:, None, None, None, :]
 
-    @cached_property
+    @curve_property
     def dgamma_by_dcoeff(self):
         return self.curve.dgamma_by_dcoeff
 
-    @cached_property
+    @curve_property
     def d2gamma_by_dphidcoeff(self):
         return self.curve.d2gamma_by_dphidcoeff
 
-    @cached_property
+    @curve_property
     def d3gamma_by_dphidphidcoeff(self):
         return self.curve.d3gamma_by_dphidphidcoeff
 
-    @cached_property
+    @curve_property
     def d4gamma_by_dphidphidphidcoeff(self):
         return self.curve.d4gamma_by_dphidphidphidcoeff
+
+    def dgamma_by_dcoeff_vjp(self, v):
+        return self.curve.dgamma_by_dcoeff_vjp(v)
+
+    def d2gamma_by_dphidcoeff_vjp(self, v):
+        return self.curve.d2gamma_by_dphidcoeff_vjp(v)
+
+    def d3gamma_by_dphidphidcoeff_vjp(self, v):
+        return self.curve.d3gamma_by_dphidphidcoeff_vjp(v)
+
+    def d4gamma_by_dphidphidphidcoeff_vjp(self, v):
+        return self.curve.d4gamma_by_dphidphidphidcoeff_vjp(v)
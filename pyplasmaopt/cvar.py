@@ -24,30 +24,52 @@ def soft_plus_dash(x, eps, method=2):
 class CVaR():
 
     def __init__(self, alpha, eps=0.1):
+        """
+        All methods take optional likelihood ratios `ratios` of the samples,
+        if these were drawn from a different distribution than the one the
+        CVaR is taken over, e.g. by importance sampling of the tail (see
+        `StochasticQuasiSymmetryObjective.set_tail_shift`). The means over the
+        samples are then weighted by the ratios.
+        """
         self.alpha = alpha
         self.eps = eps
 
-    def J(self, t, Jsamples):
-        return t + np.mean(soft_plus(Jsamples-t, self.eps))/(1-self.alpha)
+    def mean(self, values, ratios=None):
+        if ratios is None:
+            return np.mean(values)
+        return np.mean(np.asarray(ratios) * values)
+
+    def J(self, t, Jsamples, ratios=None):
+        return t + self.mean(soft_plus(Jsamples-t, self.eps), ratios)/(1-self.alpha)
     
-    def dJ_dt(self, t, Jsamples):
+    def dJ_dt(self, t, Jsamples, ratios=None):
         softplus_dash = soft_plus_dash(Jsamples-t, self.eps)
-        partial_t = np.asarray([1. - np.mean(softplus_dash)/(1-self.alpha)])
+        partial_t = np.asarray([1. - self.mean(softplus_dash, ratios)/(1-self.alpha)])
         return partial_t
 
-    def dJ_dx(self, t, Jsamples, dJsamples):
-        softplus_dash = soft_plus_dash(Jsamples-t, self.eps)
-        partial_x = np.mean(softplus_dash[:, None] * dJsamples, axis=0)/(1-self.alpha)
+    def dJ_dx(self, t, Jsamples, dJsamples, ratios=None):
+        partial_x = self.weights(t, Jsamples, ratios) @ np.asarray(dJsamples)
         return partial_x
 
-    def find_optimal_t(self, Jsamples, tinit=None):
+    def weights(self, t, Jsamples, ratios=None):
+        r"""
+        The weights w_i such that dJ_dx = \sum_i w_i dJsamples_i. They only
+        depend on the sample values, so the weighted sum of the gradients can
+        be formed where the gradients live, see
+        `StochasticQuasiSymmetryObjective.value_and_weighted_grad`.
+        """
+        Jsamples = np.asarray(Jsamples)
+        w = soft_plus_dash(Jsamples-t, self.eps)/((1-self.alpha) * len(Jsamples))
+        return w if ratios is None else np.asarray(ratios) * w
+
+    def find_optimal_t(self, Jsamples, tinit=None, ratios=None):
         if tinit is None:
             tinit = np.asarray([0.])
         else:
             tinit = np.asarray([tinit])
         from scipy.optimize import minimize
         def J(t):
-            return self.J(t, Jsamples), self.dJ_dt(t, Jsamples)
+            return self.J(t, Jsamples, ratios), self.dJ_dt(t, Jsamples, ratios)
         res = minimize(J, tinit, jac=True, method='BFGS', tol=1e-10, options={'maxiter': 100})
         t = res.x[0]
         return t
@@ -14,16 +14,15 @@ class BiotSavartQuasiSymmetricFieldDifference():
         arc_length = self.quasi_symmetric_field.magnetic_axis.incremental_arclength[:, 0]
         return np.sum(arc_length[:, None] * (Bbs-Bqs)**2)/len(arc_length)
 
-    def dJ_L2_by_dcoilcoefficients(self):
-        Bbs                = self.biotsavart.B
-        Bqs                = self.quasi_symmetric_field.B
-        dBbs_by_dcoilcoeff = self.biotsavart.dB_by_dcoilcoeffs
+    def dJ_L2_by_dB(self):
+        """ Derivative of J_L2 with respect to the Biot-Savart field at the axis points. """
+        Bbs        = self.biotsavart.B
+        Bqs        = self.quasi_symmetric_field.B
         arc_length = self.quasi_symmetric_field.magnetic_axis.incremental_arclength[:, 0]
-        res = []
-        temp = (Bbs-Bqs) * arc_length[:, None]
-        for dB in dBbs_by_dcoilcoeff:
-            res.append(np.einsum('ij,ikj->k', temp, dB) * 2 / len(arc_length))
-        return res
+        return (Bbs-Bqs) * arc_length[:, None] * 2 / len(arc_length)
+
+    def dJ_L2_by_dcoilcoefficients(self):
+        return self.biotsavart.B_vjp(self.dJ_L2_by_dB())
 
     def dJ_L2_by_dcoilcurrents(self):
         Bbs                   = self.biotsavart.B
@@ -70,16 +69,15 @@ class BiotSavartQuasiSymmetricFieldDifference():
         dBqs_by_dX = self.quasi_symmetric_field.dB_by_dX
         return np.sum(arc_length[:, None, None] * (dBbs_by_dX-dBqs_by_dX)**2)/len(arc_length)
 
-    def dJ_H1_by_dcoilcoefficients(self):
-        dBbs_by_dX            = self.biotsavart.dB_by_dX
-        d2Bbs_by_dXdcoilcoeff = self.biotsavart.d2B_by_dXdcoilcoeffs
-        dBqs_by_dX            = self.quasi_symmetric_field.dB_by_dX
+    def dJ_H1_by_ddB_by_dX(self):
+        """ Derivative of J_H1 with respect to the Biot-Savart field gradient at the axis points. """
+        dBbs_by_dX = self.biotsavart.dB_by_dX
+        dBqs_by_dX = self.quasi_symmetric_field.dB_by_dX
         arc_length = self.quasi_symmetric_field.magnetic_axis.incremental_arclength[:, 0]
-        res = []
-        temp = (arc_length[:, None, None])*(dBbs_by_dX-dBqs_by_dX)
-        for dB in d2Bbs_by_dXdcoilcoeff:
-            res.append(np.einsum('ijk,iljk->l', temp, dB) * 2 / len(arc_length))
-        return res
+        return (arc_length[:, None, None])*(dBbs_by_dX-dBqs_by_dX) * 2 / len(arc_length)
+
+    def dJ_H1_by_dcoilcoefficients(self):
+        return self.biotsavart.dB_by_dX_vjp(self.dJ_H1_by_ddB_by_dX())
 
     def dJ_H1_by_dcoilcurrents(self):
         dBbs_by_dX               = self.biotsavart.dB_by_dX
@@ -122,6 +120,55 @@ class BiotSavartQuasiSymmetricFieldDifference():
         res *= 1/arc_length.shape[0]
         return res
 
+    def value_and_grad(self, compute_derivative=True, coil_derivatives=True):
+        r"""
+        Evaluate J = (J_L2 + J_H1)/2 and all its derivatives in one pass,
+        sharing the residuals B_bs-B_qs and \nabla B_bs-\nabla B_qs between
+        the blocks. Returns `(J, dJ)` where `dJ` is `None` if
+        `compute_derivative` is false, and otherwise a dict with the entries
+
+            "B", "dB_by_dX":            dJ/dB_bs and dJ/d(\nabla B_bs) at the axis,
+            "etabar":                   dJ/deta_bar,
+            "magneticaxiscoefficients": dJ/d(axis coefficients),
+            "coilcoefficients":         list with dJ/d(coil coefficients) per coil,
+            "coilcurrents":             list with dJ/d(coil current) per coil.
+
+        The coil entries are skipped if `coil_derivatives` is false, e.g. when
+        the caller contracts "B" and "dB_by_dX" with the coils itself.
+        """
+        qsf            = self.quasi_symmetric_field
+        magnetic_axis  = qsf.magnetic_axis
+        arc_length     = magnetic_axis.incremental_arclength[:, 0]
+        weights        = arc_length/len(arc_length)
+        diff_B         = self.biotsavart.B - qsf.B
+        diff_dB_by_dX  = self.biotsavart.dB_by_dX - qsf.dB_by_dX
+        v     = weights[:, None] * diff_B
+        vgrad = weights[:, None, None] * diff_dB_by_dX
+        J = 0.5 * (np.sum(v * diff_B) + np.sum(vgrad * diff_dB_by_dX))
+        if not compute_derivative:
+            return J, None
+
+        dJ = {"B": v, "dB_by_dX": vgrad}
+        dJqs_by_detabar, dJqs_by_dcoeffs = qsf.B_and_dB_vjp(v, vgrad)
+        dJ["etabar"] = -dJqs_by_detabar
+
+        # the axis enters through the evaluation points of B_bs, through B_qs
+        # and through the arc length weights
+        dJ_by_dgamma = np.einsum('ij,ikj->ik', v, self.biotsavart.dB_by_dX) \
+            + np.einsum('ijk,ijlk->il', vgrad, self.biotsavart.d2B_by_dXdX)
+        dJ_by_dincremental_arclength = 0.5 * (np.sum(diff_B**2, axis=1) + np.sum(diff_dB_by_dX**2, axis=(1, 2)))/len(arc_length)
+        dJ_by_ddgamma_by_dphi = (dJ_by_dincremental_arclength/arc_length)[:, None] * magnetic_axis.dgamma_by_dphi[:, 0, :]
+        dJ["magneticaxiscoefficients"] = magnetic_axis.dgamma_by_dcoeff_vjp(dJ_by_dgamma) \
+            + magnetic_axis.d2gamma_by_dphidcoeff_vjp(dJ_by_ddgamma_by_dphi) \
+            - dJqs_by_dcoeffs
+
+        if coil_derivatives:
+            dJ["coilcoefficients"] = self.biotsavart.B_and_dB_vjp(v, vgrad)
+            dJ["coilcurrents"] = [
+                np.einsum('ij,ij', v, dB) + np.einsum('ijk,ijk', vgrad, d2B)
+                for (dB, d2B) in zip(self.biotsavart.dB_by_dcoilcurrents, self.biotsavart.d2B_by_dXdcoilcurrents)]
+        return J, dJ
+
 
 class SquaredMagneticFieldNormOnCurve(object):
 
@@ -452,27 +499,21 @@ class MinimumDistance():
         return res
 
     def dJ_by_dcoefficients(self):
-        res = []
+        dJ_by_dgammas = [np.zeros(curve.gamma.shape) for curve in self.curves]
         for i in range(len(self.curves)):
             gamma1 = self.curves[i].gamma
-            dgamma1 = self.curves[i].dgamma_by_dcoeff
-            numcoeff1 = self.curves[i].dgamma_by_dcoeff.shape[1]
-            res.append(np.zeros((numcoeff1, )))
             for j in range(i):
                 gamma2 = self.curves[j].gamma
-                dgamma2 = self.curves[j].dgamma_by_dcoeff
-                numcoeff2 = self.curves[j].dgamma_by_dcoeff.shape[1]
                 diffs = gamma1[:, None, :] - gamma2[None, :, :]
 
                 dists = np.sqrt(np.sum(diffs**2, axis=2))
                 if np.sum(np.maximum(self.minimum_distance - dists, 0)) < 1e-15:
                     continue
 
-                for ii in range(numcoeff1):
-                    res[i][ii] += np.sum(-2 * np.maximum(self.minimum_distance - dists, 0) * np.sum(dgamma1[:, ii, :][:, None, :] * diffs, axis=2)/dists)/(gamma1.shape[0]*gamma2.shape[0])
-                for jj in range(numcoeff2):
-                    res[j][jj] -= np.sum(-2 * np.maximum(self.minimum_distance - dists, 0) * np.sum(dgamma2[:, jj, :][None, :, :] * diffs, axis=2)/dists)/(gamma1.shape[0]*gamma2.shape[0])
-        return res
+                temp = (-2 * np.maximum(self.minimum_distance - dists, 0)/dists)[:, :, None] * diffs/(gamma1.shape[0]*gamma2.shape[0])
+                dJ_by_dgammas[i] += np.sum(temp, axis=1)
+                dJ_by_dgammas[j] -= np.sum(temp, axis=0)
+        return [curve.dgamma_by_dcoeff_vjp(dJ_by_dgamma) for (curve, dJ_by_dgamma) in zip(self.curves, dJ_by_dgammas)]
 
 class CoilLpReduction():
 
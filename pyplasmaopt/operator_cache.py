@@ -0,0 +1,82 @@
+import numpy as np
+from collections import OrderedDict
+
+
+class OperatorCache():
+
+    def __init__(self, maxbytes=2**28):
+        """
+        A size bounded cache for operators that only depend on a grid and a
+        few integers, e.g. Fourier bases, differentiation matrices and
+        covariance square roots, so that the many curves, samples and fields
+        of a stochastic run that use the same grid share one copy. The least
+        recently used entries are evicted once the cached arrays take more
+        than `maxbytes` bytes. Cached arrays are returned read-only.
+        """
+        self.maxbytes = maxbytes
+        self.entries = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def grid_key(points):
+        """ A hashable key for the grid `points`. """
+        points = np.ascontiguousarray(points, dtype=np.float64)
+        return (points.shape, points.tobytes())
+
+    def get(self, key, compute):
+        """
+        Returns the operator stored under `key`, calling `compute()` to create
+        it if it is not cached. `compute` may return an array or a tuple or
+        list of arrays.
+        """
+        if key in self.entries:
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return self.entries[key][0]
+        self.misses += 1
+        value = compute()
+        arrays = value if isinstance(value, (tuple, list)) else (value, )
+        size = 0
+        for arr in arrays:
+            arr.flags.writeable = False
+            size += arr.nbytes
+        if size <= self.maxbytes:
+            self.entries[key] = (value, size)
+            self.nbytes += size
+            self.evict(self.maxbytes)
+        return value
+
+    def evict(self, maxbytes):
+        while self.nbytes > maxbytes:
+            _, (_, size) = self.entries.popitem(last=False)
+            self.nbytes -= size
+            self.evictions += 1
+
+    def resize(self, maxbytes):
+        self.maxbytes = maxbytes
+        self.evict(maxbytes)
+
+    def clear(self):
+        self.entries.clear()
+        self.nbytes = 0
+
+    def info(self):
+        """
+        Returns the number of entries, their memory footprint in bytes and the
+        hit, miss and eviction counts since the cache was created.
+        """
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self.entries), "nbytes": self.nbytes, "maxbytes": self.maxbytes,
+            "hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+            "hit_rate": self.hits/lookups if lookups > 0 else 0.
+        }
+
+    def __len__(self):
+        return len(self.entries)
+
+
+operator_cache = OperatorCache()
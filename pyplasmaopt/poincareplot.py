@@ -1,5 +1,4 @@
 import numpy as np
-import cppplasmaopt as cpp
 
 def compute_field_lines(biotsavart, nperiods=200, batch_size=8, magnetic_axis_radius=1, max_thickness=0.5, delta=0.01, steps_per_period=100):
 
@@ -10,8 +9,6 @@ def compute_field_lines(biotsavart, nperiods=200, batch_size=8, magnetic_axis_ra
         xyz[:, 2] = rphiz[:, 2]
         return xyz
 
-    gammas                 = [coil.gamma for coil in biotsavart.coils]
-    dgamma_by_dphis        = [coil.dgamma_by_dphi[:, 0, :] for coil in biotsavart.coils]
     largest = [0.]
 
     def rhs(phi, rz):
@@ -25,8 +22,9 @@ def compute_field_lines(biotsavart, nperiods=200, batch_size=8, magnetic_axis_ra
         rphiz[:, 2] = rz[:, 1]
         xyz = cylindrical_to_cartesian(rphiz)
 
-        Bxyz = np.zeros((nparticles, 3))
-        cpp.biot_savart_B_only(xyz, gammas, dgamma_by_dphis, biotsavart.coil_currents, Bxyz)
+        # the field lines stay inside the coil set, where the treecode is
+        # slower than the direct kernel
+        Bxyz = biotsavart.evaluate(xyz, backend="direct")
 
         rhs_xyz = np.zeros((nparticles, 3))
         rhs_xyz[:, 0] = Bxyz[:, 0]
@@ -100,10 +98,7 @@ def compute_field_lines(biotsavart, nperiods=200, batch_size=8, magnetic_axis_ra
 
 
     absB = np.zeros((nparticles, nt))
-    tmp = np.zeros((nt, 3))
     for j in range(nparticles):
-        tmp[:] = 0
-        cpp.biot_savart_B_only(xyz[j, :, :], gammas, dgamma_by_dphis, biotsavart.coil_currents, tmp)
-        absB[j, :] = np.linalg.norm(tmp, axis=1)
+        absB[j, :] = np.linalg.norm(biotsavart.evaluate(xyz[j, :, :], backend="direct"), axis=1)
 
     return rphiz, xyz, absB, phi_no_mod[:-1]
@@ -2,7 +2,10 @@ from .biotsavart import BiotSavart
 from .quasi_symmetric_field import QuasiSymmetricField
 from .objective import BiotSavartQuasiSymmetricFieldDifference, CurveLength, CurveTorsion, CurveCurvature, SobolevTikhonov, UniformArclength, MinimumDistance, CoilLpReduction
 from .curve import GaussianSampler
-from .stochastic_objective import StochasticQuasiSymmetryObjective, CVaR
+from .stochastic_objective import StochasticQuasiSymmetryObjective, MultilevelStochasticQuasiSymmetryObjective, CVaR
+from .control_variate import ControlVariate
+from .sample_size import NormTest
+from .operator_cache import operator_cache
 from .logging import info
 
 from mpi4py import MPI
@@ -17,20 +20,43 @@ class NearAxisQuasiSymmetryObjective():
                  curvature_weight=1e-6, torsion_weight=1e-4, tikhonov_weight=0., arclength_weight=0., sobolev_weight=0.,
                  minimum_distance=0.04, distance_weight=1.,
                  ninsamples=0, noutsamples=0, sigma_perturb=1e-4, length_scale_perturb=0.2, mode="deterministic",
-                 outdir="output/", seed=1
+                 outdir="output/", seed=1, sample_chunk_size=None, sample_cache_size=None, linearised_samples=False,
+                 sampling="mc", control_variate=False, importance_sampling=False,
+                 ninsamples_initial=None, sample_size_theta=0.5,
+                 mlmc_nquadpoints=None, mlmc_nsamples=None, mlmc_tol=None
                  ):
         self.stellarator = stellarator
         self.seed = seed
         self.ma = ma
-        bs = BiotSavart(stellarator.coils, stellarator.currents)
+        bs = BiotSavart(stellarator._base_coils, stellarator._base_currents, symmetries=stellarator.symmetries)
         self.biotsavart = bs
         self.biotsavart.set_points(self.ma.gamma)
         qsf = QuasiSymmetricField(eta_bar, ma)
         self.qsf = qsf
         sigma = qsf.sigma
         iota = qsf.iota
-        self.ninsamples = ninsamples
         self.noutsamples = noutsamples
+        # with `mlmc_nquadpoints` the in-sample estimates are multilevel Monte
+        # Carlo estimates over coarser coil discretisations, see
+        # `MultilevelStochasticQuasiSymmetryObjective`
+        multilevel = mlmc_nquadpoints is not None and mode != "deterministic"
+        if multilevel:
+            conflicting = [name for (name, used) in [
+                ("control_variate", control_variate), ("importance_sampling", importance_sampling),
+                ("ninsamples_initial", ninsamples_initial is not None)] if used]
+            if conflicting:
+                raise ValueError("mlmc_nquadpoints cannot be combined with %s." % ", ".join(conflicting))
+        # in stochastic mode the optimisation can start with
+        # `ninsamples_initial` samples, which are increased up to `ninsamples`
+        # by the norm test
+        self.sample_size_test = None
+        if ninsamples_initial is not None and mode == "stochastic":
+            if control_variate:
+                raise ValueError("ninsamples_initial and control_variate cannot be combined.")
+            self.sample_size_test = NormTest(ninsamples, theta=sample_size_theta)
+            ninsamples = min(ninsamples_initial, ninsamples)
+        self.ninsamples = ninsamples
+        self.next_ninsamples = ninsamples
 
         self.J_BSvsQS          = BiotSavartQuasiSymmetricFieldDifference(qsf, bs)
         coils = stellarator._base_coils
@@ -68,14 +94,34 @@ class NearAxisQuasiSymmetryObjective():
         self.arclength_weight = arclength_weight
         self.distance_weight = distance_weight
 
-        sampler = GaussianSampler(coils[0].points, length_scale=length_scale_perturb, sigma=sigma_perturb)
+        # the quasi random designs need a sampler with few random numbers per
+        # sample, the multilevel estimator one that can be evaluated on other grids
+        sampler = GaussianSampler(coils[0].points, length_scale=length_scale_perturb, sigma=sigma_perturb,
+                                  method="kl" if sampling in ["sobol", "lhs"] or multilevel else "auto")
         # import IPython; IPython.embed()
         # import sys; sys.exit()
         self.sampler = sampler
 
-        self.stochastic_qs_objective = StochasticQuasiSymmetryObjective(stellarator, sampler, ninsamples, qsf, self.seed)
+        self.sample_chunk_size = sample_chunk_size
+        self.sampling = sampling
+        if multilevel:
+            # by default the number of samples halves from level to level
+            mlmc_nsamples = mlmc_nsamples or [max(ninsamples >> l, 2) for l in range(len(mlmc_nquadpoints) + 1)]
+            self.stochastic_qs_objective = MultilevelStochasticQuasiSymmetryObjective(
+                stellarator, sampler, mlmc_nsamples, qsf, self.seed, mlmc_nquadpoints, chunk_size=sample_chunk_size,
+                cache_size=sample_cache_size, linearised=linearised_samples, sampling=sampling)
+            self.ninsamples = self.next_ninsamples = self.stochastic_qs_objective.nsamples
+        else:
+            self.stochastic_qs_objective = StochasticQuasiSymmetryObjective(
+                stellarator, sampler, ninsamples, qsf, self.seed, chunk_size=sample_chunk_size, cache_size=sample_cache_size,
+                linearised=linearised_samples, sampling=sampling)
+        self.mlmc_tol = mlmc_tol if multilevel else None
         self.stochastic_qs_objective_out_of_sample = None
 
+        # in stochastic mode the mean over the samples can be estimated with
+        # the first order change of the deterministic objective as control variate
+        self.control_variate = ControlVariate() if control_variate and mode == "stochastic" else None
+
         if mode in ["deterministic", "stochastic"]:
             self.mode = mode
         elif mode[0:4] == "cvar":
@@ -87,6 +133,12 @@ class NearAxisQuasiSymmetryObjective():
 
         self.stochastic_qs_objective.set_magnetic_axis(self.ma.gamma)
 
+        # in cvar mode the samples can be shifted towards the tail, see
+        # `update_importance_shift`
+        self.importance_sampling = importance_sampling and self.mode == "cvar"
+        if self.importance_sampling:
+            self.stochastic_qs_objective.set_tail_shift(self.cvar_alpha)
+
         self.Jvals_perturbed = []
         self.Jvals_quantiles = []
         self.Jvals_no_noise = []
@@ -114,7 +166,23 @@ class NearAxisQuasiSymmetryObjective():
         self.biotsavart.clear_cached_properties()
         self.qsf.clear_cached_properties()
 
-    def update(self, x):
+    def update_importance_shift(self, x):
+        """
+        Shift the in-sample perturbations towards the CVaR tail of the
+        objective at `x`, see `StochasticQuasiSymmetryObjective.set_tail_shift`.
+        This changes the samples, so it should be done between optimisation
+        runs, not within one.
+        """
+        self.set_dofs(x)
+        self.stochastic_qs_objective.set_magnetic_axis(self.ma.gamma)
+        self.stochastic_qs_objective.set_tail_shift(self.cvar_alpha)
+
+    def update(self, x, compute_derivative=True):
+        """
+        Evaluate the objective at `x`. With `compute_derivative=False` only
+        the values are computed (e.g. for line searches) and `dres` is not
+        updated.
+        """
         self.x[:] = x
         J_BSvsQS          = self.J_BSvsQS
         J_coil_lengths    = self.J_coil_lengths
@@ -139,105 +207,141 @@ class NearAxisQuasiSymmetryObjective():
         """ Objective values """
 
         self.res2      = 0.5 * sum( (1/l)**2 * (J2.J() - l)**2 for (J2, l) in zip(J_coil_lengths, self.coil_length_targets))
-        self.drescoil += self.stellarator.reduce_coefficient_derivatives([
-            (1/l)**2 * (J_coil_lengths[i].J()-l) * J_coil_lengths[i].dJ_by_dcoefficients() for (i, l) in zip(list(range(len(J_coil_lengths))), self.coil_length_targets)])
+        if compute_derivative:
+            self.drescoil += self.stellarator.reduce_coefficient_derivatives([
+                (1/l)**2 * (J_coil_lengths[i].J()-l) * J_coil_lengths[i].dJ_by_dcoefficients() for (i, l) in zip(list(range(len(J_coil_lengths))), self.coil_length_targets)])
 
         self.res3    = 0.5 * (1/magnetic_axis_length_target)**2 * (J_axis_length.J() - magnetic_axis_length_target)**2
-        self.dresma += (1/magnetic_axis_length_target)**2 * (J_axis_length.J()-magnetic_axis_length_target) * J_axis_length.dJ_by_dcoefficients()
+        if compute_derivative:
+            self.dresma += (1/magnetic_axis_length_target)**2 * (J_axis_length.J()-magnetic_axis_length_target) * J_axis_length.dJ_by_dcoefficients()
 
         self.res4        = 0.5 * (1/iota_target**2) * (qsf.iota-iota_target)**2
-        self.dresetabar += (1/iota_target**2) * (qsf.iota - iota_target) * qsf.diota_by_detabar[:,0]
-        self.dresma     += (1/iota_target**2) * (qsf.iota - iota_target) * qsf.diota_by_dcoeffs[:, 0]
+        if compute_derivative:
+            dres4_by_detabar, dres4_by_dcoeffs = qsf.adjoint(np.zeros((qsf.n, )), (1/iota_target**2) * (qsf.iota - iota_target))
+            self.dresetabar += dres4_by_detabar
+            self.dresma     += dres4_by_dcoeffs
 
         if curvature_weight > 1e-15:
             self.res5      = sum(curvature_weight * J.J() for J in J_coil_curvatures)
-            self.drescoil += self.curvature_weight * self.stellarator.reduce_coefficient_derivatives([J.dJ_by_dcoefficients() for J in J_coil_curvatures])
+            if compute_derivative:
+                self.drescoil += self.curvature_weight * self.stellarator.reduce_coefficient_derivatives([J.dJ_by_dcoefficients() for J in J_coil_curvatures])
         else:
             self.res5 = 0
         if torsion_weight > 1e-15:
             self.res6      = sum(torsion_weight * J.J() for J in J_coil_torsions)
-            self.drescoil += self.torsion_weight * self.stellarator.reduce_coefficient_derivatives([J.dJ_by_dcoefficients() for J in J_coil_torsions])
+            if compute_derivative:
+                self.drescoil += self.torsion_weight * self.stellarator.reduce_coefficient_derivatives([J.dJ_by_dcoefficients() for J in J_coil_torsions])
         else:
             self.res6 = 0
 
         if self.sobolev_weight > 1e-15:
             self.res7 = sum(self.sobolev_weight * J.J() for J in self.J_sobolev_weights)
-            self.drescoil += self.sobolev_weight * self.stellarator.reduce_coefficient_derivatives([J.dJ_by_dcoefficients() for J in self.J_sobolev_weights[:-1]])
-            self.dresma += self.sobolev_weight * self.J_sobolev_weights[-1].dJ_by_dcoefficients()
+            if compute_derivative:
+                self.drescoil += self.sobolev_weight * self.stellarator.reduce_coefficient_derivatives([J.dJ_by_dcoefficients() for J in self.J_sobolev_weights[:-1]])
+                self.dresma += self.sobolev_weight * self.J_sobolev_weights[-1].dJ_by_dcoefficients()
         else:
             self.res7 = 0
 
         if self.arclength_weight > 1e-15:
             self.res8 = sum(self.arclength_weight * J.J() for J in self.J_arclength_weights)
-            self.drescoil += self.arclength_weight * self.stellarator.reduce_coefficient_derivatives([J.dJ_by_dcoefficients() for J in self.J_arclength_weights])
+            if compute_derivative:
+                self.drescoil += self.arclength_weight * self.stellarator.reduce_coefficient_derivatives([J.dJ_by_dcoefficients() for J in self.J_arclength_weights])
         else:
             self.res8 = 0
 
         if self.distance_weight > 1e-15:
             self.res9 = self.distance_weight * self.J_distance.J()
-            self.drescoil += self.distance_weight * self.stellarator.reduce_coefficient_derivatives(self.J_distance.dJ_by_dcoefficients())
+            if compute_derivative:
+                self.drescoil += self.distance_weight * self.stellarator.reduce_coefficient_derivatives(self.J_distance.dJ_by_dcoefficients())
         else:
             self.res9 = 0
 
         if self.tikhonov_weight > 1e-15:
             self.res_tikhonov_weight = self.tikhonov_weight * np.sum((x-self.x0)**2)
-            dres_tikhonov_weight = self.tikhonov_weight * 2. * (x-self.x0)
-            self.dresetabar += dres_tikhonov_weight[0:1]
-            self.dresma += dres_tikhonov_weight[self.ma_dof_idxs[0]:self.ma_dof_idxs[1]]
-            self.drescurrent += dres_tikhonov_weight[self.current_dof_idxs[0]:self.current_dof_idxs[1]]
-            self.drescoil += dres_tikhonov_weight[self.coil_dof_idxs[0]:self.coil_dof_idxs[1]]
+            if compute_derivative:
+                dres_tikhonov_weight = self.tikhonov_weight * 2. * (x-self.x0)
+                self.dresetabar += dres_tikhonov_weight[0:1]
+                self.dresma += dres_tikhonov_weight[self.ma_dof_idxs[0]:self.ma_dof_idxs[1]]
+                self.drescurrent += dres_tikhonov_weight[self.current_dof_idxs[0]:self.current_dof_idxs[1]]
+                self.drescoil += dres_tikhonov_weight[self.coil_dof_idxs[0]:self.coil_dof_idxs[1]]
         else:
             self.res_tikhonov_weight = 0
 
         self.stochastic_qs_objective.set_magnetic_axis(self.ma.gamma)
 
-        Jsamples = self.stochastic_qs_objective.J_samples()
+        self.likelihood_ratios = self.stochastic_qs_objective.likelihood_ratios()
+        if self.mode == "cvar":
+            t = x[-1]
+            Jsamples, dJsamples = self.stochastic_qs_objective.value_and_weighted_grad(
+                lambda Jsamples: self.cvar.weights(t, Jsamples, self.likelihood_ratios), compute_derivative=compute_derivative)
+        elif self.control_variate is not None:
+            Jsamples, Jmean, dJsamples = self.stochastic_qs_objective.value_and_controlled_mean_grad(
+                self.control_variate, compute_derivative=compute_derivative)
+        elif self.sample_size_test is not None and compute_derivative:
+            Jsamples, dJsamples, dJvariance = self.stochastic_qs_objective.value_mean_grad_and_variance()
+            Jmean = np.mean(Jsamples)
+        else:
+            Jsamples, dJsamples = self.stochastic_qs_objective.value_and_mean_grad(
+                compute_derivative=compute_derivative and self.mode == "stochastic")
+            if self.likelihood_ratios is not None:
+                Jmean = self.likelihood_ratios @ Jsamples/len(Jsamples)
+            else:
+                Jmean = np.mean(Jsamples) if len(Jsamples) > 0 else 0.
         assert len(Jsamples) == self.ninsamples
         self.QSvsBS_perturbed.append(Jsamples)
 
-        self.res1_det        = 0.5 * J_BSvsQS.J_L2() + 0.5 * J_BSvsQS.J_H1()
-        self.dresetabar_det  = 0.5 * J_BSvsQS.dJ_L2_by_detabar() + 0.5 * J_BSvsQS.dJ_H1_by_detabar()
-        self.dresma_det      = 0.5 * J_BSvsQS.dJ_L2_by_dmagneticaxiscoefficients() + 0.5 * J_BSvsQS.dJ_H1_by_dmagneticaxiscoefficients()
-        self.drescoil_det    = 0.5 * self.stellarator.reduce_coefficient_derivatives(J_BSvsQS.dJ_L2_by_dcoilcoefficients()) \
-            + 0.5 * self.stellarator.reduce_coefficient_derivatives(J_BSvsQS.dJ_H1_by_dcoilcoefficients())
-        self.drescurrent_det = 0.5 * self.current_fak * (
-            self.stellarator.reduce_current_derivatives(J_BSvsQS.dJ_L2_by_dcoilcurrents()) + self.stellarator.reduce_current_derivatives(J_BSvsQS.dJ_H1_by_dcoilcurrents())
-        )
+        self.res1_det, dJ_det = J_BSvsQS.value_and_grad(compute_derivative=compute_derivative)
+        if compute_derivative:
+            self.dresetabar_det  = dJ_det["etabar"]
+            self.dresma_det      = dJ_det["magneticaxiscoefficients"]
+            self.drescoil_det    = self.stellarator.reduce_coefficient_derivatives(dJ_det["coilcoefficients"])
+            self.drescurrent_det = self.current_fak * self.stellarator.reduce_current_derivatives(dJ_det["coilcurrents"])
         if self.mode == "deterministic":
             self.res1         = self.res1_det
-            self.dresetabar  += self.dresetabar_det
-            self.dresma      += self.dresma_det
-            self.drescoil    += self.drescoil_det
-            self.drescurrent += self.drescurrent_det
+            if compute_derivative:
+                self.dresetabar  += self.dresetabar_det
+                self.dresma      += self.dresma_det
+                self.drescoil    += self.drescoil_det
+                self.drescurrent += self.drescurrent_det
         else:
-            self.dresetabar_det  += self.dresetabar
-            self.dresma_det      += self.dresma
-            self.drescoil_det    += self.drescoil
-            self.drescurrent_det += self.drescurrent
+            if compute_derivative:
+                self.dresetabar_det  += self.dresetabar
+                self.dresma_det      += self.dresma
+                self.drescoil_det    += self.drescoil
+                self.drescurrent_det += self.drescurrent
             if self.mode == "stochastic":
-                n = self.ninsamples
-                self.res1         = sum(Jsamples)/n
+                self.res1         = Jmean
                 self.res1_det     = self.res1
-                self.drescoil    += sum(self.stochastic_qs_objective.dJ_by_dcoilcoefficients_samples())/n
-                self.drescurrent += self.current_fak * sum(self.stochastic_qs_objective.dJ_by_dcoilcurrents_samples())/n
-                self.dresetabar  += sum(self.stochastic_qs_objective.dJ_by_detabar_samples())/n
-                self.dresma      += sum(self.stochastic_qs_objective.dJ_by_dmagneticaxiscoefficients_samples())/n
+                if compute_derivative:
+                    self.drescoil    += dJsamples["coilcoefficients"]
+                    self.drescurrent += self.current_fak * dJsamples["coilcurrents"]
+                    self.dresetabar  += dJsamples["etabar"]
+                    self.dresma      += dJsamples["magneticaxiscoefficients"]
             elif self.mode == "cvar":
-                t = x[-1]
-                self.res1         = self.cvar.J(t, Jsamples)
+                self.res1         = self.cvar.J(t, Jsamples, self.likelihood_ratios)
                 self.res1_det     = self.res1
-                self.drescoil    += self.cvar.dJ_dx(t, Jsamples, self.stochastic_qs_objective.dJ_by_dcoilcoefficients_samples())
-                self.drescurrent += self.current_fak * self.cvar.dJ_dx(t, Jsamples, self.stochastic_qs_objective.dJ_by_dcoilcurrents_samples())
-                self.dresetabar  += self.cvar.dJ_dx(t, Jsamples, self.stochastic_qs_objective.dJ_by_detabar_samples())
-                self.dresma      += self.cvar.dJ_dx(t, Jsamples, self.stochastic_qs_objective.dJ_by_dmagneticaxiscoefficients_samples())
-                self.drescvart   = self.cvar.dJ_dt(t, Jsamples)
+                if compute_derivative:
+                    self.drescoil    += dJsamples["coilcoefficients"]
+                    self.drescurrent += self.current_fak * dJsamples["coilcurrents"]
+                    self.dresetabar  += dJsamples["etabar"]
+                    self.dresma      += dJsamples["magneticaxiscoefficients"]
+                    self.drescvart   = self.cvar.dJ_dt(t, Jsamples, self.likelihood_ratios)
             else:
                 raise NotImplementedError
 
         self.Jvals_individual.append([self.res1, self.res2, self.res3, self.res4, self.res5, self.res6, self.res7, self.res8, self.res9, self.res_tikhonov_weight])
         self.res = sum(self.Jvals_individual[-1])
-        self.perturbed_vals = [self.res - self.res1 + r for r in self.QSvsBS_perturbed[-1]]
+        if isinstance(self.stochastic_qs_objective, MultilevelStochasticQuasiSymmetryObjective):
+            # the evaluations of the coarse levels and corrections are not
+            # samples of the objective, so only the finest level enters the
+            # quantiles
+            fine_vals = self.stochastic_qs_objective.finest_level_values()
+        else:
+            fine_vals = self.QSvsBS_perturbed[-1]
+        self.perturbed_vals = [self.res - self.res1 + r for r in fine_vals]
 
+        if not compute_derivative:
+            return
         if self.mode in ["deterministic", "stochastic"]:
             self.dres = np.concatenate((
                 self.dresetabar, self.dresma,
@@ -258,10 +362,25 @@ class NearAxisQuasiSymmetryObjective():
                 self.drescurrent_det, self.drescoil_det
             ))
 
+        if self.sample_size_test is not None:
+            variance = np.concatenate((
+                dJvariance["etabar"], dJvariance["magneticaxiscoefficients"],
+                self.current_fak**2 * dJvariance["coilcurrents"], dJvariance["coilcoefficients"]
+            ))
+            self.next_ninsamples = self.sample_size_test(self.ninsamples, variance, self.dres)
+
 
     def compute_out_of_sample(self):
         if self.stochastic_qs_objective_out_of_sample is None:
-            self.stochastic_qs_objective_out_of_sample = StochasticQuasiSymmetryObjective(self.stellarator, self.sampler, self.noutsamples, self.qsf, 9999+self.seed)
+            # the out of sample draws are regenerated from their seeds on
+            # every call, so they are streamed through in chunks and not
+            # kept in memory. In cvar mode they are plain Monte Carlo samples,
+            # so that their empirical CVaR is an unbiased reference for the
+            # (possibly shifted) in sample estimate.
+            self.stochastic_qs_objective_out_of_sample = StochasticQuasiSymmetryObjective(
+                self.stellarator, self.sampler, self.noutsamples, self.qsf, 9999+self.seed,
+                chunk_size=self.sample_chunk_size or 64, cache_size=0,
+                sampling="mc" if self.mode == "cvar" else self.sampling)
 
         self.stochastic_qs_objective_out_of_sample.set_magnetic_axis(self.ma.gamma)
         Jsamples = np.array(self.stochastic_qs_objective_out_of_sample.J_samples())
@@ -279,6 +398,10 @@ class NearAxisQuasiSymmetryObjective():
         self.Jvals_no_noise.append(self.res - self.res1 + 0.5 * (self.J_BSvsQS.J_L2() + self.J_BSvsQS.J_H1()))
         self.xiterates.append(x.copy())
         self.Jvals_perturbed.append(self.perturbed_vals)
+        if self.control_variate is not None:
+            # only the accepted iterate updates the coefficients, so they are
+            # fixed during the line search
+            self.control_variate.accept()
 
         iteration = len(self.xiterates)-1
         info("################################################################################")
@@ -291,6 +414,13 @@ class NearAxisQuasiSymmetryObjective():
             cvar90 = np.mean(list(v for v in self.perturbed_vals if v >= np.quantile(self.perturbed_vals, 0.9)))
             cvar95 = np.mean(list(v for v in self.perturbed_vals if v >= np.quantile(self.perturbed_vals, 0.95)))
             info(f"CVaR(.9), CVaR(.95), Max:{cvar90:.6e}, {cvar95:.6e}, {max(self.perturbed_vals):.6e}")
+            if self.stochastic_qs_objective.linearised:
+                info(f"Linearisation error:     {self.stochastic_qs_objective.linearisation_error():.6e}")
+            if isinstance(self.stochastic_qs_objective, MultilevelStochasticQuasiSymmetryObjective):
+                info(f"Samples, variances per level: {self.stochastic_qs_objective.level_nsamples}, {self.stochastic_qs_objective.level_variances()}")
+            elif self.likelihood_ratios is not None:
+                ratios = self.likelihood_ratios
+                info(f"Effective sample size:   {np.sum(ratios)**2/np.sum(ratios**2):.1f} of {len(ratios)}")
         info(f"Objective gradients:     {norm(self.dresetabar):.6e}, {norm(self.dresma):.6e}, {norm(self.drescurrent):.6e}, {norm(self.drescoil):.6e}")
 
         max_curvature  = max(np.max(c.kappa) for c in self.stellarator._base_coils)
@@ -299,15 +429,39 @@ class NearAxisQuasiSymmetryObjective():
         mean_torsion   = np.mean([np.mean(np.abs(c.torsion)) for c in self.stellarator._base_coils])
         info(f"Curvature Max: {max_curvature:.3e}; Mean: {mean_curvature:.3e}")
         info(f"Torsion   Max: {max_torsion:.3e}; Mean: {mean_torsion:.3e}")
+        cache_info = operator_cache.info()
+        info(f"Operator cache: {cache_info['entries']} entries, {cache_info['nbytes']/2**20:.1f} MiB, hit rate {cache_info['hit_rate']:.3f}")
+        if self.mlmc_tol is not None:
+            level_nsamples = self.stochastic_qs_objective.level_nsamples
+            optimal = self.stochastic_qs_objective.optimal_nsamples(self.mlmc_tol)
+            if any(n > m for (n, m) in zip(optimal, level_nsamples)):
+                # never drop samples, so the estimate only improves
+                level_nsamples = [max(n, m) for (n, m) in zip(optimal, level_nsamples)]
+                info(f"Change the number of samples per level to {level_nsamples}")
+                self.stochastic_qs_objective.set_nsamples(level_nsamples)
+                self.ninsamples = self.stochastic_qs_objective.nsamples
+        if self.next_ninsamples > self.ninsamples:
+            # takes effect from the next iteration on, the samples drawn so far are kept
+            info(f"Norm test failed, increase the number of samples from {self.ninsamples} to {self.next_ninsamples}")
+            self.ninsamples = self.next_ninsamples
+            self.stochastic_qs_objective.set_nsamples(self.ninsamples)
         comm = MPI.COMM_WORLD
         if iteration % 25 == 0 and comm.rank == 0:
             self.plot('iteration-%04i.png' % iteration)
         if iteration % 25 == 0 and self.noutsamples > 0:
-            oos_vals = self.compute_out_of_sample()[1]
+            oos_qs, oos_vals = self.compute_out_of_sample()
             self.out_of_sample_values.append(oos_vals)
             info("Out of sample")
             info(f"VaR(.1), Mean, VaR(.9):  {np.quantile(oos_vals, 0.1):.6e}, {np.mean(oos_vals):.6e}, {np.quantile(oos_vals, 0.9):.6e}")
             info(f"CVaR(.9), CVaR(.95), Max:{np.mean(list(v for v in oos_vals if v >= np.quantile(oos_vals, 0.9))):.6e}, {np.mean(list(v for v in oos_vals if v >= np.quantile(oos_vals, 0.95))):.6e}, {max(oos_vals):.6e}")
+            if self.mode == "cvar":
+                # the out of sample perturbations are plain Monte Carlo samples
+                # in cvar mode, see `compute_out_of_sample`, so they need no
+                # likelihood ratios
+                ins_qs, ratios = self.QSvsBS_perturbed[-1], self.likelihood_ratios
+                ins_cvar = self.cvar.J(self.cvar.find_optimal_t(ins_qs, self.t, ratios), ins_qs, ratios)
+                oos_cvar = self.cvar.J(self.cvar.find_optimal_t(oos_qs, self.t), oos_qs)
+                info(f"CVaR({self.cvar_alpha}) of QS vs BS in sample, out of sample: {ins_cvar:.6e}, {oos_cvar:.6e}")
 
     def plot(self, filename):
         import matplotlib
@@ -412,7 +566,7 @@ class SimpleNearAxisQuasiSymmetryObjective():
                  ):
         self.stellarator = stellarator
         self.ma = ma
-        bs = BiotSavart(stellarator.coils, stellarator.currents)
+        bs = BiotSavart(stellarator._base_coils, stellarator._base_currents, symmetries=stellarator.symmetries)
         self.biotsavart = bs
         self.biotsavart.set_points(self.ma.gamma)
         qsf = QuasiSymmetricField(eta_bar, ma)
@@ -501,15 +655,12 @@ class SimpleNearAxisQuasiSymmetryObjective():
 
         """ Objective values """
 
-        self.res1        = 0.5 * J_BSvsQS.J_L2() + 0.5 * J_BSvsQS.J_H1()
+        self.res1, dJ = J_BSvsQS.value_and_grad(compute_derivative=compute_derivative)
         if compute_derivative:
-            self.dresetabar  += 0.5 * J_BSvsQS.dJ_L2_by_detabar() + 0.5 * J_BSvsQS.dJ_H1_by_detabar()
-            self.dresma      += 0.5 * J_BSvsQS.dJ_L2_by_dmagneticaxiscoefficients() + 0.5 * J_BSvsQS.dJ_H1_by_dmagneticaxiscoefficients()
-            self.drescoil    += 0.5 * self.stellarator.reduce_coefficient_derivatives(J_BSvsQS.dJ_L2_by_dcoilcoefficients()) \
-                + 0.5 * self.stellarator.reduce_coefficient_derivatives(J_BSvsQS.dJ_H1_by_dcoilcoefficients())
-            self.drescurrent += 0.5 * self.current_fak * (
-                self.stellarator.reduce_current_derivatives(J_BSvsQS.dJ_L2_by_dcoilcurrents()) + self.stellarator.reduce_current_derivatives(J_BSvsQS.dJ_H1_by_dcoilcurrents())
-            )
+            self.dresetabar  += dJ["etabar"]
+            self.dresma      += dJ["magneticaxiscoefficients"]
+            self.drescoil    += self.stellarator.reduce_coefficient_derivatives(dJ["coilcoefficients"])
+            self.drescurrent += self.current_fak * self.stellarator.reduce_current_derivatives(dJ["coilcurrents"])
 
         self.res2      = 0.5 * sum( (1/l)**2 * (J2.J() - l)**2 for (J2, l) in zip(J_coil_lengths, self.coil_length_targets))
         if compute_derivative:
@@ -522,8 +673,9 @@ class SimpleNearAxisQuasiSymmetryObjective():
 
         self.res4        = 0.5 * (1/iota_target**2) * (qsf.iota-iota_target)**2
         if compute_derivative:
-            self.dresetabar += (1/iota_target**2) * (qsf.iota - iota_target) * qsf.diota_by_detabar[:,0]
-            self.dresma     += (1/iota_target**2) * (qsf.iota - iota_target) * qsf.diota_by_dcoeffs[:, 0]
+            dres4_by_detabar, dres4_by_dcoeffs = qsf.adjoint(np.zeros((qsf.n, )), (1/iota_target**2) * (qsf.iota - iota_target))
+            self.dresetabar += dres4_by_detabar
+            self.dresma     += dres4_by_dcoeffs
 
         if curvature_weight > 0:
             # self.res5      = sum(curvature_weight * J.J() for J in J_coil_curvatures)
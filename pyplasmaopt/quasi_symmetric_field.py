@@ -1,8 +1,10 @@
 from .curve import Curve
 from .logging import info, warning
+from .operator_cache import operator_cache
 import numpy as np
 from math import pi
 from scipy.optimize import fsolve
+from scipy.linalg import lu_factor, lu_solve
 from property_manager3 import cached_property, PropertyManager
 writable_cached_property = cached_property(writable=True)
 
@@ -17,25 +19,34 @@ class QuasiSymmetricField(PropertyManager):
         self.magnetic_axis = magnetic_axis
         self.n = len(magnetic_axis.points)
         self.__state = np.zeros((self.n+1,))
-        import scipy
+        self.__lu = None
         n = self.n
-        points = self.magnetic_axis.points.reshape((n, 1))
-        oneton = np.asarray(range(0, n)).reshape((n, 1))
+        points = self.magnetic_axis.points
+        self.grid_key = operator_cache.grid_key(points)
         fak = (2 * pi) / (points[-1] - points[0] + (points[1]-points[0]))
-        dists = fak * scipy.spatial.distance.cdist(points, points, lambda a, b: a-b)
-        np.fill_diagonal(dists, 1e-10)  # to shut up the warning
+        """
+        The axis points are uniformly spaced, so the periodic spectral
+        differentiation is diagonal in Fourier space: d/dphi multiplies the
+        k-th mode by i k fak. For even n the Nyquist mode is dropped, which is
+        the same convention as the cot formula for the dense matrix.
+        """
+        k = np.arange(n//2 + 1, dtype=np.float64)
         if n % 2 == 0:
-            D = 0.5 \
-                * np.power(-1, scipy.spatial.distance.cdist(oneton, -oneton)) \
-                / np.tan(0.5 * dists)
-        else:
-            D = 0.5 \
-                * np.power(-1, scipy.spatial.distance.cdist(oneton, -oneton)) \
-                / np.sin(0.5 * dists)
-
-        np.fill_diagonal(D, 0)
-        D *= fak
-        self.D = D
+            k[-1] = 0
+        self.ik = 1j * fak * k
+
+    def diff(self, x):
+        """
+        Spectral derivative d/dphi of the periodic samples x along the first
+        axis, equivalent to D @ x at O(n log n) cost.
+        """
+        ik = self.ik.reshape((-1,) + (1,) * (np.ndim(x)-1))
+        return np.fft.irfft(ik * np.fft.rfft(x, axis=0), n=self.n, axis=0)
+
+    @property
+    def D(self):
+        """ The dense n x n differentiation matrix, shared via the `operator_cache`. """
+        return operator_cache.get(("differentiation_matrix", self.grid_key), lambda: self.diff(np.eye(self.n)))
 
     def clear(self):
         self.clear_cached_properties()
@@ -170,6 +181,7 @@ class QuasiSymmetricField(PropertyManager):
 
     def compute_derivative(self):
         self.compute()
+        self.solve_sensitivities()
         kappa = self.magnetic_axis.kappa[:, 0]
         dkappa_by_dphi = self.magnetic_axis.dkappa_by_dphi[:, 0, 0]
         torsion = self.magnetic_axis.torsion[:, 0]
@@ -241,7 +253,7 @@ class QuasiSymmetricField(PropertyManager):
         dsigma_by_dcoeffs = self.dsigma_by_dcoeffs
         dkappa_by_dcoeff = self.magnetic_axis.dkappa_by_dcoeff[:, :, 0]
         dl_by_dcoeff = self.magnetic_axis.dincremental_arclength_by_dcoeff[:, :, 0]
-        d2sigma_by_dphidcoeff = self.D @ dsigma_by_dcoeffs
+        d2sigma_by_dphidcoeff = self.diff(dsigma_by_dcoeffs)
         dtorsion_by_dcoeff = self.magnetic_axis.dtorsion_by_dcoeff[:, :, 0]
 
         """ Compute d2B_by_dcoeffsdX"""
@@ -291,8 +303,121 @@ class QuasiSymmetricField(PropertyManager):
                     ) \
                     + dtterm_by_dcoeff[:, None] * t + tterm[:, None] * dt_by_dcoeff[:, i, :]
 
-    # FIXME: this function could be split up so that the sensitivity is only computed when actually necessary
+    def B_and_dB_vjp(self, v, vgrad):
+        r"""
+        Return the gradient of
+            \sum_i v_i \cdot B_i + vgrad_i : \nabla B_i
+        with respect to eta_bar and the magnetic axis coefficients in reverse
+        mode: the weights are propagated back through B, \nabla B and the
+        Riccati equation for sigma and iota (with one transposed solve) to the
+        Frenet frame, curvature, torsion and arc length of the axis. The cost
+        does not grow with the number of axis coefficients except for the
+        final vjps of the curve.
+        """
+        ma = self.magnetic_axis
+        kappa = ma.kappa[:, 0]
+        dkappa_by_dphi = ma.dkappa_by_dphi[:, 0, 0]
+        torsion = ma.torsion[:, 0]
+        (t, n, b) = ma.frenet_frame
+        l = ma.incremental_arclength[:, 0]
+        s_G = self.s_G
+        s_Psi = self.s_Psi
+        eta_bar = self.eta_bar
+        B_0 = self.B_0
+        G_0 = np.mean(l) * self.s_G * self.B_0/(2*pi)
+        assert G_0 >= 0
+        iota = self.iota
+        sigma = self.sigma
+        dsigma_dphi = self.dsigma_by_dphi
+        X1c, Y1s, Y1c = self.X1c, self.Y1s, self.Y1c
+        dX1c_dphi, dY1s_dphi, dY1c_dphi = self.dX1c_dphi, self.dY1s_dphi, self.dY1c_dphi
+        dX1c_dvarphi, dY1s_dvarphi, dY1c_dvarphi = self.dX1c_dvarphi, self.dY1s_dvarphi, self.dY1c_dvarphi
+        inner = lambda a, b: np.sum(a*b, axis=1)
+
+        """
+        Write \nabla B = c (nterm n^T + bterm b^T) + tterm t^T with
+            nterm = a_t t + a_n n + a_b b, bterm = b_n n + b_b b, tterm = g n.
+        """
+        c = s_Psi * B_0**2/abs(G_0)
+        a_t = s_Psi * G_0 * kappa / B_0
+        a_n = dX1c_dvarphi * Y1s + iota * X1c * Y1c
+        a_b = dY1c_dvarphi * Y1s - dY1s_dvarphi * Y1c + s_Psi * G_0 * B_0 * torsion + iota*(Y1s**2 + Y1c**2)
+        b_n = -s_Psi * G_0 * torsion/B_0 - iota * X1c**2
+        b_b = X1c * dY1s_dvarphi - iota * X1c * Y1c
+        g = kappa * s_G * B_0
+        nterm = a_t[:, None] * t + a_n[:, None] * n + a_b[:, None] * b
+        bterm = b_n[:, None] * n + b_b[:, None] * b
+        tterm = g[:, None] * n
+
+        v_c = np.sum(vgrad * (nterm[:, :, None] * n[:, None, :] + bterm[:, :, None] * b[:, None, :]))
+        v_nterm = c * np.einsum('ijk,ik->ij', vgrad, n)
+        v_bterm = c * np.einsum('ijk,ik->ij', vgrad, b)
+        v_tterm = np.einsum('ijk,ik->ij', vgrad, t)
+        v_t = B_0 * v + np.einsum('ijk,ij->ik', vgrad, tterm) + a_t[:, None] * v_nterm
+        v_n = c * np.einsum('ijk,ij->ik', vgrad, nterm) + a_n[:, None] * v_nterm + b_n[:, None] * v_bterm + g[:, None] * v_tterm
+        v_b = c * np.einsum('ijk,ij->ik', vgrad, bterm) + a_b[:, None] * v_nterm + b_b[:, None] * v_bterm
+        v_a_t, v_a_n, v_a_b = inner(v_nterm, t), inner(v_nterm, n), inner(v_nterm, b)
+        v_b_n, v_b_b = inner(v_bterm, n), inner(v_bterm, b)
+        v_g = inner(v_tterm, n)
+
+        v_G_0 = -v_c * s_Psi * B_0**2/G_0**2
+        v_G_0 += np.sum(v_a_t * s_Psi * kappa/B_0 + v_a_b * s_Psi * B_0 * torsion - v_b_n * s_Psi * torsion/B_0)
+        v_kappa = v_a_t * s_Psi * G_0/B_0 + v_g * s_G * B_0
+        v_torsion = v_a_b * s_Psi * G_0 * B_0 - v_b_n * s_Psi * G_0/B_0
+        v_iota = np.sum(v_a_n * X1c * Y1c + v_a_b * (Y1s**2 + Y1c**2) - v_b_n * X1c**2 - v_b_b * X1c * Y1c)
+        v_dX1c_dvarphi = v_a_n * Y1s
+        v_dY1s_dvarphi = -v_a_b * Y1c + v_b_b * X1c
+        v_dY1c_dvarphi = v_a_b * Y1s
+        v_X1c = v_a_n * iota * Y1c - v_b_n * 2 * iota * X1c + v_b_b * (dY1s_dvarphi - iota * Y1c)
+        v_Y1s = v_a_n * dX1c_dvarphi + v_a_b * (dY1c_dvarphi + 2 * iota * Y1s)
+        v_Y1c = v_a_n * iota * X1c + v_a_b * (-dY1s_dvarphi + 2 * iota * Y1c) - v_b_b * iota * X1c
+
+        """ d(.)_dvarphi = G_0 d(.)_dphi/(l B_0) """
+        v_l = np.zeros((self.n, ))
+        v_dX1c_dphi = v_dX1c_dvarphi * G_0/(l * B_0)
+        v_dY1s_dphi = v_dY1s_dvarphi * G_0/(l * B_0)
+        v_dY1c_dphi = v_dY1c_dvarphi * G_0/(l * B_0)
+        v_G_0 += np.sum(v_dX1c_dphi * dX1c_dphi + v_dY1s_dphi * dY1s_dphi + v_dY1c_dphi * dY1c_dphi)/G_0
+        v_l -= (v_dX1c_dvarphi * dX1c_dvarphi + v_dY1s_dvarphi * dY1s_dvarphi + v_dY1c_dvarphi * dY1c_dvarphi)/l
+
+        s = s_G * s_Psi
+        v_dkappa_by_dphi = -v_dX1c_dphi * eta_bar/kappa**2 + v_dY1s_dphi * s/eta_bar + v_dY1c_dphi * s * sigma/eta_bar
+        v_kappa += 2 * v_dX1c_dphi * eta_bar * dkappa_by_dphi/kappa**3 + v_dY1c_dphi * s * dsigma_dphi/eta_bar \
+            - v_X1c * eta_bar/kappa**2 + v_Y1s * s/eta_bar + v_Y1c * s * sigma/eta_bar
+        v_sigma = v_dY1c_dphi * s * dkappa_by_dphi/eta_bar + v_Y1c * s * kappa/eta_bar
+        v_dsigma_dphi = v_dY1c_dphi * s * kappa/eta_bar
+        v_eta_bar = np.sum(-v_dX1c_dphi * dkappa_by_dphi/kappa**2 - v_dY1s_dphi * dY1s_dphi/eta_bar - v_dY1c_dphi * dY1c_dphi/eta_bar
+                           + v_X1c/kappa - v_Y1s * Y1s/eta_bar - v_Y1c * Y1c/eta_bar)
+
+        """ dsigma_dphi = D sigma and D is skew-symmetric """
+        v_sigma -= self.diff(v_dsigma_dphi)
+
+        """
+        Riccati equation R(sigma, iota; kappa, torsion, l, G_0, eta_bar) = 0,
+            R_i = fak1 (D sigma)_i/l_i + iota ((eta_bar/kappa_i)^4 + 1 + sigma_i^2) + fak2 torsion_i/kappa_i^2
+        """
+        lam = lu_solve(self.__lu, np.concatenate((v_sigma, [v_iota])), trans=1)[:-1]
+        fak1 = abs(G_0)/B_0
+        fak2 = 2 * G_0 * eta_bar**2 / (s_Psi * B_0)
+        v_G_0 -= np.sum(lam * (dsigma_dphi/(l * B_0) + 2 * eta_bar**2 * torsion/(s_Psi * B_0 * kappa**2)))
+        v_l += lam * fak1 * dsigma_dphi/l**2
+        v_kappa += lam * (4 * iota * eta_bar**4/kappa**5 + 2 * fak2 * torsion/kappa**3)
+        v_torsion -= lam * fak2/kappa**2
+        v_eta_bar -= np.sum(lam * (4 * iota * eta_bar**3/kappa**4 + 4 * G_0 * eta_bar * torsion/(s_Psi * B_0 * kappa**2)))
+
+        v_l += v_G_0 * s_G * B_0/(2 * pi * self.n)
+        dJ_by_dcoeffs = ma.frenet_frame_vjp(v_t, v_n, v_b, v_kappa, v_dkappa_by_dphi, v_torsion, v_l)
+        return np.asarray([v_eta_bar]), dJ_by_dcoeffs
+
     def solve_state(self):
+        """
+        Solves the Riccati equation for sigma and iota with Newton's method.
+        The LU factorisation of the Jacobian at the previous solution is kept
+        and reused for the Newton steps (a chord method), and is only
+        refreshed if the iteration contracts slowly. At the new solution the
+        Jacobian is factorised once more; that factorisation is used for all
+        sensitivity and adjoint solves and for the next call.
+        """
         n = self.n
         l = self.magnetic_axis.incremental_arclength[:, 0]
         kappa = self.magnetic_axis.kappa[:, 0]
@@ -301,13 +426,13 @@ class QuasiSymmetricField(PropertyManager):
         fak1 = abs(G_0)/self.B_0
         fak2 = 2 * G_0 * self.eta_bar**2 / (self.s_Psi * self.B_0)
         torsion = self.magnetic_axis.torsion[:, 0]
-        fak1lD = np.diag(fak1/l) @ self.D
+        fak1l = fak1/l
 
         def build_residual(x):
             sigma = x[:-1]
             iota = x[-1]
             residual = np.zeros((n+1, ))
-            residual[:n] = fak1lD@sigma + iota * ((self.eta_bar/kappa)**4 + 1 + sigma**2) + fak2 * torsion / kappa**2
+            residual[:n] = fak1l * self.diff(sigma) + iota * ((self.eta_bar/kappa)**4 + 1 + sigma**2) + fak2 * torsion / kappa**2
             residual[-1] = sigma[0]
             return residual
 
@@ -315,81 +440,104 @@ class QuasiSymmetricField(PropertyManager):
             sigma = x[:-1]
             iota = x[-1]
             jacobian = np.zeros((n+1, n+1))
-            jacobian[:n, :n] = fak1lD
-            np.fill_diagonal(jacobian[:n, :n], np.diagonal(jacobian[:n, :n]) + 2 * sigma * iota)
+            jacobian[:n, :n] = fak1l[:, None] * self.D
+            jacobian[:n, :n] += np.diag(2 * sigma * iota)
             jacobian[:n, n] = ((self.eta_bar/kappa)**4 + 1 + sigma**2)
             jacobian[-1, 0] = 1
             return jacobian
 
-        # x = np.random.rand(*self.__state.shape)
-        # jac = build_jacobian(x)
-        # jac_est = np.zeros(jac.shape)
-        # f0 = build_residual(x)
-        # eps = 1e-4
-        # for i in range(self.n+1):
-        #     x[i] += eps
-        #     fx = build_residual(x)
-        #     x[i] -= 2*eps
-        #     fy = build_residual(x)
-        #     x[i] += eps
-        #     jac_est[:, i] = (fx-fy)/(2*eps)
-        # np.set_printoptions(linewidth=1000, precision=4)
-        # print( "Jac - Jac_Est", np.linalg.norm(jac-jac_est))
-        if np.linalg.norm(self.__state) < 1e-13:
+        if np.linalg.norm(self.__state) < 1e-13 or self.__lu is None:
             # info("First solve: use fsolve")
             soln = fsolve(build_residual, self.__state, fprime=build_jacobian, xtol=1e-13)
         else:
             diff = 1
             soln = self.__state.copy()
+            lu = self.__lu
             count = 0
             while diff > 1e-13:
-                update = np.linalg.solve(build_jacobian(soln), build_residual(soln))
+                update = lu_solve(lu, build_residual(soln))
                 soln -= update
-                diff = np.linalg.norm(update)
+                diff_new = np.linalg.norm(update)
+                if diff_new > 0.5 * diff:
+                    lu = lu_factor(build_jacobian(soln))
+                diff = diff_new
                 count += 1
-                if count > 10:
+                if count > 20:
                     # warning("Newton failed: use fsolve")
                     soln = fsolve(build_residual, self.__state, fprime=build_jacobian, xtol=1e-13)
                     break
 
         self.__state[:] = soln[:]
+        self.__lu = lu_factor(build_jacobian(self.__state))
         sigma = self.__state[:-1].copy()
         iota = self.__state[-1]
-        dsigma_by_dphi = self.D @ sigma
+        dsigma_by_dphi = self.diff(sigma)
+        return sigma, iota, dsigma_by_dphi
+
+    def dresidual_by_dparameters(self):
+        """
+        Partial derivatives of the residual of the Riccati equation w.r.t.
+        eta_bar and the magnetic axis coefficients, of shape (n+1, 1) and
+        (n+1, num_coeff).
+        """
+        n = self.n
+        sigma = self.sigma
+        iota = self.iota
+        dsigma_by_dphi = self.dsigma_by_dphi
+        l = self.magnetic_axis.incremental_arclength[:, 0]
+        kappa = self.magnetic_axis.kappa[:, 0]
+        torsion = self.magnetic_axis.torsion[:, 0]
+        G_0  = np.mean(l) * self.s_G * self.B_0/(2*pi)
+        assert G_0 >= 0
+        fak1 = abs(G_0)/self.B_0
+        fak2 = 2 * G_0 * self.eta_bar**2 / (self.s_Psi * self.B_0)
 
-        jac = build_jacobian(self.__state)
-        jacinv = np.linalg.inv(jac)
         """ Calculate dresidual_by_detabar """
         dresidual_by_detabar = np.zeros((n+1, 1))
         dresidual_by_detabar[:n, 0] = iota * 4 * self.eta_bar**3 / kappa**4 + (4 * G_0 * self.eta_bar / (self.s_Psi * self.B_0)) * torsion / kappa**2
 
-
-        temp = jacinv @ dresidual_by_detabar
-
-        self.dsigma_by_detabar = -temp[:n, :]
-        self.diota_by_detabar = -temp[-1:, :]
-        self.d2sigma_by_detabardphi = (self.D @ self.dsigma_by_detabar[:, 0]).reshape((n, 1, 1))
-
         """ Calculate dresidual_by_dcoeffs """
         dl_by_dcoeff = self.magnetic_axis.dincremental_arclength_by_dcoeff[:, :, 0]
         dkappa_by_dcoeff = self.magnetic_axis.dkappa_by_dcoeff[:, :, 0]
+        dtorsion_by_dcoeff = self.magnetic_axis.dtorsion_by_dcoeff[:, :, 0]
 
         dG_0_by_dcoeff  = np.mean(dl_by_dcoeff, axis=0) * self.s_G * self.B_0/(2*pi)
-        assert G_0 >= 0
         dfak1_by_dcoeff = dG_0_by_dcoeff/self.B_0
         dfak2_by_dcoeff = 2 * dG_0_by_dcoeff * self.eta_bar**2 / (self.s_Psi * self.B_0)
-        dtorsion_by_dcoeff = self.magnetic_axis.dtorsion_by_dcoeff[:, :, 0]
 
         num_coeff = dtorsion_by_dcoeff.shape[1]
         dresidual_by_dcoeff = np.zeros((n+1, num_coeff))
-        for i in range(num_coeff):
-            dresidual_by_dcoeff[:n, i] = (dfak1_by_dcoeff[i]/l - fak1 * dl_by_dcoeff[:,i]/l**2)*(self.D@sigma) \
-                -4*iota * dkappa_by_dcoeff[:, i] * (self.eta_bar**4/kappa**5) \
-                + dfak2_by_dcoeff[i] * torsion / kappa**2 + fak2 * dtorsion_by_dcoeff[:,i] / kappa**2 - 2*fak2*torsion*dkappa_by_dcoeff[:,i] / kappa**3
-
-        temp = jacinv @ dresidual_by_dcoeff
-
-        self.diota_by_dcoeffs  = -temp[-1:, :].T
-        self.dsigma_by_dcoeffs = -temp[:n, :]
-        return sigma, iota, dsigma_by_dphi
-
+        dresidual_by_dcoeff[:n, :] = (dfak1_by_dcoeff[None, :]/l[:, None] - fak1 * dl_by_dcoeff/l[:, None]**2) * dsigma_by_dphi[:, None] \
+            - 4 * iota * dkappa_by_dcoeff * (self.eta_bar**4/kappa**5)[:, None] \
+            + dfak2_by_dcoeff[None, :] * (torsion / kappa**2)[:, None] + fak2 * dtorsion_by_dcoeff / kappa[:, None]**2 \
+            - 2 * fak2 * dkappa_by_dcoeff * (torsion / kappa**3)[:, None]
+        return dresidual_by_detabar, dresidual_by_dcoeff
+
+    def solve_sensitivities(self):
+        """
+        Computes the derivatives of sigma and iota w.r.t. eta_bar and the
+        magnetic axis coefficients, using the factorised Jacobian from
+        `solve_state`.
+        """
+        n = self.n
+        dresidual_by_detabar, dresidual_by_dcoeff = self.dresidual_by_dparameters()
+        temp = -lu_solve(self.__lu, np.concatenate((dresidual_by_detabar, dresidual_by_dcoeff), axis=1))
+
+        self.dsigma_by_detabar = temp[:n, :1]
+        self.diota_by_detabar = temp[-1:, :1]
+        self.d2sigma_by_detabardphi = self.diff(self.dsigma_by_detabar[:, 0]).reshape((n, 1, 1))
+        self.dsigma_by_dcoeffs = temp[:n, 1:]
+        self.diota_by_dcoeffs  = temp[-1:, 1:].T
+
+    def adjoint(self, dJ_by_dsigma, dJ_by_diota):
+        r"""
+        Returns the gradient of a function J(sigma, iota) w.r.t. eta_bar and
+        the magnetic axis coefficients with a single transposed solve,
+            dJ/dp = -\lambda^T \partial R/\partial p,    (\partial R/\partial(\sigma, \iota))^T \lambda = (dJ/d\sigma, dJ/d\iota),
+        instead of computing dsigma_by_dcoeffs and diota_by_dcoeffs.
+        """
+        self.sigma
+        rhs = np.concatenate((np.asarray(dJ_by_dsigma, dtype=np.float64).reshape((self.n, )), [dJ_by_diota]))
+        lam = lu_solve(self.__lu, rhs, trans=1)
+        dresidual_by_detabar, dresidual_by_dcoeff = self.dresidual_by_dparameters()
+        return -lam @ dresidual_by_detabar, -lam @ dresidual_by_dcoeff
@@ -0,0 +1,29 @@
+import numpy as np
+
+
+class NormTest():
+
+    def __init__(self, nmax, theta=0.5):
+        r"""
+        Adaptive sample size for a sample average gradient, using the norm
+        test of Byrd, Chin, Nocedal and Wu (2012): the sample mean of |S|
+        sample gradients is a descent direction with high probability if
+            \sum_k Var(\nabla F)_k / |S| \le \theta^2 |g|^2,
+        where g is the estimated gradient, including any deterministic terms,
+        which have no variance. If the test fails, the sample size is
+        increased to the smallest one that passes it, at most `nmax`. The
+        sample size is never decreased.
+        """
+        self.nmax = nmax
+        self.theta = theta
+
+    def __call__(self, nsamples, variance, grad):
+        """
+        Returns the sample size for the next iteration, given the current one,
+        the sample variance of every gradient component and the gradient.
+        """
+        grad_norm_sq = np.sum(np.asarray(grad)**2)
+        if grad_norm_sq == 0:
+            return self.nmax
+        required = int(np.ceil(np.sum(variance)/(self.theta**2 * grad_norm_sq)))
+        return min(self.nmax, max(nsamples, required))
@@ -1,7 +1,9 @@
 import numpy as np
-from .curve import GaussianPerturbedCurve
+from collections import OrderedDict
+from .curve import GaussianPerturbedCurve, CartesianFourierCurve
+from .coils import CoilCollection
 from .objective import BiotSavartQuasiSymmetricFieldDifference
-from .biotsavart import BiotSavart
+from .biotsavart import BiotSavart, BatchedBiotSavart, LinearisedBatchedBiotSavart
 from .cvar import CVaR
 from property_manager3 import cached_property, PropertyManager
 from mpi4py import MPI
@@ -9,11 +11,252 @@ comm = MPI.COMM_WORLD
 from randomgen import Generator, PCG64
 
 
+class AntitheticNormals():
+
+    def __init__(self, randomgen):
+        """ Stands in for `randomgen` and returns its normal numbers negated. """
+        self.randomgen = randomgen
+
+    def standard_normal(self, size=None):
+        return -self.randomgen.standard_normal(size=size)
+
+
+class QuasiRandomNormals():
+
+    def __init__(self, z):
+        """ Stands in for a random generator and hands out the entries of `z` in order. """
+        self.z = z
+        self.pos = 0
+
+    def standard_normal(self, size=None):
+        n = int(np.prod(size))
+        z = self.z[self.pos:self.pos+n].reshape(size)
+        self.pos += n
+        return z
+
+
+class ShiftedNormals():
+
+    def __init__(self, randomgen, shift):
+        r"""
+        Stands in for `randomgen` and returns its normal numbers \epsilon
+        shifted by the consecutive entries of `shift`. The sum of
+        \epsilon \cdot shift is kept for the likelihood ratio.
+        """
+        self.randomgen = randomgen
+        self.shift = shift
+        self.pos = 0
+        self.inner = 0.
+
+    def standard_normal(self, size=None):
+        eps = self.randomgen.standard_normal(size=size)
+        n = eps.size
+        shift = self.shift[self.pos:self.pos+n].reshape(eps.shape)
+        self.pos += n
+        self.inner += np.sum(eps * shift)
+        return eps + shift
+
+
+class PerturbedCoilSamples():
+
+    def __init__(self, coils, sampler, seed, cache_size=None, sampling="mc", nsamples=None):
+        """
+        Provides the perturbed copies of `coils` for sample i, drawn with the
+        generator `PCG64(seed, i)`, without keeping all samples alive. A
+        sample is regenerated from its seed whenever it is requested and the
+        `cache_size` most recently used samples (all if `None`) are kept, so
+        that their cached derivative arrays can be reused across iterations.
+
+        For every sample only the state of its generator at the start of its
+        last regeneration is stored; after `resample()` the next draw is
+        obtained by replaying the draws in between from that state.
+
+        `sampling` selects how the normal numbers of the sampler are drawn:
+
+            "mc":         independent pseudo random numbers,
+            "antithetic": samples 2k and 2k+1 use the generator `PCG64(seed, k)`,
+                          the latter with the numbers negated,
+            "sobol":      a scrambled Sobol sequence, one point per sample,
+            "lhs":        a Latin hypercube design of `nsamples` points,
+
+        where for the last two the uniform points are mapped to normal
+        numbers by the inverse normal CDF. Their dimension is the number of
+        normal numbers of all coils, so they are meant for samplers with few
+        modes, e.g. `GaussianSampler(method="kl")`. The dimensions are ordered
+        such that the leading modes of all coils come first. Every
+        `resample()` uses a new scrambling. As every sample is defined by its
+        global index, the samples do not depend on how they are distributed
+        over the ranks.
+
+        With `set_shift` the normal numbers of all samples are drawn from
+        N(shift, I) instead of N(0, I), see `log_likelihood_ratio`.
+        """
+        if sampling not in ["mc", "antithetic", "sobol", "lhs"]:
+            raise ValueError("Unknown sampling %s" % sampling)
+        if sampling == "lhs" and nsamples is None:
+            raise ValueError("Latin hypercube sampling needs the number of samples.")
+        self.coils = coils
+        self.sampler = sampler
+        self.seed = seed
+        self.cache_size = cache_size
+        self.sampling = sampling
+        self.nsamples = nsamples
+        self.draw = 0
+        self.states = {}
+        self.cache = OrderedDict()
+        self.shift = None
+        self.log_ratios = {}
+
+    def generator(self, i):
+        if self.sampling in ["sobol", "lhs"]:
+            return QuasiRandomNormals(self.quasi_random_normals(i))
+        stream = i//2 if self.sampling == "antithetic" else i
+        rg = np.random.Generator(PCG64(self.seed, stream, mode="sequence"))
+        if i in self.states:
+            draw, state = self.states[i]
+            rg.bit_generator.state = state
+        else:
+            draw = 0
+        for _ in range(self.draw - draw):
+            for coil in self.coils:
+                self.sampler.sample(rg)
+        self.states[i] = (self.draw, rg.bit_generator.state)
+        if self.sampling == "antithetic" and i % 2 == 1:
+            return AntitheticNormals(rg)
+        return rg
+
+    def set_shift(self, shift):
+        """
+        Draw the normal numbers of all coils of a sample, in the order in which
+        they are drawn, from N(shift, I), or from N(0, I) if `shift` is `None`.
+        The cached samples are regenerated.
+        """
+        self.shift = None if shift is None else np.asarray(shift, dtype=np.float64)
+        self.log_ratios = {}
+        self.release(0)
+
+    def log_likelihood_ratio(self, i):
+        r"""
+        log(p(z_i)/q(z_i)) = -shift \cdot \epsilon_i - |shift|^2/2 for the
+        normal numbers z_i = shift + \epsilon_i of sample i, where p is the
+        density of N(0, I) and q that of N(shift, I). Weighting the samples by
+        the ratio gives unbiased estimates of expectations under p.
+        """
+        if self.shift is None:
+            return 0.
+        if i not in self.log_ratios:
+            self[i]
+            self.release()
+        return self.log_ratios[i]
+
+    def quasi_random_normals(self, i):
+        """
+        The normal numbers of sample i for the quasi random designs. The
+        scrambled Sobol engine and the Latin hypercube design are generated
+        once per draw.
+        """
+        from scipy.stats import qmc, norm
+        ncoils = len(self.coils)
+        if getattr(self, "design_draw", None) != self.draw:
+            dimension = ncoils * self.sampler.dimension
+            rg = np.random.default_rng(np.random.SeedSequence([self.seed, self.draw]))
+            if self.sampling == "sobol":
+                self.design = qmc.Sobol(dimension, scramble=True, seed=rg)
+            else:
+                self.design = qmc.LatinHypercube(dimension, seed=rg).random(self.nsamples)
+            self.design_draw = self.draw
+        if self.sampling == "sobol":
+            self.design.reset()
+            if i > 0:
+                self.design.fast_forward(i)
+            u = self.design.random(1)[0]
+        else:
+            u = self.design[i]
+        z = norm.ppf(np.clip(u, 2.**-53, 1-2.**-53))
+        # dimension k*ncoils + c is the k-th number of coil c
+        return z.reshape((-1, ncoils)).T.ravel()
+
+    def __getitem__(self, i):
+        if i in self.cache:
+            self.cache.move_to_end(i)
+            return self.cache[i]
+        rg = self.generator(i)
+        if self.shift is not None:
+            rg = ShiftedNormals(rg, self.shift)
+        perturbed_coils = [GaussianPerturbedCurve(coil, self.sampler, randomgen=rg) for coil in self.coils]
+        if self.shift is not None:
+            self.log_ratios[i] = -rg.inner - 0.5 * (self.shift @ self.shift)
+        self.cache[i] = perturbed_coils
+        return perturbed_coils
+
+    def set_nsamples(self, nsamples):
+        if self.sampling == "lhs" and nsamples != self.nsamples:
+            self.design_draw = None
+            self.release(0)
+        self.nsamples = nsamples
+
+    def retain(self, idxs):
+        """ Release all cached samples that are not in `idxs`. """
+        for i in [i for i in self.cache if i not in idxs]:
+            self.cache.pop(i)
+
+    def release(self, cache_size=None):
+        """
+        Evict the least recently used samples until at most `cache_size`
+        (default: the size of the cache) are left.
+        """
+        cache_size = self.cache_size if cache_size is None else cache_size
+        if cache_size is None:
+            return
+        while len(self.cache) > cache_size:
+            self.cache.popitem(last=False)
+
+    def resample(self):
+        self.draw += 1
+        self.log_ratios = {}
+        if self.sampling in ["sobol", "lhs"] or self.shift is not None:
+            # a new scrambling or a shift, the cached samples have to be regenerated
+            self.release(0)
+            return
+        # the cached samples continue with their own generator
+        for perturbed_coils in self.cache.values():
+            for c in perturbed_coils:
+                c.resample()
+
+
 class StochasticQuasiSymmetryObjective(PropertyManager):
 
-    def __init__(self, stellarator, sampler, nsamples, qsf, seed):
+    def __init__(self, stellarator, sampler, nsamples, qsf, seed, chunk_size=None, cache_size=None, linearised=False, sampling="mc"):
+        """
+        The local samples are evaluated in chunks of `chunk_size` (all at
+        once if `None`) and their perturbed coils are regenerated on demand,
+        see `PerturbedCoilSamples`, so with a small `cache_size` the memory
+        per rank is proportional to the chunk size rather than to the number
+        of samples. `sampling` selects plain Monte Carlo, antithetic or quasi
+        Monte Carlo samples, see there.
+
+        If `linearised` is true, the fields of the samples are not computed
+        with the Biot-Savart kernel but with the first order expansion about
+        the unperturbed coils, see `LinearisedBatchedBiotSavart`. This is
+        accurate to second order in the size of the perturbations;
+        `linearisation_error` compares it with the exact evaluation.
+        """
         self.stellarator = stellarator
-        self.nsamples = nsamples
+        self.qsf = qsf
+        self.samples = PerturbedCoilSamples(stellarator.coils, sampler, seed, cache_size=cache_size, sampling=sampling, nsamples=nsamples)
+        self.max_chunk_size = chunk_size
+        self.set_nsamples(nsamples)
+        self.linearised = linearised
+        self.nominal_biotsavart = BiotSavart(stellarator.coils, stellarator.currents)
+
+    def set_nsamples(self, nsamples):
+        """
+        Use the samples 0, ..., nsamples-1, split into contiguous ranges over
+        the ranks. As every sample is defined by its global index, growing the
+        sample set keeps the previous samples; the cached samples that move to
+        another rank are released. For Latin hypercube sampling the design
+        depends on the number of samples, so all samples change.
+        """
         size = comm.size
         idxs = [i*nsamples//size for i in range(size+1)]
         assert idxs[0] == 0
@@ -21,54 +264,520 @@ class StochasticQuasiSymmetryObjective(PropertyManager):
         first = idxs[comm.rank]
         last = idxs[comm.rank+1]
         assert last >= first
-        self.J_BSvsQS_perturbed = []
-
-        for i in range(first, last):
-            rg = np.random.Generator(PCG64(seed, i, mode="sequence"))
-            perturbed_coils = [
-                GaussianPerturbedCurve(coil, sampler, randomgen=rg) for coil in stellarator.coils]
-            perturbed_bs    = BiotSavart(perturbed_coils, stellarator.currents)
-            self.J_BSvsQS_perturbed.append(BiotSavartQuasiSymmetricFieldDifference(qsf, perturbed_bs))
+        self.nsamples = nsamples
+        self.first, self.last = first, last
+        self.sample_counts = np.diff(idxs)
+        self.sample_displs = np.asarray(idxs[:-1])
+        self.chunk_size = self.max_chunk_size or max(last - first, 1)
+        self.samples.set_nsamples(nsamples)
+        self.samples.retain(range(first, last))
 
     def resample(self):
-        for J in self.J_BSvsQS_perturbed:
-            for c in J.biotsavart.coils:
-                c.resample()
+        self.samples.resample()
 
     def set_magnetic_axis(self, gamma):
-        for J in self.J_BSvsQS_perturbed:
-            J.biotsavart.clear_cached_properties()
-            J.biotsavart.set_points(gamma)
+        """
+        Set the points at which the fields of the samples are evaluated. The
+        evaluation itself is done chunk by chunk in `evaluate_chunks`.
+        """
+        self.points = gamma
+        self.nominal_biotsavart.set_points(gamma)
+
+    def evaluate_samples(self, idxs, linearised):
+        """
+        Evaluate the fields of the samples `idxs` at the magnetic axis with
+        one batched call and hand them to per sample `BiotSavart` objects.
+        Returns the batched field and the list of
+        `BiotSavartQuasiSymmetricFieldDifference` objects of the samples.
+        """
+        gamma = self.points
+        currents = self.stellarator.currents
+        coil_sets = [self.samples[i] for i in idxs]
+        if linearised:
+            bbs = LinearisedBatchedBiotSavart(self.nominal_biotsavart, coil_sets)
+        else:
+            bbs = BatchedBiotSavart(coil_sets, currents)
+        bbs.set_points(gamma)
+        bbs.compute(gamma)
+        Js = []
+        for k, coils in enumerate(coil_sets):
+            bs = BiotSavart(coils, currents)
+            bs.set_points(gamma)
+            bs.B           = bbs.B[k]
+            bs.dB_by_dX    = bbs.dB_by_dX[k]
+            bs.d2B_by_dXdX = bbs.d2B_by_dXdX[k]
+            bs.dB_by_dcoilcurrents    = list(bbs.dB_by_dcoilcurrents[k])
+            bs.d2B_by_dXdcoilcurrents = list(bbs.d2B_by_dXdcoilcurrents[k])
+            Js.append(BiotSavartQuasiSymmetricFieldDifference(self.qsf, bs))
+        return bbs, Js
+
+    def evaluate_chunks(self):
+        """
+        Evaluate the local samples in chunks of `chunk_size`, see
+        `evaluate_samples`. The fields of a chunk are discarded once the next
+        chunk is requested.
+        """
+        for start in range(self.first, self.last, self.chunk_size):
+            yield self.evaluate_samples(range(start, min(start + self.chunk_size, self.last)), self.linearised)
+            self.samples.release()
+
+    def linearisation_error(self, nsamples=1):
+        """
+        Largest relative difference in the objective between the linearised
+        and the exact field over the first `nsamples` local samples, 0 if
+        there are none.
+        """
+        idxs = range(self.first, min(self.first + nsamples, self.last))
+        if len(idxs) == 0:
+            return 0.
+        J_exact  = np.asarray([J.value_and_grad(compute_derivative=False)[0] for J in self.evaluate_samples(idxs, False)[1]])
+        J_linear = np.asarray([J.value_and_grad(compute_derivative=False)[0] for J in self.evaluate_samples(idxs, True)[1]])
+        self.samples.release()
+        return np.max(np.abs(J_linear - J_exact)/np.abs(J_exact))
 
     def J_samples(self):
-        local_vals = [0.5 * (J.J_L2() + J.J_H1()) for J in self.J_BSvsQS_perturbed]
-        all_vals = [i for o in comm.allgather(local_vals) for i in o]
-        return all_vals
+        return self.value_and_grad_samples(compute_derivative=False)[0]
+
+    def dJ_by_dB_samples(self, Js):
+        """
+        Derivatives of the samples `Js` with respect to B and dB_by_dX at the
+        axis, stacked to shape (nsamples, npoints, 3) and (nsamples, npoints, 3, 3).
+        """
+        npoints = len(self.points)
+        v     = np.zeros((len(Js), npoints, 3))
+        vgrad = np.zeros((len(Js), npoints, 3, 3))
+        for i, J in enumerate(Js):
+            v[i]     = 0.5 * J.dJ_L2_by_dB()
+            vgrad[i] = 0.5 * J.dJ_H1_by_ddB_by_dX()
+        return v, vgrad
+
+    def local_dJ_by_dcoilcoefficients(self, bbs, v, vgrad):
+        """
+        Coil coefficient gradients of the samples in `bbs`, given their
+        derivatives `v` and `vgrad` with respect to B and dB_by_dX at the axis.
+        Returns an array with one row per sample.
+        """
+        if len(v) == 0:
+            return np.zeros((0, len(self.stellarator.get_dofs())))
+        dJ_by_dgammas, dJ_by_ddgamma_by_dphis = bbs.compute_vjp(bbs.points, v, vgrad)
+        # every sample perturbs the same coils, so the contraction with the
+        # coefficient derivatives is done for all samples at once
+        dJ_by_dcoeffs = [
+            coil.dgamma_by_dcoeff_vjp(dJ_by_dgammas[:, i]) + coil.d2gamma_by_dphidcoeff_vjp(dJ_by_ddgamma_by_dphis[:, i])
+            for i, coil in enumerate(self.stellarator.coils)]
+        return self.stellarator.reduce_coefficient_derivatives(dJ_by_dcoeffs, axis=1)
+
+    def local_dJ_by_dcoilcurrents(self, bbs, v, vgrad):
+        """
+        Coil current gradients of the samples in `bbs`, see `local_dJ_by_dcoilcoefficients`.
+        """
+        dJ_by_dcoilcurrents = np.einsum('sij,scij->cs', v, bbs.dB_by_dcoilcurrents) \
+            + np.einsum('sijk,scijk->cs', vgrad, bbs.d2B_by_dXdcoilcurrents)
+        return self.stellarator.reduce_current_derivatives(list(dJ_by_dcoilcurrents)).T
+
+    gradient_keys = ("etabar", "magneticaxiscoefficients", "coilcurrents", "coilcoefficients")
+
+    def gradient_sizes(self):
+        return (1, len(self.qsf.magnetic_axis.get_dofs()), len(self.stellarator.get_currents()), len(self.stellarator.get_dofs()))
+
+    def local_value_and_grad_buffer(self, compute_derivative=True):
+        """
+        Values and, if `compute_derivative` is true, gradients of the local
+        samples packed into one contiguous array with one row
+            [J, dJ/deta_bar, dJ/d(axis coeffs), dJ/d(currents), dJ/d(coil coeffs)]
+        per sample, so that they can be communicated with a single buffer
+        based collective.
+        """
+        nlocal = self.last - self.first
+        sizes = self.gradient_sizes() if compute_derivative else ()
+        buf = np.zeros((nlocal, 1 + sum(sizes)))
+        npoints = len(self.points)
+        start = 0
+        for bbs, Js in self.evaluate_chunks():
+            rows = buf[start:start+len(Js)]
+            start += len(Js)
+            local = [J.value_and_grad(compute_derivative=compute_derivative, coil_derivatives=False) for J in Js]
+            rows[:, 0] = [J for (J, _) in local]
+            if not compute_derivative:
+                continue
+            v     = np.asarray([dJ["B"] for (_, dJ) in local]).reshape((-1, npoints, 3))
+            vgrad = np.asarray([dJ["dB_by_dX"] for (_, dJ) in local]).reshape((-1, npoints, 3, 3))
+            dJ_by_detabar, dJ_by_dma, dJ_by_dcurrents, dJ_by_dcoils = np.split(rows[:, 1:], np.cumsum(sizes)[:-1], axis=1)
+            dJ_by_detabar[:] = [dJ["etabar"] for (_, dJ) in local]
+            dJ_by_dma[:] = [dJ["magneticaxiscoefficients"] for (_, dJ) in local]
+            dJ_by_dcurrents[:] = self.local_dJ_by_dcoilcurrents(bbs, v, vgrad)
+            dJ_by_dcoils[:] = self.local_dJ_by_dcoilcoefficients(bbs, v, vgrad)
+        return buf
+
+    def unpack_gradients(self, buf):
+        """ Split the gradient columns of a packed buffer into a dict of views. """
+        return dict(zip(self.gradient_keys, np.split(buf, np.cumsum(self.gradient_sizes())[:-1], axis=-1)))
+
+    def value_and_grad_samples(self, compute_derivative=True):
+        """
+        Fused version of `J_samples` and the `dJ_by_*_samples` methods, built
+        on `BiotSavartQuasiSymmetricFieldDifference.value_and_grad`. Returns
+        the values of all samples and, if `compute_derivative` is true, a dict
+        with arrays of shape (nsamples, ndofs) of the per sample derivatives
+        with respect to "etabar", "magneticaxiscoefficients", "coilcurrents"
+        and "coilcoefficients" (the coil derivatives already reduced over the
+        symmetric copies). Everything is communicated in a single `Allgatherv`.
+        Use this when the samples need to be weighted individually, e.g. for
+        the CVaR, otherwise `value_and_mean_grad` moves less data.
+        """
+        buf = self.local_value_and_grad_buffer(compute_derivative)
+        width = buf.shape[1]
+        all_buf = np.empty((self.nsamples, width))
+        comm.Allgatherv(buf, [all_buf, self.sample_counts * width, self.sample_displs * width, MPI.DOUBLE])
+        all_vals = list(all_buf[:, 0])
+        if not compute_derivative:
+            return all_vals, None
+        return all_vals, self.unpack_gradients(all_buf[:, 1:])
+
+    def value_and_mean_grad(self, compute_derivative=True):
+        """
+        Returns the values of all samples and, if `compute_derivative` is true,
+        a dict with the sample mean of the gradients (keys as in
+        `value_and_grad_samples`). The gradients are summed locally and
+        combined with the values, each written to its global slot, in a single
+        `Allreduce`, so the communicated data does not grow with the number of
+        samples times the number of dofs.
+        """
+        buf = self.local_value_and_grad_buffer(compute_derivative)
+        nsamples = self.nsamples
+        total = np.zeros((nsamples + buf.shape[1] - 1, ))
+        total[self.first:self.last] = buf[:, 0]
+        total[nsamples:] = np.sum(buf[:, 1:], axis=0)
+        comm.Allreduce(MPI.IN_PLACE, total, op=MPI.SUM)
+        all_vals = list(total[:nsamples])
+        if not compute_derivative:
+            return all_vals, None
+        return all_vals, self.unpack_gradients(total[nsamples:]/nsamples)
+
+    def value_mean_grad_and_variance(self):
+        """
+        Same as `value_and_mean_grad`, but additionally returns a dict with the
+        sample variance of every gradient component, e.g. for the norm test of
+        `NormTest`. The sums of squares are included in the single `Allreduce`.
+        """
+        buf = self.local_value_and_grad_buffer()
+        nsamples, width = self.nsamples, buf.shape[1] - 1
+        total = np.zeros((nsamples + 2 * width, ))
+        total[self.first:self.last] = buf[:, 0]
+        total[nsamples:nsamples+width] = np.sum(buf[:, 1:], axis=0)
+        total[nsamples+width:] = np.sum(buf[:, 1:]**2, axis=0)
+        comm.Allreduce(MPI.IN_PLACE, total, op=MPI.SUM)
+        mean = total[nsamples:nsamples+width]/nsamples
+        variance = (total[nsamples+width:] - nsamples * mean**2)/max(nsamples - 1, 1)
+        return list(total[:nsamples]), self.unpack_gradients(mean), self.unpack_gradients(np.maximum(variance, 0))
+
+    def control_sensitivity(self):
+        """
+        dJ_0/dgamma and dJ_0/d(dgamma_by_dphi) of the objective J_0 of the
+        unperturbed coils, stacked to shape (ncoils, nquadpoints, 6).
+        """
+        J0 = BiotSavartQuasiSymmetricFieldDifference(self.qsf, self.nominal_biotsavart)
+        _, dJ = J0.value_and_grad(coil_derivatives=False)
+        dJ_by_dgammas, dJ_by_ddgamma_by_dphis = self.nominal_biotsavart.compute_vjp(self.points, dJ["B"], dJ["dB_by_dX"])
+        return np.concatenate((np.asarray(dJ_by_dgammas), np.asarray(dJ_by_ddgamma_by_dphis)), axis=2)
+
+    def local_controls(self):
+        r"""
+        The first order change of the unperturbed objective J_0 due to the
+        perturbation \delta_i of every local sample,
+            C_i = dJ_0/d\gamma \cdot \delta_i + dJ_0/d\gamma' \cdot \delta'_i.
+        It has mean zero and for small perturbations it is the leading part of
+        J_i - J_0, which makes it a good control variate.
+        """
+        sensitivity = self.control_sensitivity()
+        controls = np.zeros((self.last - self.first, ))
+        for start in range(self.first, self.last, self.chunk_size):
+            idxs = range(start, min(start + self.chunk_size, self.last))
+            deltas = LinearisedBatchedBiotSavart(self.nominal_biotsavart, [self.samples[i] for i in idxs]).perturbations()
+            controls[start-self.first:start-self.first+len(idxs)] = np.einsum('scjb,cjb->s', deltas, sensitivity)
+            self.samples.release()
+        return controls
+
+    def latent_sensitivity(self):
+        """
+        The derivative of the controls of `local_controls` with respect to the
+        normal numbers of a sample, in the order in which they are drawn.
+        """
+        sensitivity = self.control_sensitivity()
+        sampler = self.samples.sampler
+        return np.concatenate([sampler.sample_vjp([s[:, :3], s[:, 3:]]) for s in sensitivity])
+
+    def set_tail_shift(self, alpha):
+        r"""
+        Importance sampling for the tail beyond the `alpha` quantile, e.g. for
+        the CVaR: to first order J_i - J_0 = g \cdot z_i for the normal
+        numbers z_i of the sample, with g from `latent_sensitivity`. The tail
+        of J is then the tail of the standard normal g \cdot z/|g|, whose mean
+        beyond the `alpha` quantile q_\alpha is \phi(q_\alpha)/(1-\alpha). The
+        samples are drawn with their mean shifted by that amount in the
+        direction of g, so that about half of them fall into the tail, and
+        are reweighted with `likelihood_ratios`. With `alpha=None` the shift is
+        removed.
+        """
+        if alpha is None:
+            self.samples.set_shift(None)
+            return
+        from scipy.stats import norm
+        g = self.latent_sensitivity()
+        self.samples.set_shift(norm.pdf(norm.ppf(alpha))/(1-alpha) * g/np.linalg.norm(g))
+
+    def likelihood_ratios(self):
+        """
+        The likelihood ratios of all samples, see
+        `PerturbedCoilSamples.log_likelihood_ratio`, or `None` if the samples
+        are not shifted.
+        """
+        if self.samples.shift is None:
+            return None
+        local = np.exp([self.samples.log_likelihood_ratio(i) for i in range(self.first, self.last)])
+        ratios = np.empty((self.nsamples, ))
+        comm.Allgatherv(local, [ratios, self.sample_counts, self.sample_displs, MPI.DOUBLE])
+        return ratios
+
+    def value_and_controlled_mean_grad(self, control_variate, compute_derivative=True):
+        """
+        Same as `value_and_mean_grad`, but the mean value and gradient are
+        estimated with the `ControlVariate` `control_variate` and the
+        controls of `local_controls`. The sums needed for the estimate and
+        for updating its coefficients are included in the single `Allreduce`,
+        the coefficients are updated once `control_variate.accept()` is called.
+        Returns the values of all samples, the estimated mean value and, if
+        `compute_derivative` is true, the dict of estimated mean gradients.
+        """
+        buf = self.local_value_and_grad_buffer(compute_derivative)
+        controls = self.local_controls()
+        nsamples, width = self.nsamples, buf.shape[1]
+        total = np.zeros((nsamples + 2 * width + 2, ))
+        total[self.first:self.last] = buf[:, 0]
+        sum_x, sum_xc = total[nsamples:nsamples+width], total[nsamples+width:nsamples+2*width]
+        sum_x[:] = np.sum(buf, axis=0)
+        sum_xc[:] = controls @ buf
+        total[-2:] = [np.sum(controls), np.sum(controls**2)]
+        comm.Allreduce(MPI.IN_PLACE, total, op=MPI.SUM)
+        sum_c, sum_cc = total[-2:]
+        all_vals = list(total[:nsamples])
+        if not compute_derivative:
+            mean = control_variate.estimate(sum_x/nsamples, sum_c/nsamples)
+            return all_vals, mean[0], None
+        mean = control_variate.estimate(sum_x/nsamples, sum_c/nsamples, sum_xc, sum_cc, nsamples)
+        return all_vals, mean[0], self.unpack_gradients(mean[1:])
+
+    def value_and_weighted_grad(self, weights, compute_derivative=True):
+        """
+        Two phase evaluation for objectives that weight the samples by their
+        values, e.g. the CVaR: first the values of all samples are gathered
+        with an `Allgatherv`, then `weights(values)` returns one weight per
+        sample, the local gradients are weighted and summed on each rank, and
+        a single `Allreduce` of size ndofs combines them. Returns the values of
+        all samples and, if `compute_derivative` is true, the dict of weighted
+        gradient sums (keys as in `value_and_grad_samples`).
+        """
+        buf = self.local_value_and_grad_buffer(compute_derivative)
+        all_vals = np.empty((self.nsamples, ))
+        comm.Allgatherv(np.ascontiguousarray(buf[:, 0]), [all_vals, self.sample_counts, self.sample_displs, MPI.DOUBLE])
+        if not compute_derivative:
+            return list(all_vals), None
+        local_weights = np.asarray(weights(all_vals))[self.first:self.last]
+        grad = local_weights @ buf[:, 1:]
+        comm.Allreduce(MPI.IN_PLACE, grad, op=MPI.SUM)
+        return list(all_vals), self.unpack_gradients(grad)
 
     def dJ_by_dcoilcoefficients_samples(self, t=None):
-        local_vals = [0.5 * 
-                      (
-                          self.stellarator.reduce_coefficient_derivatives(J.dJ_L2_by_dcoilcoefficients())
-                          + self.stellarator.reduce_coefficient_derivatives(J.dJ_H1_by_dcoilcoefficients())
-                      ) for J in self.J_BSvsQS_perturbed]
+        local_vals = [dJ for (bbs, Js) in self.evaluate_chunks() for dJ in self.local_dJ_by_dcoilcoefficients(bbs, *self.dJ_by_dB_samples(Js))]
         all_vals = [i for o in comm.allgather(local_vals) for i in o]
         return all_vals
 
     def dJ_by_dcoilcurrents_samples(self, t=None):
-        local_vals = [0.5 * 
-                      (
-                          self.stellarator.reduce_current_derivatives(J.dJ_L2_by_dcoilcurrents())
-                          + self.stellarator.reduce_current_derivatives(J.dJ_H1_by_dcoilcurrents())
-                      ) for J in self.J_BSvsQS_perturbed]
+        local_vals = [dJ for (bbs, Js) in self.evaluate_chunks() for dJ in self.local_dJ_by_dcoilcurrents(bbs, *self.dJ_by_dB_samples(Js))]
         all_vals = [i for o in comm.allgather(local_vals) for i in o]
         return all_vals
 
     def dJ_by_detabar_samples(self, t=None):
-        local_vals = [0.5 * (J.dJ_L2_by_detabar() + J.dJ_H1_by_detabar()) for J in self.J_BSvsQS_perturbed]
+        local_vals = [0.5 * (J.dJ_L2_by_detabar() + J.dJ_H1_by_detabar()) for (_, Js) in self.evaluate_chunks() for J in Js]
         all_vals = [i for o in comm.allgather(local_vals) for i in o]
         return all_vals
 
     def dJ_by_dmagneticaxiscoefficients_samples(self, t=None):
-        local_vals = [0.5 * (J.dJ_L2_by_dmagneticaxiscoefficients() + J.dJ_H1_by_dmagneticaxiscoefficients()) for J in self.J_BSvsQS_perturbed]
+        local_vals = [0.5 * (J.dJ_L2_by_dmagneticaxiscoefficients() + J.dJ_H1_by_dmagneticaxiscoefficients()) for (_, Js) in self.evaluate_chunks() for J in Js]
         all_vals = [i for o in comm.allgather(local_vals) for i in o]
         return all_vals
+
+
+class MultilevelStochasticQuasiSymmetryObjective():
+
+    def __init__(self, stellarator, sampler, nsamples, qsf, seed, nquadpoints, **kwargs):
+        r"""
+        Multilevel Monte Carlo over the number of quadrature points of the
+        coils. The finest level L is `stellarator` itself, the levels
+        l = 0, ..., L-1 are copies of it whose base coils are evaluated at
+        `nquadpoints[l]` (increasing) uniformly spaced points. With J_l the
+        objective of a sample on level l,
+            E[f(J_L)] = E[f(J_0)] + \sum_{l=1}^L E[f(J_l) - f(J_{l-1})],
+        and the term of level l is estimated with `nsamples[l]` samples that
+        use the seed `seed + l 2^32`. The two evaluations in a correction term
+        share the perturbation: the sampler of the copies is
+        `sampler.at_points`, so `sampler` has to use `method="kl"`, and both
+        evaluations use the same seed. As the corrections are small, most of
+        the samples can be spent on the cheap coarse levels, see
+        `optimal_nsamples`.
+
+        Every sample evaluation k enters the estimate with a weight c_k, which
+        is 1/N_l or -1/N_l, so the estimator is a weighted mean over all
+        evaluations. `likelihood_ratios` returns the weights relative to the
+        plain mean over all evaluations, so that for example `CVaR` can use
+        them in the same way as the likelihood ratios of importance sampling.
+
+        The keyword arguments are passed to the `StochasticQuasiSymmetryObjective`
+        of every level.
+        """
+        if len(nsamples) != len(nquadpoints) + 1:
+            raise ValueError("Need the number of samples for every level.")
+        self.stellarator = stellarator
+        self.qsf = qsf
+        self.nquadpoints = list(nquadpoints) + [len(stellarator._base_coils[0].points)]
+        self.stellarators = [self.coarse_stellarator(n) for n in nquadpoints] + [stellarator]
+        samplers = [sampler.at_points(s._base_coils[0].points) for s in self.stellarators[:-1]] + [sampler]
+        # objectives[l] evaluates the samples of level l on level l and, for
+        # l > 0, on level l-1
+        self.objectives = [[
+            StochasticQuasiSymmetryObjective(self.stellarators[k], samplers[k], nsamples[l], qsf, seed + (l << 32), **kwargs)
+            for k in ([l] if l == 0 else [l, l-1])] for l in range(len(nsamples))]
+        self.linearised = self.objectives[0][0].linearised
+        self.values = None
+
+    def coarse_stellarator(self, nquadpoints):
+        """ A copy of `stellarator` with the base coils evaluated at `nquadpoints` points. """
+        coils = []
+        for coil in self.stellarator._base_coils:
+            if not isinstance(coil, CartesianFourierCurve):
+                raise TypeError("Coarse levels need CartesianFourierCurve coils, got %s." % type(coil).__name__)
+            coarse_coil = CartesianFourierCurve(coil.order, np.linspace(0, 1, nquadpoints, endpoint=False))
+            coarse_coil.set_dofs(coil.get_dofs())
+            coils.append(coarse_coil)
+        return CoilCollection(coils, self.stellarator.get_currents(), self.stellarator.nfp, self.stellarator.stellerator_symmetrie)
+
+    def all_objectives(self):
+        return [J for Js in self.objectives for J in Js]
+
+    @property
+    def nsamples(self):
+        """ The total number of sample evaluations over all levels. """
+        return sum(J.nsamples for J in self.all_objectives())
+
+    @property
+    def level_nsamples(self):
+        return [Js[0].nsamples for Js in self.objectives]
+
+    def set_nsamples(self, nsamples):
+        """ Use `nsamples[l]` samples on level l, see `StochasticQuasiSymmetryObjective.set_nsamples`. """
+        for Js, n in zip(self.objectives, nsamples):
+            for J in Js:
+                J.set_nsamples(n)
+
+    def resample(self):
+        for J in self.all_objectives():
+            J.resample()
+
+    def set_magnetic_axis(self, gamma):
+        """ Copy the coil dofs and currents of `stellarator` to the coarse levels and set the axis. """
+        dofs, currents = self.stellarator.get_dofs(), self.stellarator.get_currents()
+        for stellarator in self.stellarators[:-1]:
+            stellarator.set_dofs(dofs)
+            stellarator.set_currents(currents)
+        for J in self.all_objectives():
+            J.set_magnetic_axis(gamma)
+
+    def linearisation_error(self, nsamples=1):
+        return max(J.linearisation_error(nsamples) for J in self.all_objectives())
+
+    def sample_weights(self):
+        """ The weights c_k of all sample evaluations, ordered as the values. """
+        return np.concatenate([
+            sign * np.full((J.nsamples, ), 1./J.nsamples) for Js in self.objectives for (J, sign) in zip(Js, [1., -1.])])
+
+    def likelihood_ratios(self):
+        return self.nsamples * self.sample_weights()
+
+    def value_and_weighted_grad(self, weights, compute_derivative=True):
+        """
+        Same as `StochasticQuasiSymmetryObjective.value_and_weighted_grad`,
+        for the values of all evaluations of all levels. The gradients of all
+        levels are summed locally and combined in a single `Allreduce`.
+        """
+        objectives = self.all_objectives()
+        bufs = [J.local_value_and_grad_buffer(compute_derivative) for J in objectives]
+        all_vals = []
+        for J, buf in zip(objectives, bufs):
+            vals = np.empty((J.nsamples, ))
+            comm.Allgatherv(np.ascontiguousarray(buf[:, 0]), [vals, J.sample_counts, J.sample_displs, MPI.DOUBLE])
+            all_vals.append(vals)
+        self.values = all_vals
+        all_vals = np.concatenate(all_vals)
+        if not compute_derivative:
+            return list(all_vals), None
+        all_weights = np.asarray(weights(all_vals))
+        grad = np.zeros((bufs[0].shape[1] - 1, ))
+        offset = 0
+        for J, buf in zip(objectives, bufs):
+            grad += all_weights[offset+J.first:offset+J.last] @ buf[:, 1:]
+            offset += J.nsamples
+        comm.Allreduce(MPI.IN_PLACE, grad, op=MPI.SUM)
+        return list(all_vals), objectives[0].unpack_gradients(grad)
+
+    def value_and_mean_grad(self, compute_derivative=True):
+        """
+        The values of all evaluations and, if `compute_derivative` is true, the
+        multilevel estimate of the mean gradient. The multilevel estimate of
+        the mean value is `likelihood_ratios() @ values/nsamples`.
+        """
+        return self.value_and_weighted_grad(lambda vals: self.sample_weights(), compute_derivative=compute_derivative)
+
+    def J_samples(self):
+        return self.value_and_weighted_grad(None, compute_derivative=False)[0]
+
+    def level_variances(self):
+        """
+        The sample variances of J_0 and of the corrections J_l - J_{l-1} of
+        the last evaluation.
+        """
+        if self.values is None:
+            raise RuntimeError("The level variances are only known after the objective has been evaluated with value_and_weighted_grad.")
+        variances = []
+        offset = 0
+        for l, Js in enumerate(self.objectives):
+            Y = self.values[offset] if l == 0 else self.values[offset] - self.values[offset+1]
+            variances.append(np.var(Y, ddof=1) if len(Y) > 1 else 0.)
+            offset += len(Js)
+        return np.asarray(variances)
+
+    def finest_level_values(self):
+        """
+        The values of the samples of the finest level L on level L in the last
+        evaluation. Unlike the values of all evaluations, these are i.i.d.
+        samples of J_L and can be used for quantiles and the like.
+        """
+        if self.values is None:
+            raise RuntimeError("The finest level values are only known after the objective has been evaluated with value_and_weighted_grad.")
+        return self.values[len(self.values) - len(self.objectives[-1])]
+
+    def level_costs(self):
+        """ The cost of a sample on every level, proportional to the number of coil quadrature points. """
+        return np.asarray([self.nquadpoints[l] + (self.nquadpoints[l-1] if l > 0 else 0) for l in range(len(self.objectives))], dtype=np.float64)
+
+    def optimal_nsamples(self, tol):
+        r"""
+        The number of samples per level for which the variance of the
+        multilevel estimate of the mean is tol^2 at the least cost (Giles,
+        2008),
+            N_l = tol^{-2} \sqrt{V_l/C_l} \sum_k \sqrt{V_k C_k},
+        with the variances V_l of `level_variances` and the costs C_l of
+        `level_costs`. At least two samples are used per level.
+        """
+        V, C = self.level_variances(), self.level_costs()
+        N = np.sqrt(V/C) * np.sum(np.sqrt(V*C))/tol**2
+        return [max(int(np.ceil(n)), 2) for n in N]
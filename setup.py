@@ -39,7 +39,7 @@ class get_numpy_include(object):
 ext_modules = [
     Extension(
         'cppplasmaopt',
-        ['cppplasmaopt/main.cpp', 'cppplasmaopt/biot_savart_all.cpp', 'cppplasmaopt/biot_savart_by_dcoilcoeff_all.cpp',
+        ['cppplasmaopt/main.cpp', 'cppplasmaopt/biot_savart_all.cpp', 'cppplasmaopt/biot_savart_by_dcoilcoeff_all.cpp', 'cppplasmaopt/biot_savart_vjp.cpp', 'cppplasmaopt/biot_savart_tiled.cpp', 'cppplasmaopt/biot_savart_batched.cpp',
          'cppplasmaopt/biot_savart_B.cpp', 'cppplasmaopt/biot_savart_dB_by_dX.cpp', 'cppplasmaopt/biot_savart_d2B_by_dXdX.cpp',
          'cppplasmaopt/biot_savart_dB_by_dcoilcoeff.cpp', 'cppplasmaopt/biot_savart_d2B_by_dXdcoilcoeff.cpp'],
         include_dirs=[
@@ -129,7 +129,7 @@ setup(
     name='PlasmaOpt',
     long_description='',
     ext_modules=ext_modules,
-    install_requires=['pybind11>=2.4', 'sympy', 'property_manager3', 'numpy', 'scipy', 'argparse', 'mpi4py', 'matplotlib', 'randomgen'],
+    install_requires=['pybind11>=2.4', 'property_manager3', 'numpy', 'scipy>=1.7', 'argparse', 'mpi4py', 'matplotlib', 'randomgen'],
     setup_requires=['pybind11>=2.4'],
     cmdclass={'build_ext': BuildExt},
     packages = ["pyplasmaopt"],
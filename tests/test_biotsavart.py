@@ -168,3 +168,185 @@ if __name__ == "__main__":
     plt.show()
 
 
+
+@pytest.mark.parametrize("use_cpp", [True, False])
+def test_biotsavart_vjp_matches_dcoilcoeff(use_cpp):
+    coil = get_coil()
+    bs = BiotSavart([coil], [1e4])
+    points = np.asarray(17 * [[-1.41513202e-03,  8.99999382e-01, -3.14473221e-04 ]])
+    points += 0.001 * (np.random.rand(*points.shape)-0.5)
+    bs.set_points(points)
+    v = np.random.rand(*points.shape)
+    vgrad = np.random.rand(points.shape[0], 3, 3)
+    bs.compute_by_dcoilcoeff(points, use_cpp=use_cpp)
+    dJ_B  = np.einsum('ij,ikj->k', v, bs.dB_by_dcoilcoeffs[0])
+    dJ_dB = np.einsum('ijk,iljk->l', vgrad, bs.d2B_by_dXdcoilcoeffs[0])
+    assert np.allclose(bs.B_vjp(v, use_cpp=use_cpp)[0], dJ_B)
+    assert np.allclose(bs.dB_by_dX_vjp(vgrad, use_cpp=use_cpp)[0], dJ_dB)
+    assert np.allclose(bs.B_and_dB_vjp(v, vgrad, use_cpp=use_cpp)[0], dJ_B + dJ_dB)
+
+@pytest.mark.parametrize("tol", [1e-3, 1e-6])
+def test_biotsavart_treecode_matches_direct(tol):
+    from pyplasmaopt import get_ncsx_data, CoilCollection
+    coils, ma, currents = get_ncsx_data(Nt=25, ppp=10)
+    stellerator = CoilCollection(coils, currents, 3, True)
+    np.random.seed(1)
+    points = np.concatenate([s * ma.gamma + 0.1 * np.random.standard_normal(size=ma.gamma.shape) for s in [1., 2., 4.]])
+    direct = BiotSavart(stellerator.coils, stellerator.currents)
+    treecode = BiotSavart(stellerator.coils, stellerator.currents, backend="treecode", tol=tol)
+    B, dB_by_dX = direct.evaluate(points, compute_dB_by_dX=True)
+    Btree, dB_by_dXtree = treecode.evaluate(points, compute_dB_by_dX=True)
+    assert np.max(np.linalg.norm(Btree-B, axis=1)/np.linalg.norm(B, axis=1)) < 10 * tol
+    assert np.max(np.linalg.norm(dB_by_dXtree-dB_by_dX, axis=(1, 2))/np.linalg.norm(dB_by_dX, axis=(1, 2))) < 10 * tol
+
+def test_biotsavart_treecode_follows_coil_changes():
+    from pyplasmaopt import get_ncsx_data, CoilCollection
+    coils, ma, currents = get_ncsx_data(Nt=25, ppp=10)
+    stellerator = CoilCollection(coils, currents, 3, True)
+    points = 2 * ma.gamma
+    direct = BiotSavart(stellerator.coils, stellerator.currents)
+    treecode = BiotSavart(stellerator.coils, stellerator.currents, backend="treecode", tol=1e-6)
+    treecode.evaluate(points)
+    stellerator.set_currents(2 * np.asarray(currents))
+    B = direct.evaluate(points)
+    assert np.max(np.linalg.norm(treecode.evaluate(points)-B, axis=1)/np.linalg.norm(B, axis=1)) < 1e-5
+    np.random.seed(1)
+    stellerator.set_dofs(stellerator.get_dofs() + 1e-2 * np.random.standard_normal(size=stellerator.get_dofs().shape))
+    B = direct.evaluate(points)
+    assert np.max(np.linalg.norm(treecode.evaluate(points)-B, axis=1)/np.linalg.norm(B, axis=1)) < 1e-5
+
+@pytest.mark.parametrize("num_threads", [0, 1, 3])
+@pytest.mark.parametrize("chunk_size", [0, 1, 7])
+def test_biotsavart_tiled_matches_default(num_threads, chunk_size):
+    coils = [get_coil(), get_coil(50)]
+    points = np.asarray(17 * [[-1.41513202e-03,  8.99999382e-01, -3.14473221e-04 ]])
+    points += 0.001 * (np.random.rand(*points.shape)-0.5)
+    bs = BiotSavart(coils, [1e4, -2e4]).compute(points)
+    bs.compute_by_dcoilcoeff(points)
+    bs_tiled = BiotSavart(coils, [1e4, -2e4], num_threads=num_threads, chunk_size=chunk_size).compute(points)
+    bs_tiled.compute_by_dcoilcoeff(points)
+    for attr in ["B", "dB_by_dX", "d2B_by_dXdX"]:
+        assert np.allclose(getattr(bs, attr), getattr(bs_tiled, attr), rtol=1e-13, atol=0)
+    for attr in ["dB_by_dcoilcurrents", "d2B_by_dXdcoilcurrents", "dB_by_dcoilcoeffs", "d2B_by_dXdcoilcoeffs"]:
+        for a, b in zip(getattr(bs, attr), getattr(bs_tiled, attr)):
+            assert np.allclose(a, b, rtol=1e-13, atol=0)
+
+@pytest.mark.parametrize("use_cpp", [True, False])
+def test_biotsavart_symmetric_matches_full(use_cpp):
+    from pyplasmaopt import get_ncsx_data, CoilCollection
+    coils, ma, currents = get_ncsx_data(Nt=4, ppp=10)
+    stellerator = CoilCollection(coils, currents, 3, True)
+    points = ma.gamma[:7] + 0.05
+    full = BiotSavart(stellerator.coils, stellerator.currents).compute(points, use_cpp=use_cpp)
+    full.compute_by_dcoilcoeff(points, use_cpp=use_cpp)
+    symm = BiotSavart(stellerator._base_coils, stellerator._base_currents, symmetries=stellerator.symmetries).compute(points, use_cpp=use_cpp)
+    symm.compute_by_dcoilcoeff(points, use_cpp=use_cpp)
+    for attr in ["B", "dB_by_dX", "d2B_by_dXdX"]:
+        assert np.allclose(getattr(full, attr), getattr(symm, attr), rtol=1e-13, atol=1e-13)
+    for attr in ["dB_by_dcoilcurrents", "d2B_by_dXdcoilcurrents"]:
+        assert np.allclose(stellerator.reduce_current_derivatives(getattr(full, attr)),
+                           stellerator.reduce_current_derivatives(getattr(symm, attr)), rtol=1e-13, atol=1e-13)
+    for attr in ["dB_by_dcoilcoeffs", "d2B_by_dXdcoilcoeffs"]:
+        assert np.allclose(stellerator.reduce_coefficient_derivatives(getattr(full, attr), axis=1),
+                           stellerator.reduce_coefficient_derivatives(getattr(symm, attr), axis=1), rtol=1e-13, atol=1e-13)
+    full.set_points(points)
+    symm.set_points(points)
+    v = np.random.standard_normal(size=(len(points), 3))
+    vgrad = np.random.standard_normal(size=(len(points), 3, 3))
+    assert np.allclose(stellerator.reduce_coefficient_derivatives(full.B_and_dB_vjp(v, vgrad, use_cpp=use_cpp)),
+                       stellerator.reduce_coefficient_derivatives(symm.B_and_dB_vjp(v, vgrad, use_cpp=use_cpp)), rtol=1e-13, atol=1e-13)
+
+@pytest.mark.parametrize("use_cpp", [True, False])
+def test_biotsavart_batched_matches_single(use_cpp):
+    from pyplasmaopt import BatchedBiotSavart, GaussianPerturbedCurve, GaussianSampler
+    coils = [get_coil(40), get_coil(40)]
+    coils[1].coefficients[2][0] = 0.3
+    coils[1].update()
+    currents = [1e4, -2e4]
+    sampler = GaussianSampler(coils[0].points, 0.01, 0.3)
+    coil_sets = [[GaussianPerturbedCurve(coil, sampler) for coil in coils] for i in range(3)]
+    points = np.asarray(5 * [[-1.41513202e-03,  8.99999382e-01, -3.14473221e-04 ]])
+    points += 0.001 * (np.random.rand(*points.shape)-0.5)
+    bbs = BatchedBiotSavart(coil_sets, currents)
+    bbs.set_points(points)
+    v = np.random.standard_normal(size=(len(coil_sets), len(points), 3))
+    vgrad = np.random.standard_normal(size=(len(coil_sets), len(points), 3, 3))
+    vjps = bbs.B_and_dB_vjp(v, vgrad, use_cpp=use_cpp)
+    bbs.compute(points, use_cpp=use_cpp)
+    for i, coil_set in enumerate(coil_sets):
+        bs = BiotSavart(coil_set, currents)
+        bs.set_points(points)
+        for attr in ["B", "dB_by_dX", "d2B_by_dXdX", "dB_by_dcoilcurrents", "d2B_by_dXdcoilcurrents"]:
+            assert np.allclose(getattr(bbs, attr)[i], getattr(bs, attr), rtol=1e-13, atol=1e-13)
+        for vjp, vjp_single in zip(vjps[i], bs.B_and_dB_vjp(v[i], vgrad[i])):
+            assert np.allclose(vjp, vjp_single, rtol=1e-13, atol=1e-13)
+
+def test_dB_by_dcoilgeometry_matches_dcoilcoeff():
+    coil = get_coil(40)
+    bs = BiotSavart([coil], [1e4])
+    points = np.asarray(5 * [[-1.41513202e-03,  8.99999382e-01, -3.14473221e-04 ]])
+    points += 0.001 * (np.random.rand(*points.shape)-0.5)
+    bs.set_points(points)
+    # chain rule through the quadrature points and tangents
+    dgeometry_by_dcoeff = np.concatenate((coil.dgamma_by_dcoeff, coil.d2gamma_by_dphidcoeff[:, 0, :, :]), axis=2)
+    dfield_by_dcoeff = 1e4 * np.einsum('irjb,jkb->ikr', bs.dB_by_dcoilgeometry[0], dgeometry_by_dcoeff)
+    assert np.allclose(dfield_by_dcoeff[:, :, :3], bs.dB_by_dcoilcoeffs[0], rtol=1e-11, atol=1e-11)
+    assert np.allclose(dfield_by_dcoeff[:, :, 3:], bs.d2B_by_dXdcoilcoeffs[0].reshape((len(points), -1, 9)), rtol=1e-11, atol=1e-11)
+
+def test_d2B_by_dXdXdcoilgeometry_matches_finite_differences():
+    coil = get_coil(40)
+    points = np.asarray(5 * [[-1.41513202e-03,  8.99999382e-01, -3.14473221e-04 ]])
+    points += 0.001 * (np.random.rand(*points.shape)-0.5)
+    bs = BiotSavart([coil], [1e4])
+    bs.set_points(points)
+    dgeometry_by_dcoeff = np.concatenate((coil.dgamma_by_dcoeff, coil.d2gamma_by_dphidcoeff[:, 0, :, :]), axis=2)
+    dfield_by_dcoeff = 1e4 * np.einsum('irjb,jkb->ikr', bs.d2B_by_dXdXdcoilgeometry[0], dgeometry_by_dcoeff)
+    x = coil.get_dofs()
+    h = np.random.standard_normal(size=x.shape)
+    eps = 1e-6
+    d2B = []
+    for sign in [1, -1]:
+        coil.set_dofs(x + sign * eps * h)
+        d2B.append(BiotSavart([coil], [1e4]).compute(points).d2B_by_dXdX.reshape((len(points), 27)))
+    fd = (d2B[0] - d2B[1])/(2*eps)
+    assert np.allclose(fd, np.einsum('ikr,k->ir', dfield_by_dcoeff, h), rtol=0, atol=1e-6 * np.max(np.abs(fd)))
+
+def test_linearised_batched_biotsavart_derivatives():
+    from pyplasmaopt import LinearisedBatchedBiotSavart, GaussianPerturbedCurve, GaussianSampler
+    coils = [get_coil(40), get_coil(40)]
+    coils[1].coefficients[2][0] = 0.3
+    coils[1].update()
+    currents = [1e4, -2e4]
+    sampler = GaussianSampler(coils[0].points, 0.01, 0.3)
+    coil_sets = [[GaussianPerturbedCurve(coil, sampler) for coil in coils] for i in range(2)]
+    points = np.asarray(5 * [[-1.41513202e-03,  8.99999382e-01, -3.14473221e-04 ]])
+    points += 0.001 * (np.random.rand(*points.shape)-0.5)
+    def linearised(points):
+        return LinearisedBatchedBiotSavart(BiotSavart(coils, currents), coil_sets).compute(points)
+    lbs = linearised(points)
+    eps = 1e-6
+
+    # the second derivatives are the x derivatives of the linearised dB_by_dX
+    h = np.random.standard_normal(size=points.shape)
+    fd = (linearised(points + eps * h).dB_by_dX - linearised(points - eps * h).dB_by_dX)/(2*eps)
+    assert np.allclose(fd, np.einsum('siabj,ib->siaj', lbs.d2B_by_dXdX, h), rtol=0, atol=1e-6 * np.max(np.abs(fd)))
+
+    # the vjp is the coil gradient of the linearised v.B + vgrad:dB_by_dX,
+    # the perturbations are kept fixed
+    v = np.random.standard_normal(size=(len(coil_sets), len(points), 3))
+    vgrad = np.random.standard_normal(size=(len(coil_sets), len(points), 3, 3))
+    dJ_by_dgammas, dJ_by_ddgamma_by_dphis = lbs.compute_vjp(points, v, vgrad)
+    xs = [coil.get_dofs() for coil in coils]
+    hs = [np.random.standard_normal(size=x.shape) for x in xs]
+    Js = []
+    for sign in [1, -1]:
+        for coil, x, h in zip(coils, xs, hs):
+            coil.set_dofs(x + sign * eps * h)
+        lbs_eps = linearised(points)
+        Js.append(np.sum(v * lbs_eps.B, axis=(1, 2)) + np.sum(vgrad * lbs_eps.dB_by_dX, axis=(1, 2, 3)))
+    for coil, x in zip(coils, xs):
+        coil.set_dofs(x)
+    fd = (Js[0] - Js[1])/(2*eps)
+    dJ = [sum((coil.dgamma_by_dcoeff_vjp(dJ_by_dgammas[s, i]) + coil.d2gamma_by_dphidcoeff_vjp(dJ_by_ddgamma_by_dphis[s, i])) @ h
+              for i, (coil, h) in enumerate(zip(coils, hs))) for s in range(len(coil_sets))]
+    assert np.allclose(fd, dJ, rtol=1e-6)
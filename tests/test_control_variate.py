@@ -0,0 +1,40 @@
+import numpy as np
+from pyplasmaopt import ControlVariate
+
+def test_control_variate_toy_example():
+    rng = np.random.default_rng(1)
+    nsamples = 50
+    cv = ControlVariate()
+    errs_mc, errs_cv = [], []
+    for i in range(20):
+        # E[X] = (1, 2), the first component is strongly correlated with C
+        c = rng.standard_normal(size=(nsamples, ))
+        x = np.stack((1 + 3*c + 0.1*rng.standard_normal(size=(nsamples, )), 2 + rng.standard_normal(size=(nsamples, ))), axis=1)
+        est = cv.estimate(np.mean(x, axis=0), np.mean(c), c @ x, c @ c, nsamples)
+        cv.accept()
+        if i == 0:
+            # no coefficient is known yet
+            assert np.allclose(est, np.mean(x, axis=0))
+            continue
+        errs_mc.append(np.abs(np.mean(x, axis=0) - [1, 2]))
+        errs_cv.append(np.abs(est - [1, 2]))
+    assert np.allclose(cv.coefficient(), [3, 0], atol=0.15)
+    assert np.mean(errs_cv, axis=0)[0] < 0.1 * np.mean(errs_mc, axis=0)[0]
+    assert np.mean(errs_cv, axis=0)[1] < 1.5 * np.mean(errs_mc, axis=0)[1]
+
+
+def test_control_variate_accept():
+    rng = np.random.default_rng(1)
+    cv = ControlVariate()
+    c = rng.standard_normal(size=(10, ))
+    x = 2*c + rng.standard_normal(size=(10, ))
+    cv.estimate(np.mean(x), np.mean(c), c @ x, c @ c, 10)
+    # e.g. a rejected trial point of a line search
+    cv.estimate(np.mean(x) + 1, np.mean(c), c @ x + 100, c @ c, 10)
+    assert cv.coefficient() == 0.
+    cv.estimate(np.mean(x), np.mean(c), c @ x, c @ c, 10)
+    cv.accept()
+    beta = cv.coefficient()
+    assert np.isclose(beta, np.cov(x, c)[0, 1]/np.var(c, ddof=1))
+    cv.accept()
+    assert cv.coefficient() == beta
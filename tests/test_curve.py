@@ -80,6 +80,32 @@ def test_coil_dof_numbering():
     cfc.set_dofs(coeffs)
     assert(np.allclose(coeffs, cfc.get_dofs()))
 
+def test_coil_fourier_basis():
+    from math import pi
+    x = np.random.rand(11)
+    cfc = get_coil(x)
+    expected = np.stack([
+        np.zeros_like(x),
+        1. + 0.5 * np.sin(2*pi*x),
+        0.5 * np.cos(2*pi*x)
+    ], axis=1)
+    assert np.allclose(cfc.gamma, expected)
+    assert np.allclose(cfc.dgamma_by_dphi[:, 0, :], np.einsum('ijk,j->ik', cfc.d2gamma_by_dphidcoeff[:, 0, :, :], cfc.get_dofs()))
+    assert np.allclose(cfc.d3gamma_by_dphidphidphi[:, 0, 0, 0, :], np.einsum('ijk,j->ik', cfc.d4gamma_by_dphidphidphidcoeff[:, 0, 0, 0, :, :], cfc.get_dofs()))
+    assert get_coil(x).dgamma_by_dcoeff is cfc.dgamma_by_dcoeff
+
+def test_coil_coefficient_derivative_vjp():
+    from pyplasmaopt import RotatedCurve
+    cfc = get_coil(np.random.rand(11))
+    for curve in [cfc, RotatedCurve(cfc, 0.3, True)]:
+        v = np.random.standard_normal(size=curve.gamma.shape)
+        assert np.allclose(curve.dgamma_by_dcoeff_vjp(v), np.einsum('ij,ikj->k', v, curve.dgamma_by_dcoeff))
+        assert np.allclose(curve.d2gamma_by_dphidcoeff_vjp(v), np.einsum('ij,ikj->k', v, curve.d2gamma_by_dphidcoeff[:, 0, :, :]))
+        assert np.allclose(curve.d3gamma_by_dphidphidcoeff_vjp(v), np.einsum('ij,ikj->k', v, curve.d3gamma_by_dphidphidcoeff[:, 0, 0, :, :]))
+        assert np.allclose(curve.d4gamma_by_dphidphidphidcoeff_vjp(v), np.einsum('ij,ikj->k', v, curve.d4gamma_by_dphidphidphidcoeff[:, 0, 0, 0, :, :]))
+        vs = np.random.standard_normal(size=(4, ) + curve.gamma.shape)
+        assert np.allclose(curve.dgamma_by_dcoeff_vjp(vs), [curve.dgamma_by_dcoeff_vjp(v) for v in vs])
+
 def test_coil_coefficient_derivative():
     cfc = get_coil()
     coeffs = cfc.get_dofs()
@@ -112,6 +138,27 @@ def test_coil_curvature_derivative():
         return cfc.dkappa_by_dcoeff.copy()
     taylor_test(f, df, coeffs)
 
+def test_coil_lazy_invalidation():
+    from pyplasmaopt import RotatedCurve, GaussianPerturbedCurve, GaussianSampler
+    cfc = get_coil(np.linspace(0, 1, 20, endpoint=False))
+    rotated = RotatedCurve(cfc, 0.3, True)
+    perturbed = GaussianPerturbedCurve(rotated, GaussianSampler(cfc.points, 0.01, 0.2))
+    gamma, kappa = rotated.gamma, perturbed.kappa
+    assert rotated.gamma is gamma and perturbed.kappa is kappa
+    # setting the same dofs does not invalidate anything
+    version = cfc.version
+    cfc.set_dofs(cfc.get_dofs().copy())
+    assert cfc.version == version and rotated.gamma is gamma
+    dofs = cfc.get_dofs()
+    dofs[0] += 0.1
+    cfc.set_dofs(dofs)
+    assert np.allclose(rotated.gamma, (cfc.gamma @ rotated.rotmat))
+    assert np.allclose(rotated.gamma, gamma + np.asarray([0.1, 0, 0]) @ rotated.rotmat)
+    assert np.allclose(perturbed.gamma, rotated.gamma + perturbed.sample[0])
+    assert np.allclose(perturbed.kappa, kappa)
+    perturbed.resample()
+    assert np.allclose(perturbed.gamma, rotated.gamma + perturbed.sample[0])
+
 def get_magnetic_axis(x=np.asarray([0.12345])):
     from pyplasmaopt import StelleratorSymmetricCylindricalFourierCurve
 
@@ -288,6 +335,17 @@ def test_magnetic_axis_dkappa_by_dphi_derivative():
     taylor_test(f, df, coeffs)
 
 
+def test_magnetic_axis_frenet_frame_vjp():
+    ma = get_magnetic_axis(np.random.rand(11))
+    N = len(ma.points)
+    v_t, v_n, v_b = [np.random.standard_normal(size=(N, 3)) for _ in range(3)]
+    v_kappa, v_dkappa_by_dphi, v_torsion, v_l = [np.random.standard_normal(size=(N, )) for _ in range(4)]
+    (dt, dn, db) = ma.dfrenet_frame_by_dcoeff
+    expected = np.einsum('ij,ikj->k', v_t, dt) + np.einsum('ij,ikj->k', v_n, dn) + np.einsum('ij,ikj->k', v_b, db) \
+        + v_kappa @ ma.dkappa_by_dcoeff[:, :, 0] + v_dkappa_by_dphi @ ma.d2kappa_by_dphidcoeff[:, 0, :, 0] \
+        + v_torsion @ ma.dtorsion_by_dcoeff[:, :, 0] + v_l @ ma.dincremental_arclength_by_dcoeff[:, :, 0]
+    assert np.allclose(ma.frenet_frame_vjp(v_t, v_n, v_b, v_kappa, v_dkappa_by_dphi, v_torsion, v_l), expected)
+
 def test_magnetic_axis_frenet_frame():
     ma = get_magnetic_axis()
     (t, n, b) = ma.frenet_frame
@@ -298,6 +356,78 @@ def test_magnetic_axis_frenet_frame():
     assert np.allclose(np.sum(n*n, axis=1), 1)
     assert np.allclose(np.sum(b*b, axis=1), 1)
 
+@pytest.mark.parametrize("length_scale", [0.2, 0.5])
+def test_gaussian_sampler_fft_matches_dense(length_scale):
+    from pyplasmaopt import GaussianSampler
+    n = 20
+    points = np.linspace(0, 1, n, endpoint=False)
+    dense = GaussianSampler(points, 0.01, length_scale, method="dense")
+    fft = GaussianSampler(points, 0.01, length_scale)
+    assert fft.method == "fft"
+
+    class Columns():
+        # feeds the unit vectors to `sample`, which is linear in the random numbers
+        def standard_normal(self, size):
+            return self.z
+    columns = Columns()
+    L = np.zeros((4*n, 4*n))
+    for k in range(4*n):
+        columns.z = np.zeros((4*n, 3))
+        columns.z[k, 0] = 1.
+        L[:, k] = np.concatenate([s[:, 0] for s in fft.sample(columns)])
+    cov = dense.L @ dense.L.T
+    # the truncated sum over periodic images makes the covariance slightly
+    # indefinite for long length scales, so neither square root is exact
+    assert np.allclose(L @ L.T, cov, rtol=0, atol=1e-7 * np.max(np.abs(cov)))
+    assert np.allclose(L, dense.L, rtol=0, atol=1e-4 * np.max(np.abs(dense.L)))
+
+def test_gaussian_sampler_derivatives():
+    from pyplasmaopt import GaussianSampler
+    # the covariance of f' and f is the derivative of the kernel
+    sampler = GaussianSampler(np.linspace(0, 1, 10, endpoint=False), 0.01, 0.3, n_derivs=1, method="dense")
+    u = np.linspace(-0.5, 0.5, 11)
+    eps = 1e-6
+    fd = (sampler.kernel_derivative(u + eps, 0) - sampler.kernel_derivative(u - eps, 0))/(2*eps)
+    assert np.allclose(sampler.kernel_derivative(u, 1), fd, rtol=1e-6, atol=1e-12)
+    assert len(sampler.sample()) == 2
+    cov = sampler.L @ sampler.L.T
+    assert np.allclose(cov[10:, :10], -cov[:10, 10:])
+
+@pytest.mark.parametrize("length_scale", [0.1, 0.2])
+def test_gaussian_sampler_kl_matches_kernel(length_scale):
+    from pyplasmaopt import GaussianSampler, GaussianPerturbedCurve
+    n = 40
+    points = np.linspace(0, 1, n, endpoint=False)
+    sampler = GaussianSampler(points, 0.01, length_scale, method="kl", tol=1e-12)
+    assert sampler.rank < n
+    u = np.subtract.outer(points, points)
+    u -= np.round(u)
+    for a in range(4):
+        for b in range(4):
+            cov = (-1)**b * sampler.kernel_derivative(u, a+b)
+            assert np.allclose(sampler.basis[a] @ sampler.basis[b].T, cov, rtol=0, atol=1e-10 * np.max(np.abs(cov)))
+    sample = sampler.sample()
+    assert len(sample) == 4 and sample[3].shape == (n, 3)
+    coil = get_coil(points)
+    perturbed = GaussianPerturbedCurve(coil, sampler)
+    assert np.allclose(perturbed.gamma - coil.gamma, perturbed.sample[0])
+    assert np.allclose(perturbed.dgamma_by_dphi[:, 0, :] - coil.dgamma_by_dphi[:, 0, :], perturbed.sample[1])
+
+@pytest.mark.parametrize("method", ["dense", "fft", "kl"])
+def test_gaussian_sampler_vjp(method):
+    from pyplasmaopt import GaussianSampler
+    n = 20
+    sampler = GaussianSampler(np.linspace(0, 1, n, endpoint=False), 0.01, 0.2, method=method)
+    rg = np.random.default_rng(1)
+    z = rg.standard_normal(size=(sampler.dimension, ))
+
+    class Fixed():
+        def standard_normal(self, size):
+            return z.reshape(size)
+    sample = sampler.sample(Fixed())
+    v = [rg.standard_normal(size=(n, 3)) for d in range(2)]
+    assert np.isclose(sum(np.sum(v[d] * sample[d]) for d in range(2)), sampler.sample_vjp(v) @ z, rtol=1e-10)
+
 if __name__ == "__main__":
     points = np.linspace(0, 1, 100)
     cfc = get_coil(points)
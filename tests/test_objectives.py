@@ -236,6 +236,275 @@ def test_taylor_test_sigma_by_coeffs():
         print("err_new %s" % (err_new))
     assert eps < 1e-2
 
+@pytest.mark.parametrize("n", [40, 41])
+def test_quasi_symmetric_field_spectral_derivative(n):
+    nfp = 2
+    ma = StelleratorSymmetricCylindricalFourierCurve(3, nfp, np.linspace(0, 1/nfp, n, endpoint=False))
+    qsf = QuasiSymmetricField(-2.25, ma)
+    phi = 2 * np.pi * ma.points
+    f = np.stack([np.cos(3*nfp*phi) + np.sin(nfp*phi), np.sin(5*nfp*phi)], axis=1)
+    df = 2 * np.pi * nfp * np.stack([-3 * np.sin(3*nfp*phi) + np.cos(nfp*phi), 5 * np.cos(5*nfp*phi)], axis=1)
+    assert np.allclose(qsf.diff(f), df, atol=1e-10)
+    assert np.allclose(qsf.D @ f, df, atol=1e-10)
+    # the dense matrix is skew-symmetric and annihilates constants
+    assert np.allclose(qsf.D, -qsf.D.T, atol=1e-10)
+    assert np.allclose(qsf.diff(np.ones((n,))), 0, atol=1e-10)
+
+def test_quasi_symmetric_field_adjoint():
+    nfp = 2
+    (_, _, ma, eta_bar) = get_24_coil_data(nfp=nfp, ppp=20)
+    qsf = QuasiSymmetricField(eta_bar, ma)
+    np.random.seed(1)
+    ma_dofs = ma.get_dofs()
+    # the second solve starts from the factorisation of the first one
+    ma.set_dofs(ma_dofs + 1e-3 * np.random.rand(len(ma_dofs)))
+    qsf.clear_cached_properties()
+    sigma = qsf.sigma
+    fresh = QuasiSymmetricField(eta_bar, ma)
+    assert np.allclose(sigma, fresh.sigma, atol=1e-12)
+    assert abs(qsf.iota - fresh.iota) < 1e-12
+
+    w = np.random.standard_normal(size=(qsf.n, ))
+    v = np.random.standard_normal()
+    dJ_by_detabar, dJ_by_dcoeffs = qsf.adjoint(w, v)
+    assert np.allclose(dJ_by_detabar, w @ qsf.dsigma_by_detabar[:, 0] + v * qsf.diota_by_detabar[0, 0])
+    assert np.allclose(dJ_by_dcoeffs, w @ qsf.dsigma_by_dcoeffs + v * qsf.diota_by_dcoeffs[:, 0])
+
+def test_quasi_symmetric_field_B_and_dB_vjp():
+    nfp = 2
+    (_, _, ma, eta_bar) = get_24_coil_data(nfp=nfp, ppp=20)
+    qsf = QuasiSymmetricField(eta_bar, ma)
+    np.random.seed(1)
+    v = np.random.standard_normal(size=(qsf.n, 3))
+    vgrad = np.random.standard_normal(size=(qsf.n, 3, 3))
+    dJ_by_detabar, dJ_by_dcoeffs = qsf.B_and_dB_vjp(v, vgrad)
+    assert np.allclose(dJ_by_detabar, np.sum(v * qsf.dB_by_detabar[:, 0, :]) + np.sum(vgrad * qsf.d2B_by_detabardX[:, 0, :, :]))
+    assert np.allclose(dJ_by_dcoeffs, np.einsum('ij,imj->m', v, qsf.dB_by_dcoeffs) + np.einsum('ijk,imjk->m', vgrad, qsf.d2B_by_dcoeffsdX))
+
+def test_value_and_grad_matches_individual_derivatives():
+    nfp = 2
+    (coils, _, ma, _) = get_24_coil_data(nfp=nfp, ppp=20)
+    currents = len(coils) * [1e4]
+    stellerator = CoilCollection(coils, currents, nfp, True)
+    bs = BiotSavart(stellerator.coils, stellerator.currents)
+    bs.set_points(ma.gamma)
+    qsf = QuasiSymmetricField(-2.25, ma)
+    J = BiotSavartQuasiSymmetricFieldDifference(qsf, bs)
+    J0, dJ = J.value_and_grad()
+    assert np.isclose(J0, 0.5 * (J.J_L2() + J.J_H1()), rtol=1e-14)
+    assert J.value_and_grad(compute_derivative=False) == (J0, None)
+    assert np.allclose(dJ["etabar"], 0.5 * (J.dJ_L2_by_detabar() + J.dJ_H1_by_detabar()), rtol=1e-12, atol=0)
+    assert np.allclose(dJ["magneticaxiscoefficients"], 0.5 * (J.dJ_L2_by_dmagneticaxiscoefficients() + J.dJ_H1_by_dmagneticaxiscoefficients()), rtol=1e-12, atol=1e-14)
+    assert np.allclose(stellerator.reduce_coefficient_derivatives(dJ["coilcoefficients"]),
+                       0.5 * (stellerator.reduce_coefficient_derivatives(J.dJ_L2_by_dcoilcoefficients()) + stellerator.reduce_coefficient_derivatives(J.dJ_H1_by_dcoilcoefficients())), rtol=1e-12, atol=1e-14)
+    assert np.allclose(stellerator.reduce_current_derivatives(dJ["coilcurrents"]),
+                       0.5 * (stellerator.reduce_current_derivatives(J.dJ_L2_by_dcoilcurrents()) + stellerator.reduce_current_derivatives(J.dJ_H1_by_dcoilcurrents())), rtol=1e-12, atol=1e-14)
+
+def get_ncsx_stochastic_data(sigma, **kwargs):
+    from pyplasmaopt import get_ncsx_data, GaussianSampler
+    coils, ma, currents = get_ncsx_data(Nt=4, ppp=10)
+    stellerator = CoilCollection(coils, currents, 3, True)
+    qsf = QuasiSymmetricField(0.685, ma)
+    sampler = GaussianSampler(coils[0].points, length_scale=0.2, sigma=sigma, **kwargs)
+    return (stellerator, ma, qsf, sampler)
+
+def test_stochastic_objective_packed_gradients():
+    from pyplasmaopt import StochasticQuasiSymmetryObjective
+    stellerator, ma, qsf, sampler = get_ncsx_stochastic_data(sigma=0.01)
+    J = StochasticQuasiSymmetryObjective(stellerator, sampler, 3, qsf, 1)
+    J.set_magnetic_axis(ma.gamma)
+    vals, grads = J.value_and_grad_samples()
+    mean_vals, mean_grads = J.value_and_mean_grad()
+    assert np.allclose(vals, mean_vals, rtol=1e-14)
+    for key, dJ in [("etabar", J.dJ_by_detabar_samples()), ("magneticaxiscoefficients", J.dJ_by_dmagneticaxiscoefficients_samples()),
+                    ("coilcurrents", J.dJ_by_dcoilcurrents_samples()), ("coilcoefficients", J.dJ_by_dcoilcoefficients_samples())]:
+        assert np.allclose(grads[key], dJ, rtol=1e-12, atol=1e-12 * np.max(np.abs(dJ)))
+        assert np.allclose(mean_grads[key], np.mean(dJ, axis=0), rtol=1e-12, atol=1e-12 * np.max(np.abs(dJ)))
+
+    from pyplasmaopt import CVaR
+    cvar = CVaR(0.5, eps=0.1)
+    t = np.median(vals)
+    cvar_vals, cvar_grads = J.value_and_weighted_grad(lambda Jsamples: cvar.weights(t, Jsamples))
+    assert np.allclose(cvar_vals, vals, rtol=1e-14)
+    for key in grads:
+        assert np.allclose(cvar_grads[key], cvar.dJ_dx(t, vals, grads[key]), rtol=1e-12, atol=1e-12 * np.max(np.abs(grads[key])))
+
+def test_stochastic_objective_streamed_samples():
+    from pyplasmaopt import StochasticQuasiSymmetryObjective
+    stellerator, ma, qsf, sampler = get_ncsx_stochastic_data(sigma=0.01)
+    J = StochasticQuasiSymmetryObjective(stellerator, sampler, 5, qsf, 1)
+    # regenerate every sample from its seed, keeping at most one of them
+    J_streamed = StochasticQuasiSymmetryObjective(stellerator, sampler, 5, qsf, 1, chunk_size=2, cache_size=1)
+    for i in range(2):
+        J.set_magnetic_axis(ma.gamma)
+        J_streamed.set_magnetic_axis(ma.gamma)
+        vals, grads = J.value_and_grad_samples()
+        vals_streamed, grads_streamed = J_streamed.value_and_grad_samples()
+        assert np.allclose(vals, vals_streamed, rtol=1e-13)
+        for key in grads:
+            assert np.allclose(grads[key], grads_streamed[key], rtol=1e-12, atol=1e-12 * np.max(np.abs(grads[key])))
+        assert len(J_streamed.samples.cache) == 1
+        J.resample()
+        J_streamed.resample()
+
+def test_stochastic_objective_linearised_samples():
+    from pyplasmaopt import StochasticQuasiSymmetryObjective
+    errs, grad_errs = [], []
+    for sigma in [1e-3, 1e-4]:
+        stellerator, ma, qsf, sampler = get_ncsx_stochastic_data(sigma=sigma)
+        J = StochasticQuasiSymmetryObjective(stellerator, sampler, 3, qsf, 1)
+        J_linearised = StochasticQuasiSymmetryObjective(stellerator, sampler, 3, qsf, 1, chunk_size=2, linearised=True)
+        J.set_magnetic_axis(ma.gamma)
+        J_linearised.set_magnetic_axis(ma.gamma)
+        vals, grads = J.value_and_grad_samples()
+        vals_linearised, grads_linearised = J_linearised.value_and_grad_samples()
+        errs.append(np.max(np.abs(np.asarray(vals) - vals_linearised)))
+        assert np.isclose(J_linearised.linearisation_error(3), np.max(np.abs(np.asarray(vals) - vals_linearised)/np.abs(vals)), rtol=1e-6)
+        grad_errs.append([np.max(np.abs(grads[key] - grads_linearised[key]))/np.max(np.abs(grads[key])) for key in grads])
+    # the error of the linearisation is quadratic in the size of the perturbation,
+    # and as the gradients are those of the linearised objective, so are their errors
+    assert errs[1] < 0.02 * errs[0]
+    assert max(grad_errs[0]) < 1e-3
+    assert all(e1 < 0.02 * e0 for (e0, e1) in zip(*grad_errs))
+
+@pytest.mark.parametrize("sampling", ["antithetic", "sobol", "lhs"])
+def test_stochastic_objective_sampling(sampling):
+    from pyplasmaopt import StochasticQuasiSymmetryObjective
+    from scipy.stats import norm
+    stellerator, ma, qsf, sampler = get_ncsx_stochastic_data(sigma=0.01, method="kl", tol=1e-6)
+    J = StochasticQuasiSymmetryObjective(stellerator, sampler, 8, qsf, 1, cache_size=0, sampling=sampling)
+    for draw in range(2):
+        samples = [[c.sample.coefficients.copy() for c in J.samples[i]] for i in range(8)]
+        J.samples.release()
+        # regenerating a sample gives the same perturbation
+        assert all(np.array_equal(a, b.sample.coefficients) for (a, b) in zip(samples[5], J.samples[5]))
+        if sampling == "antithetic":
+            assert all(np.array_equal(a, -b) for (a, b) in zip(samples[2], samples[3]))
+        else:
+            # every one dimensional projection of the design is stratified
+            u = norm.cdf([s[0][0, 0] for s in samples])
+            assert sorted(np.floor(8 * u)) == list(range(8))
+        J.resample()
+
+def test_stochastic_objective_control_variate():
+    from pyplasmaopt import StochasticQuasiSymmetryObjective, ControlVariate
+    stellerator, ma, qsf, sampler = get_ncsx_stochastic_data(sigma=1e-3)
+    J = StochasticQuasiSymmetryObjective(stellerator, sampler, 8, qsf, 1, chunk_size=3)
+    J.set_magnetic_axis(ma.gamma)
+    J0 = BiotSavartQuasiSymmetricFieldDifference(qsf, J.nominal_biotsavart).value_and_grad(compute_derivative=False)[0]
+    # the controls are the first order change of the unperturbed objective
+    vals, mean_grads = J.value_and_mean_grad()
+    controls = J.local_controls()
+    assert np.allclose(np.asarray(vals) - J0, controls, rtol=0, atol=0.05 * np.max(np.abs(controls)))
+
+    cv = ControlVariate()
+    cv_vals, cv_mean, cv_grads = J.value_and_controlled_mean_grad(cv)
+    assert np.allclose(cv_vals, vals, rtol=1e-14)
+    assert np.isclose(cv_mean, np.mean(vals), rtol=1e-14)
+    for key in mean_grads:
+        assert np.allclose(cv_grads[key], mean_grads[key], rtol=1e-12, atol=1e-12 * np.max(np.abs(mean_grads[key])))
+    # the coefficient of the value is close to one, and the controlled means
+    # fluctuate much less than the plain ones
+    assert cv.coefficient() == 0.
+    cv.accept()
+    assert abs(cv.coefficient()[0] - 1) < 0.1
+    means, cv_means = [], []
+    for i in range(4):
+        J.resample()
+        vals, cv_mean, _ = J.value_and_controlled_mean_grad(cv)
+        cv.accept()
+        means.append(np.mean(vals))
+        cv_means.append(cv_mean)
+    assert np.std(cv_means) < 0.2 * np.std(means)
+
+def test_stochastic_objective_tail_shift():
+    from pyplasmaopt import StochasticQuasiSymmetryObjective, CVaR
+    from scipy.stats import norm
+    stellerator, ma, qsf, sampler = get_ncsx_stochastic_data(sigma=3e-3)
+    J = StochasticQuasiSymmetryObjective(stellerator, sampler, 16, qsf, 1, cache_size=0)
+    J.set_magnetic_axis(ma.gamma)
+    controls = J.local_controls()
+    assert J.likelihood_ratios() is None
+    # the controls are linear in the normal numbers, so the shift moves them
+    # by |shift| |g| and the likelihood ratios follow from them
+    g = J.latent_sensitivity()
+    J.set_tail_shift(0.9)
+    q = norm.pdf(norm.ppf(0.9))/0.1
+    shifted_controls = J.local_controls()
+    assert np.allclose(shifted_controls - controls, q * np.linalg.norm(g), rtol=1e-8)
+    assert np.allclose(np.log(J.likelihood_ratios()), -q * controls/np.linalg.norm(g) - q**2/2, rtol=1e-8)
+
+    # compare the CVaR estimates of plain and importance sampling with a large
+    # plain Monte Carlo reference
+    cvar = CVaR(0.9, 0.01)
+    def estimate(J):
+        vals, ratios = np.asarray(J.J_samples()), J.likelihood_ratios()
+        return cvar.J(cvar.find_optimal_t(vals, np.quantile(vals, 0.9), ratios), vals, ratios)
+    reference = StochasticQuasiSymmetryObjective(stellerator, sampler, 256, qsf, 100, chunk_size=64, cache_size=0)
+    reference.set_magnetic_axis(ma.gamma)
+    cvar_ref = estimate(reference)
+    errs_mc, errs_is = [], []
+    for seed in range(4):
+        J = StochasticQuasiSymmetryObjective(stellerator, sampler, 16, qsf, seed, cache_size=0)
+        J.set_magnetic_axis(ma.gamma)
+        errs_mc.append(estimate(J) - cvar_ref)
+        J.set_tail_shift(0.9)
+        errs_is.append(estimate(J) - cvar_ref)
+    assert np.linalg.norm(errs_is) < 0.5 * np.linalg.norm(errs_mc)
+
+def test_stochastic_objective_set_nsamples():
+    from pyplasmaopt import StochasticQuasiSymmetryObjective
+    stellerator, ma, qsf, sampler = get_ncsx_stochastic_data(sigma=1e-3)
+    J = StochasticQuasiSymmetryObjective(stellerator, sampler, 3, qsf, 1)
+    J.set_magnetic_axis(ma.gamma)
+    vals = J.J_samples()
+    # growing the sample set keeps the previous samples
+    J.set_nsamples(6)
+    all_vals, all_grads = J.value_and_grad_samples()
+    assert np.allclose(all_vals[:3], vals, rtol=1e-14)
+    vals, mean_grads, variances = J.value_mean_grad_and_variance()
+    assert np.allclose(vals, all_vals, rtol=1e-14)
+    for key in all_grads:
+        scale = np.max(np.abs(all_grads[key]))
+        assert np.allclose(mean_grads[key], np.mean(all_grads[key], axis=0), rtol=0, atol=1e-12 * scale)
+        assert np.allclose(variances[key], np.var(all_grads[key], axis=0, ddof=1), rtol=0, atol=1e-10 * scale**2)
+
+@pytest.mark.parametrize("nquadpoints", [[40], [20, 40]])
+def test_multilevel_stochastic_objective(nquadpoints):
+    from pyplasmaopt import StochasticQuasiSymmetryObjective, MultilevelStochasticQuasiSymmetryObjective
+    stellerator, ma, qsf, sampler = get_ncsx_stochastic_data(sigma=3e-3, method="kl")
+    nsamples = [4, 3, 2][:len(nquadpoints)+1]
+    J = MultilevelStochasticQuasiSymmetryObjective(stellerator, sampler, nsamples, qsf, 1, nquadpoints, chunk_size=2)
+    # the coarse copies follow the dofs of the stellarator
+    stellerator.set_dofs(stellerator.get_dofs() * (1 + 1e-3))
+    J.set_magnetic_axis(ma.gamma)
+    with pytest.raises(RuntimeError):
+        J.level_variances()
+    vals, grads = J.value_and_mean_grad()
+    assert len(vals) == J.nsamples == sum(nsamples[:1] + [2*n for n in nsamples[1:]])
+    mlmc_mean = J.likelihood_ratios() @ vals/len(vals)
+    # the finest level is evaluated second to last, before its coarse copy
+    nfine = nsamples[-1]
+    assert np.array_equal(J.finest_level_values(), vals[-2*nfine:-nfine])
+
+    # the coarsest level on its own
+    J0 = StochasticQuasiSymmetryObjective(J.stellarators[0], sampler.at_points(J.stellarators[0]._base_coils[0].points), nsamples[0], qsf, 1)
+    J0.set_magnetic_axis(ma.gamma)
+    vals0, grads0 = J0.value_and_mean_grad()
+    assert np.allclose(vals[:nsamples[0]], vals0, rtol=1e-14)
+    if nquadpoints == [40]:
+        # a level with the same grid as the one below has no correction, as
+        # both evaluations of a correction share the perturbation
+        assert np.allclose(vals[nsamples[0]:nsamples[0]+nsamples[1]], vals[nsamples[0]+nsamples[1]:], rtol=1e-14)
+        assert np.isclose(mlmc_mean, np.mean(vals0), rtol=1e-13)
+        for key in grads:
+            assert np.allclose(grads[key], grads0[key], rtol=0, atol=1e-12 * np.max(np.abs(grads0[key])))
+    else:
+        # the corrections are small compared to the spread of the samples
+        variances = J.level_variances()
+        assert variances[2] < 1e-2 * variances[0]
+        assert np.all(np.diff(J.optimal_nsamples(1e-2)) <= 0)
+
 if __name__ == "__main__":
     test_taylor_test_ma_coeffs("l2")
     test_taylor_test_ma_coeffs("h1")
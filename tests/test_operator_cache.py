@@ -0,0 +1,50 @@
+import numpy as np
+import pytest
+from pyplasmaopt import OperatorCache, operator_cache, CartesianFourierCurve, QuasiSymmetricField, \
+    StelleratorSymmetricCylindricalFourierCurve
+
+
+def test_operator_cache_lru_eviction():
+    cache = OperatorCache(maxbytes=3 * 800)
+    for i in range(3):
+        cache.get(("op", i), lambda: np.zeros((100, )))
+    assert len(cache) == 3 and cache.info()["nbytes"] == 3 * 800
+    cache.get(("op", 0), lambda: None)
+    cache.get(("op", 3), lambda: np.zeros((100, )))
+    # ("op", 1) was the least recently used entry
+    assert ("op", 1) not in cache.entries and ("op", 0) in cache.entries
+    info = cache.info()
+    assert (info["hits"], info["misses"], info["evictions"]) == (1, 4, 1)
+    assert info["hit_rate"] == 0.2
+    # entries larger than the cache are computed but not stored
+    big = cache.get(("big", ), lambda: np.zeros((1000, )))
+    assert big.shape == (1000, ) and ("big", ) not in cache.entries
+    cache.resize(800)
+    assert len(cache) == 1 and cache.info()["nbytes"] == 800
+    cache.clear()
+    assert len(cache) == 0 and cache.info()["nbytes"] == 0
+
+
+def test_operator_cache_read_only():
+    cache = OperatorCache()
+    a, b = cache.get(("pair", ), lambda: (np.zeros((3, )), np.ones((3, ))))
+    with pytest.raises(ValueError):
+        a[0] = 1.
+    with pytest.raises(ValueError):
+        b[0] = 1.
+
+
+def test_operator_cache_shared_between_objects():
+    points = np.linspace(0, 1, 37, endpoint=False)
+    hits = operator_cache.info()["hits"]
+    c1, c2 = CartesianFourierCurve(3, points), CartesianFourierCurve(3, points.copy())
+    assert np.shares_memory(c1.d2gamma_by_dphidcoeff, c2.d2gamma_by_dphidcoeff)
+    ma_points = np.linspace(0, 1/2, 29, endpoint=False)
+    ma = StelleratorSymmetricCylindricalFourierCurve(3, 2, ma_points)
+    ma.coefficients[0][0] = 1.
+    ma.coefficients[0][1] = 0.1
+    ma.coefficients[1][0] = 0.1
+    ma.update()
+    qsf1, qsf2 = QuasiSymmetricField(-2.25, ma), QuasiSymmetricField(-2.25, ma)
+    assert qsf1.D is qsf2.D
+    assert operator_cache.info()["hits"] >= hits + 2
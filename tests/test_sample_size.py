@@ -0,0 +1,13 @@
+import numpy as np
+from pyplasmaopt import NormTest
+
+def test_norm_test():
+    test = NormTest(100, theta=0.5)
+    grad = np.asarray([3., 4.])
+    # the sum of the variances 6.25 = theta^2 |g|^2 passes with a single sample
+    assert test(1, [1.25, 5.], grad) == 1
+    assert test(10, [1.25, 5.], grad) == 10
+    # four times the variance needs four times the samples
+    assert test(1, [5., 20.], grad) == 4
+    assert test(1, [500., 2000.], grad) == 100
+    assert test(1, [1., 1.], np.zeros(2)) == 100